@@ -0,0 +1,327 @@
+""" run `main.main()` against the fakes in `fakes.py` & report how it keeps up,
+so throughput can be measured (& compared between versions) off the pi:
+
+    python benchmark.py --interval 1 --duration 60 --json results.json
+    python benchmark.py --interval 1 --duration 60 --compare results.json
+
+or, with --night, replay a whole night of a mode preset on a sped up clock,
+waiting for its observation start time & all, to see how the disk usage,
+file count & memory hold up:
+
+    python benchmark.py --night -c standard_mode.json --scale 100
+"""
+import os
+import sys
+import json
+import glob
+import asyncio
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime, timedelta, timezone
+
+import h5py
+import numpy as np
+
+import fakes
+from clock import ScaledClock
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--config', '-c',
+    help='mode preset to start from',
+    default='standard_mode.json'
+)
+parser.add_argument(
+    '--interval',
+    type=float,
+    help='seconds between exposures (default 1, or the config\'s for --night)'
+)
+parser.add_argument(
+    '--exposure-time',
+    type=float,
+    help='seconds each fake exposure takes (default 0.05, or the config\'s '
+        'for --night)'
+)
+parser.add_argument(
+    '--duration',
+    type=float,
+    help='seconds to run for (default 60, or the config\'s for --night)'
+)
+parser.add_argument(
+    '--night',
+    action='store_true',
+    help='simulate a whole night of the config on a sped up clock'
+)
+parser.add_argument(
+    '--scale',
+    type=float,
+    default=100,
+    help='with --night, how many times faster than real time to run'
+)
+parser.add_argument(
+    '--lead',
+    type=float,
+    default=300,
+    help='with --night, start the clock this many seconds before the '
+        'observation start time'
+)
+parser.add_argument('--capture-mode', default='rgb', choices=['rgb', 'raw'])
+parser.add_argument('--raw-bits', type=int, default=12, choices=[12, 16])
+parser.add_argument(
+    '--conversion-time',
+    type=float,
+    default=0.045,
+    help='seconds each fake magnetometer reading takes'
+)
+parser.add_argument(
+    '--set',
+    action='append',
+    default=[],
+    metavar='KEY=VALUE',
+    help='override a config key; VALUE is parsed as json if it can be'
+)
+parser.add_argument(
+    '--outdir',
+    help='where to write the data (default: a new temporary directory)'
+)
+parser.add_argument('--json', help='write the results to this file')
+parser.add_argument(
+    '--compare',
+    help='results file from an earlier run to compare against'
+)
+parser.add_argument('--verbose', '-v', action='store_true')
+
+
+def _config_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def make_config(args, workdir):
+    with open(args.config) as f:
+        config = json.load(f)
+
+    if not args.night:
+        args.interval = args.interval or 1
+        args.exposure_time = args.exposure_time or 0.05
+        args.duration = args.duration or 60
+        # the whole run in a single line of the metrics file
+        config['metrics_interval'] = 2 * args.duration
+
+    if args.interval is not None:
+        config['exposure_interval'] = args.interval
+    if args.exposure_time is not None:
+        config['exposure_duration'] = args.exposure_time
+    if args.duration is not None:
+        config['observation_interval'] = args.duration / 3600 # [hours]
+
+    config.update(capture_mode=args.capture_mode, raw_bits=args.raw_bits)
+    for override in args.set:
+        key, value = override.split('=', 1)
+        config[key] = _config_value(value)
+
+    path = f'{workdir}/config.json'
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+    return config, path
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return dict(p50=None, p95=None, max=None)
+    p50, p95 = np.percentile(values, [50, 95])
+    return dict(p50=float(p50), p95=float(p95), max=float(np.max(values)))
+
+
+def _observation_start(config, lead):
+    """ when to start a simulated night's clock: `lead` seconds before the
+    next `observation_start_time`
+    """
+    now = datetime.now()
+    start = datetime.combine(
+        now.date(),
+        datetime.strptime(config['observation_start_time'], '%H:%M').time()
+    )
+    if start < now:
+        start += timedelta(days=1)
+    return (start - timedelta(seconds=lead)).astimezone(timezone.utc)
+
+
+def summarize(datadir, elapsed, config):
+    """ frames/s, MB/s, schedule jitter, stage latencies & disk & memory use
+    from the files a run left behind. stage latencies are for the worst
+    period of the metrics file
+    """
+    n_frames = 0
+    n_full_frames = 0
+    frame_bytes = 0
+    jitter = []
+    for path in glob.glob(f'{datadir}/*/*-exposures*.hdf5'):
+        with h5py.File(path, 'r') as f:
+            # files written in swmr mode are trimmed instead
+            n_valid = int(f.attrs.get('n_valid', f['timestamp'].shape[0]))
+            written = f['timestamp'][:n_valid] > 0
+            n_frames += int(written.sum())
+            frame_bytes += int(written.sum()) * int(
+                np.prod(f['exposure'].shape[1:]) * f['exposure'].dtype.itemsize
+            )
+            jitter.append(f['jitter'][:n_valid][written])
+            if 'selection' in f:
+                kept = f['selection'].fields('kept')[:n_valid][written]
+                n_full_frames += int(kept.sum())
+            else:
+                n_full_frames += int(written.sum())
+    jitter = np.concatenate(jitter) if jitter else np.zeros((0,))
+
+    files = glob.glob(f'{datadir}/*/*.hdf5')
+    file_bytes = sum(os.path.getsize(path) for path in files)
+
+    stages = {}
+    peak_rss = []
+    for path in glob.glob(f'{datadir}/*/metrics.jsonl'):
+        with open(path) as f:
+            for line in f:
+                summary = json.loads(line)
+                peak_rss.append(summary['peak_rss_mb'] or 0)
+                for stage, stats in summary['stages'].items():
+                    worst = stages.setdefault(stage, stats)
+                    if stats['p95'] > worst['p95']:
+                        stages[stage] = stats
+
+    n_expected = int(config['observation_interval'] * 3600 / config['exposure_interval'])
+
+    return dict(
+        config=config,
+        elapsed=elapsed,
+        n_frames=n_frames,
+        n_expected=n_expected,
+        n_full_frames=n_full_frames,
+        frames_per_s=n_frames / elapsed,
+        frame_mb_per_s=frame_bytes / elapsed / 1024**2,
+        file_mb_per_s=file_bytes / elapsed / 1024**2,
+        jitter=_percentiles(jitter),
+        stages=stages,
+        n_files=len(files),
+        file_gb=file_bytes / 1024**3,
+        peak_rss_mb=max(peak_rss, default=None)
+    )
+
+
+def report(results, baseline=None):
+    def line(name, key, fmt='{:.3f}'):
+        value = results[key]
+        text = f'{name:>24}: {fmt.format(value)}'
+        if baseline is not None and baseline.get(key):
+            text += f'  ({100 * (value / baseline[key] - 1):+.1f}% vs baseline)'
+        print(text)
+
+    print(
+        f'{results["n_frames"]} of {results["n_expected"]} frames '
+        f'in {results["elapsed"]:.1f}s'
+    )
+    if results['n_full_frames'] != results['n_frames']:
+        print(f'{"full resolution frames":>24}: {results["n_full_frames"]}')
+    line('frames/s', 'frames_per_s')
+    line('frame data MB/s', 'frame_mb_per_s')
+    line('file MB/s', 'file_mb_per_s')
+    print(f'{"data files":>24}: {results["n_files"]}, {results["file_gb"]:.2f} GB')
+    if results['peak_rss_mb'] is not None:
+        line('peak rss (MB)', 'peak_rss_mb', '{:.0f}')
+
+    jitter = results['jitter']
+    if jitter['max'] is not None:
+        print(
+            f'{"jitter (ms)":>24}: p50 = {1e3 * jitter["p50"]:.1f}, '
+            f'p95 = {1e3 * jitter["p95"]:.1f}, max = {1e3 * jitter["max"]:.1f}'
+        )
+
+    for stage, stats in sorted(results['stages'].items()):
+        text = (
+            f'{stage + " (ms)":>24}: p50 = {stats["p50"]:.1f}, '
+            f'p95 = {stats["p95"]:.1f}, max = {stats["max"]:.1f}'
+        )
+        if baseline is not None and stage in baseline.get('stages', {}):
+            text += f'  (p95 was {baseline["stages"][stage]["p95"]:.1f})'
+        print(text)
+
+
+def run(args):
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    workdir = args.outdir or tempfile.mkdtemp(prefix='gpoe-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+
+    config, config_path = make_config(args, workdir)
+
+    fakes.install(conversion_time=args.conversion_time)
+
+    w1_dir = f'{workdir}/w1/'
+    fakes.make_w1_device(w1_dir)
+
+    # `main` reads its config from the command line when it's imported
+    sys.argv = ['main.py', '-c', config_path, '--now']
+
+    import measure
+    measure.W1_DEVICES_DIR = w1_dir
+
+    import main
+    from logger import setup_logger, configure_logging
+
+    main.parentdir = f'{workdir}/data'
+    os.makedirs(main.parentdir, exist_ok=True)
+    main.log = setup_logger('main-logger', sys.stdout, 'main')
+    configure_logging(queue_size=main.log_queue_size, rate=main.log_rate_limit)
+
+    if args.night:
+        # the setup's test exposure is sped up too
+        fakes.use_clock(ScaledClock(args.scale))
+
+    main.setup(camera_wait=0)
+
+    if args.night:
+        # start the night's clock after the setup, so it isn't already past
+        # the observation start time by the end of it
+        clock = ScaledClock(
+            args.scale, start=_observation_start(config, args.lead)
+        )
+        fakes.use_clock(clock)
+        main.clock = clock
+
+    t1 = perf_counter()
+    try:
+        if args.night:
+            main.observe(n_nights=1)
+        else:
+            asyncio.run(main.main())
+    finally:
+        elapsed = perf_counter() - t1
+        main.teardown()
+
+    results = summarize(main.parentdir, elapsed, config)
+    results['outdir'] = workdir
+
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(args)
+
+    report(results, baseline)
+    print(f'data written to {results["outdir"]}')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
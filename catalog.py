@@ -0,0 +1,165 @@
+import os
+import sys
+import threading
+
+import h5py
+import numpy as np
+
+from data import _frame_mask, _level_dataset, _n_valid, _read_rows, night_files
+
+from logger import setup_logger
+log = setup_logger('catalog-logger', sys.stdout, 'catalog')
+
+CATALOG_NAME = 'catalog.hdf5'
+
+_lock = threading.Lock()
+
+
+def catalog_path(outdir):
+    return f'{outdir}/{CATALOG_NAME}'
+
+
+def _create_catalog(path):
+    with h5py.File(path, 'w') as f:
+        f.create_dataset(
+            'files',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(64,),
+            dtype=h5py.string_dtype()
+        )
+        for name, dtype in [
+            ('timestamp', np.float64), ('file', np.int32), ('row', np.int32)
+        ]:
+            f.create_dataset(
+                name,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(1024,),
+                dtype=dtype
+            )
+
+
+def _set(dataset, values):
+    dataset.resize(len(values), axis=0)
+    dataset[:] = values
+
+
+def add_to_catalog(path):
+    """ add the frames of the exposure file at `path` to the catalog of the
+    night it's in. if the file is already in the catalog, its entries are
+    replaced
+    """
+    outdir, filename = os.path.split(path)
+
+    with h5py.File(path, 'r') as f:
+        if 'n_valid' in f.attrs:
+            timestamp = f['timestamp'][:_n_valid(f)]
+        else:
+            timestamp = f['timestamp'][:]
+
+        # frames that weren't kept aren't in the catalog
+        rows = np.flatnonzero(_frame_mask(f, timestamp))
+    timestamp = timestamp[rows]
+
+    with _lock:
+        if not os.path.isfile(catalog_path(outdir)):
+            _create_catalog(catalog_path(outdir))
+
+        with h5py.File(catalog_path(outdir), 'r+') as f:
+            files = list(f['files'].asstr()[:])
+
+            if filename in files:
+                file_id = files.index(filename)
+                keep = f['file'][:] != file_id
+                for name in ['timestamp', 'file', 'row']:
+                    _set(f[name], f[name][:][keep])
+            else:
+                file_id = len(files)
+                _set(f['files'], files + [filename])
+
+            n = f['timestamp'].shape[0]
+            for name, values in [
+                ('timestamp', timestamp),
+                ('file', np.full(len(rows), file_id)),
+                ('row', rows)
+            ]:
+                f[name].resize(n + len(rows), axis=0)
+                f[name][n:] = values
+
+    log.info(f'added {len(rows)} frames from {path} to catalog')
+
+
+def build_catalog(outdir):
+    """ (re)build the catalog for a night from all of its exposure files """
+    if os.path.isfile(catalog_path(outdir)):
+        os.remove(catalog_path(outdir))
+
+    for path in night_files(outdir, 'exposures'):
+        add_to_catalog(path)
+
+
+class Catalog:
+    """ a night's index of frame timestamp -> (file, row), so a time range
+    can be looked up without opening every hourly file
+
+        catalog = Catalog('/media/usb_drive/2025-01-01')
+        for timestamp, frame in catalog.frames(start, stop):
+            ...
+
+    chunk_size: int, number of frames read from disk at a time by `frames`
+    """
+
+    def __init__(self, outdir, chunk_size=16):
+        self.outdir = outdir
+        self.chunk_size = chunk_size
+
+        with h5py.File(catalog_path(outdir), 'r') as f:
+            self.files = list(f['files'].asstr()[:])
+            self.timestamp = f['timestamp'][:]
+            self.file = f['file'][:]
+            self.row = f['row'][:]
+
+        # files are added in the order they're closed, but just in case
+        if (np.diff(self.timestamp) < 0).any():
+            order = np.argsort(self.timestamp, kind='stable')
+            self.timestamp = self.timestamp[order]
+            self.file = self.file[order]
+            self.row = self.row[order]
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def query(self, start=None, stop=None):
+        """ the frames taken in [start, stop), as a list of
+        (path, rows, timestamps) for each file they're in, in time order
+        """
+        i0 = 0 if start is None else np.searchsorted(self.timestamp, start)
+        i1 = len(self) if stop is None else np.searchsorted(self.timestamp, stop)
+
+        file = self.file[i0:i1]
+        breaks = np.flatnonzero(np.diff(file)) + 1
+
+        return [
+            (f'{self.outdir}/{self.files[file_ids[0]]}', rows, timestamps)
+            for file_ids, rows, timestamps in zip(
+                np.split(file, breaks),
+                np.split(self.row[i0:i1], breaks),
+                np.split(self.timestamp[i0:i1], breaks)
+            )
+            if len(file_ids)
+        ]
+
+    def frames(self, start=None, stop=None, level=1):
+        """ yield (timestamp, frame) for the frames taken in [start, stop),
+        binned `level` x `level` (see `data.read_file`)
+        """
+        for path, rows, timestamps in self.query(start, stop):
+            with h5py.File(path, 'r') as f:
+                dataset = _level_dataset(f, level)
+                for i in range(0, len(rows), self.chunk_size):
+                    chunk = slice(i, i + self.chunk_size)
+                    yield from zip(
+                        timestamps[chunk],
+                        _read_rows(dataset, rows[chunk])
+                    )
@@ -0,0 +1,65 @@
+import time
+import asyncio
+from datetime import datetime, timezone
+
+
+class Clock:
+    """ the wall & monotonic clocks, and sleeping on them. everything that
+    schedules against time takes one of these, so a `ScaledClock` can stand
+    in to run a night faster than real time
+    """
+
+    def now(self):
+        """ the current UTC time, as a datetime """
+        return datetime.now(timezone.utc)
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+class ScaledClock(Clock):
+    """ a clock that runs `scale` times faster than real time, starting from
+    `start` (a datetime; now by default). sleeps are shortened to match, so
+    eg an hour's sleep at scale=60 takes a real minute.
+
+    only what's timed with the clock is sped up; disk i/o & anything else
+    that takes real time looks `scale` times slower against it
+    """
+
+    def __init__(self, scale, start=None):
+        if start is None:
+            start = datetime.now(timezone.utc)
+
+        self.scale = scale
+        self._start = start.timestamp()
+        self._real_start = time.monotonic()
+
+    def _elapsed(self):
+        return (time.monotonic() - self._real_start) * self.scale
+
+    def now(self):
+        return datetime.fromtimestamp(self.time(), timezone.utc)
+
+    def time(self):
+        return self._start + self._elapsed()
+
+    def monotonic(self):
+        return self._real_start + self._elapsed()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0) / self.scale)
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(max(seconds, 0) / self.scale)
+
+
+real_clock = Clock()
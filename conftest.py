@@ -0,0 +1,7 @@
+from logger import stop_logging
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # the loggers write to the stdout pytest captures, which is closed
+    # before the interpreter's exit handlers would write out the logs
+    stop_logging()
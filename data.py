@@ -1,19 +1,33 @@
 import os
 import sys
 import json
+import time
+import threading
 from copy import copy
+from contextlib import nullcontext
 
 import h5py
 import numpy as np
+from numpy.lib.recfunctions import unstructured_to_structured
+
+from clock import real_clock
 
 from logger import setup_logger
 log = setup_logger('data-logger', sys.stdout, 'data')
 
 
-def _create_file(path, dataset_parameters, chunk_size=None, config=None):
+# the oldest file format that can be written in swmr mode; files are made in
+# it when they will be, so they're still readable with hdf5 1.10
+SWMR_LIBVER = ('v110', 'v110')
+
+
+def _create_file(
+    path, dataset_parameters, chunk_size=None, config=None, libver=None
+):
     """
     path: must NOT have h5py on the end
     n_expected: int, the number of integers expected
+    libver: `h5py.File`'s libver, eg `SWMR_LIBVER`
     """
     
     orig_name, ext = os.path.splitext(path)
@@ -27,9 +41,13 @@ def _create_file(path, dataset_parameters, chunk_size=None, config=None):
     log.debug(f'making file at {path}')
 
     if ext == '.hdf5':
-        with h5py.File(path, 'w', rdcc_nbytes=1024**2*10) as f:
+        with h5py.File(
+            path, 'w', libver=libver, rdcc_nbytes=1024**2*10
+        ) as f:
             for params in dataset_parameters:
-                f.create_dataset(**params)
+                params = copy(params)
+                attrs = params.pop('attrs', {})
+                f.create_dataset(**params).attrs.update(attrs)
                 log.debug(f'made dataset with parameters {params}')
             if config is not None:
                 if isinstance(config, dict):
@@ -51,38 +69,240 @@ def _create_file(path, dataset_parameters, chunk_size=None, config=None):
     return path
 
 
+MEASUREMENT_DTYPE = np.dtype([
+    ('timestamp', np.float64),
+    ('temperature', np.float64),
+    ('bx', np.float64),
+    ('by', np.float64),
+    ('bz', np.float64),
+])
+
+
+def _measurement_dataset_parameters(n_measurements, stream_chunk_rows=1024):
+    return [
+        # one (timestamp, temperature, bx, by, bz) record per sample
+        dict(
+            name='measurements',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_measurements, 1), 1024),),
+            dtype=MEASUREMENT_DTYPE
+        ),
+        # (timestamp, bx, by, bz) rows from a streaming magnetometer
+        dict(
+            name='magnetic_field_stream',
+            shape=(0, 4),
+            maxshape=(None, 4),
+            chunks=(stream_chunk_rows, 4),
+            dtype=np.float64,
+            attrs=dict(columns=['timestamp', 'bx', 'by', 'bz'])
+        ),
+    ]
+
+
+DEFAULT_EXPOSURE_CODEC = dict(
+    compression=None,
+    compression_level=4,
+    shuffle=False,
+    fletcher32=False,
+    tile=None
+)
+
+
+def _exposure_codec(codec=None):
+    """ fill in the defaults for an `exposure_compression` config entry
+
+    codec: dict with any of the keys
+        compression: None, 'gzip' or 'lzf'
+        compression_level: int 0-9, only used for gzip
+        shuffle: bool, apply the hdf5 shuffle filter before compressing
+        fletcher32: bool, store a checksum with each chunk
+        tile: None, or [n_xpix, n_ypix] to split each frame into tiles of
+            this size rather than storing the whole frame as one chunk
+    """
+    codec = {**DEFAULT_EXPOSURE_CODEC, **(codec or {})}
+
+    valid_compression = [None, 'gzip', 'lzf']
+    if codec['compression'] not in valid_compression:
+        raise ValueError(f'compression must be one of {valid_compression}')
+
+    if codec['compression'] != 'gzip':
+        codec['compression_level'] = None
+
+    return codec
+
+
+def _exposure_filter_parameters(codec, frame_shape):
+    """ turn an `exposure_compression` config entry into `create_dataset`
+    keyword arguments for a dataset of frames with shape `frame_shape`
+    """
+    codec = _exposure_codec(codec)
+
+    if codec['tile'] is None:
+        chunks = (1, *frame_shape)
+    else:
+        tile = [min(t, n) for t, n in zip(codec['tile'], frame_shape)]
+        chunks = (1, *tile, *frame_shape[len(tile):])
+
+    return dict(
+        chunks=chunks,
+        compression=codec['compression'],
+        compression_opts=codec['compression_level'],
+        shuffle=codec['shuffle'],
+        fletcher32=codec['fletcher32']
+    )
+
+
 def _create_files(
-    outdir, name, n_measurements, n_exposures, n_xpix, n_ypix, n_colors=3, config=None
+    outdir,
+    name,
+    n_measurements,
+    n_exposures,
+    frame_shape,
+    frame_dtype=np.uint8,
+    frame_attrs=None,
+    exposure_codec=None,
+    stream_chunk_rows=1024,
+    config=None,
+    swmr=False,
+    stats_dtype=None,
+    stats_attrs=None,
+    thumbnail_shape=None,
+    thumbnail_dtype=None,
+    selection_dtype=None,
+    pyramid_shapes=None,
+    pyramid_dtype=None
 ):
+    """
+    n_measurements, n_exposures: rough number of rows expected per file,
+        used to size chunks. every dataset starts empty & grows as it's
+        written to, so the files are only as large as the data in them
+    frame_shape: shape of a single frame, eg (n_xpix, n_ypix, n_colors) for rgb
+        frames or (n_xpix, n_bytes) for packed raw frames
+    frame_dtype: dtype of a single frame
+    frame_attrs: dict, stored as attributes of the `exposure` dataset (see
+        `measure.get_frame_attrs`)
+    stream_chunk_rows: chunk size of the `magnetic_field_stream` dataset
+    swmr: bool, make the files so they can be written in swmr mode (see
+        `Writer`)
+    stats_dtype: dtype of each frame's statistics (see
+        `reduction.FrameReducer`), or None to not store any
+    stats_attrs: dict, stored as attributes of the `stats` dataset
+    thumbnail_shape, thumbnail_dtype: shape & dtype of the thumbnail of a
+        frame, or None to not store any
+    selection_dtype: dtype of the record of whether each frame was kept (see
+        `selection.FrameSelector`), or None if they all are
+    pyramid_shapes, pyramid_dtype: {dataset name: shape} & dtype of the
+        binned frames stored next to each frame (see
+        `reduction.FramePyramid`), or None to not store any
+    """
+    libver = SWMR_LIBVER if swmr else None
+
     exposure_dataset_parameters = [
-        dict(name='timestamp', shape=(n_exposures,), dtype=np.float64),
+        dict(
+            name='timestamp',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_exposures, 1), 1024),),
+            dtype=np.float64
+        ),
+        # the frame schedule's tick for each exposure, & how late (in
+        # seconds) the exposure started relative to its slot
+        dict(
+            name='tick',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_exposures, 1), 1024),),
+            dtype=np.int64
+        ),
+        dict(
+            name='jitter',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_exposures, 1), 1024),),
+            dtype=np.float64
+        ),
         dict(
             name='exposure',
-            shape=(n_exposures, n_xpix, n_ypix, n_colors),
-            dtype=np.uint8,
-            chunks=(1, n_xpix, n_ypix, n_colors)
+            shape=(0, *frame_shape),
+            maxshape=(None, *frame_shape),
+            dtype=frame_dtype,
+            attrs=frame_attrs or {},
+            **_exposure_filter_parameters(exposure_codec, frame_shape)
         )
     ]
 
-    measurement_dataset_parameters = [
-        dict(name='timestamp', col_width=18),
-        dict(name='temperature', col_width=18),
-        dict(name='bx', col_width=18),
-        dict(name='by', col_width=18),
-        dict(name='bz', col_width=18),
-    ]
+    if stats_dtype is not None:
+        # a small record per frame, so frames can be picked out without
+        # reading them
+        exposure_dataset_parameters.append(dict(
+            name='stats',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_exposures, 1), 1024),),
+            dtype=stats_dtype,
+            attrs=stats_attrs or {}
+        ))
+
+    if thumbnail_shape is not None:
+        exposure_dataset_parameters.append(dict(
+            name='thumbnail',
+            shape=(0, *thumbnail_shape),
+            maxshape=(None, *thumbnail_shape),
+            chunks=(1, *thumbnail_shape),
+            dtype=thumbnail_dtype,
+            compression='gzip',
+            shuffle=True
+        ))
+
+    # a chunk per frame, so a binned frame can be read on its own
+    for key, shape in (pyramid_shapes or {}).items():
+        exposure_dataset_parameters.append(dict(
+            name=key,
+            shape=(0, *shape),
+            maxshape=(None, *shape),
+            chunks=(1, *shape),
+            dtype=pyramid_dtype,
+            compression='gzip',
+            shuffle=True
+        ))
+
+    if selection_dtype is not None:
+        exposure_dataset_parameters.append(dict(
+            name='selection',
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(min(max(n_exposures, 1), 1024),),
+            dtype=selection_dtype
+        ))
+
+    # record the codec actually used, defaults included
+    if config is not None:
+        if not isinstance(config, dict):
+            config = json.loads(config)
+        config = {
+            **config,
+            'exposure_compression': _exposure_codec(exposure_codec)
+        }
+
+    measurement_dataset_parameters = _measurement_dataset_parameters(
+        n_measurements, stream_chunk_rows
+    )
 
     exposure_file_path = _create_file(
         f'{outdir}/{name}-exposures.hdf5',
         exposure_dataset_parameters,
-        config=config
+        config=config,
+        libver=libver
     )
 
     log.info(f'made exposure file at {exposure_file_path}')
 
     measurement_file_path = _create_file(
-        f'{outdir}/{name}-measurements.txt',
-        measurement_dataset_parameters
+        f'{outdir}/{name}-measurements.hdf5',
+        measurement_dataset_parameters,
+        config=config,
+        libver=libver
     )
 
     log.info(f'made measurement file at {measurement_file_path}')
@@ -90,14 +310,187 @@ def _create_files(
     return exposure_file_path, measurement_file_path
 
 
+def pack_12bit(arr, out=None):
+    """ pack a (..., n) uint16 array of 12-bit values into a (..., 3n/2) uint8
+    array, two pixels to every three bytes. n must be even
+
+    out: optional contiguous (..., 3n/2) uint8 array to pack into
+    """
+    a = arr[..., 0::2]
+    b = arr[..., 1::2]
+
+    if out is None:
+        packed = np.empty((*a.shape, 3), dtype=np.uint8)
+    else:
+        packed = out.reshape(*a.shape, 3)
+    packed[..., 0] = a & 0xFF
+    packed[..., 1] = (a >> 8) | ((b & 0xF) << 4)
+    packed[..., 2] = b >> 4
+
+    if out is not None:
+        return out
+    return packed.reshape(*arr.shape[:-1], -1)
+
+
+def unpack_12bit(packed):
+    """ inverse of `pack_12bit` """
+    packed = packed.reshape(
+        *packed.shape[:-1], packed.shape[-1] // 3, 3
+    ).astype(np.uint16)
+
+    arr = np.empty((*packed.shape[:-2], packed.shape[-2] * 2), dtype=np.uint16)
+    arr[..., 0::2] = packed[..., 0] | ((packed[..., 1] & 0xF) << 8)
+    arr[..., 1::2] = (packed[..., 1] >> 4) | (packed[..., 2] << 4)
+
+    return arr
+
+
+def _to_records(rows):
+    """ (n, 5) or (5,) array of measurements -> `MEASUREMENT_DTYPE` records """
+    rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+    return unstructured_to_structured(rows, dtype=MEASUREMENT_DTYPE)
+
+
+def _write_rows(dataset, indices, rows):
+    """ write `rows` at `indices` of a resizable dataset, growing it if
+    needed. contiguous runs of indices are written in one go
+    """
+    indices = np.asarray(indices)
+    order = np.argsort(indices, kind='stable')
+    indices = indices[order]
+    rows = rows[order]
+
+    if indices[-1] >= dataset.shape[0]:
+        dataset.resize(indices[-1] + 1, axis=0)
+
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    for run_indices, run_rows in zip(
+        np.split(indices, breaks), np.split(rows, breaks)
+    ):
+        dataset[run_indices[0]:run_indices[-1] + 1] = run_rows
+
+
+def _grow(dataset, index, grow_by=1):
+    """ make sure row `index` exists in `dataset`, growing it (if it's
+    resizable) in steps of its chunk size, or `grow_by` rows if that's larger
+    """
+    if index < dataset.shape[0] or dataset.maxshape[0] is not None:
+        return
+
+    step = max(dataset.chunks[0], grow_by)
+    dataset.resize(step * (index // step + 1), axis=0)
+
+
+def level_key(level):
+    """ name of the dataset of an exposure file with its frames binned
+    `level` x `level` (see `reduction.FramePyramid`); full resolution frames
+    (level 1) are in `exposure`
+    """
+    return 'exposure' if level == 1 else f'binned{level}'
+
+
+def stored_levels(f):
+    """ the resolution levels the frames of the exposure file `f` are
+    stored at, eg [1, 2, 4]
+    """
+    return [1] + sorted(
+        int(key[len('binned'):]) for key in f if key.startswith('binned')
+    )
+
+
+def _level_dataset(f, level):
+    """ the dataset with the frames of the exposure file `f` at `level` """
+    if level_key(level) not in f:
+        raise ValueError(
+            f'{f.filename} has no frames at level {level}; it has '
+            f'{stored_levels(f)}'
+        )
+    return f[level_key(level)]
+
+
+def _n_valid(f):
+    """ number of rows written to the exposure file `f`; rows past this are
+    just the padding from growing the datasets
+    """
+    return int(f.attrs.get('n_valid', 0))
+
+
+def _trim(datasets, n_valid):
+    """ resize the resizable `datasets` to `n_valid` rows. most are shrunk;
+    `exposure` & the binned frames can be short, if the last frames weren't
+    kept, in which case they're grown without storing anything
+    """
+    for dataset in datasets:
+        if dataset.maxshape[0] is None and dataset.shape[0] != n_valid:
+            dataset.resize(n_valid, axis=0)
+
+
+def _frame_mask(f, timestamp):
+    """ which of the rows with `timestamp`s of the exposure file `f` have a
+    frame stored: ones that were written, and weren't left out by
+    `selection.FrameSelector`
+    """
+    mask = timestamp > 0
+    if 'selection' in f:
+        kept = f['selection'].fields('kept')[:len(timestamp)]
+        mask[len(kept):] = False
+        mask[:len(kept)] &= kept
+    return mask
+
+
+def _set_start_timestamp(f, datum):
+    """ record the timestamp of the first exposure in an exposure file, so a
+    night's files can be put in order without reading their data
+    """
+    if 'start_timestamp' not in f.attrs and datum.get('timestamp', 0) > 0:
+        f.attrs['start_timestamp'] = datum['timestamp']
+
+
+class EncodedFrame:
+    """ a frame that's already been compressed into the chunks of the
+    `exposure` dataset (see `offload.FrameEncoder`), so it can be stored
+    as-is rather than going through hdf5's filters again
+
+    chunks: list of (offset, data), where `offset` is the chunk's position
+        within the frame & `data` its filtered bytes
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    @property
+    def nbytes(self):
+        return sum(len(data) for _, data in self.chunks)
+
+    def write(self, dataset, index):
+        for offset, data in self.chunks:
+            dataset.id.write_direct_chunk((index, *offset), data)
+
+
+def _write_value(dataset, index, value):
+    if isinstance(value, EncodedFrame):
+        value.write(dataset, index)
+    else:
+        dataset[index] = value
+
+
 def insert_datum(path, datum, index):
+    """ datum: a dict of {dataset name: value} for exposure files, or a row of
+        (timestamp, temperature, bx, by, bz) for measurement files
+    """
     _, ext = os.path.splitext(path)
 
     if ext == '.hdf5':
         log.info(f'start to insert at {path}')
         with h5py.File(path, 'r+') as f:
-            for key, value in datum.items():
-                f[key][index] = value
+            if isinstance(datum, dict):
+                for key, value in datum.items():
+                    _grow(f[key], index)
+                    _write_value(f[key], index, value)
+                f.attrs['n_valid'] = max(_n_valid(f), index + 1)
+                _set_start_timestamp(f, datum)
+            else:
+                _write_rows(f['measurements'], [index], _to_records(datum))
         log.info(f'done inserting at {path}')
     elif ext == '.txt':
         if len(datum.shape) == 1:
@@ -109,66 +502,773 @@ def insert_datum(path, datum, index):
             f'file at {path} must have either hdf5 or txt extension'
         )
 
-def read_file(path, subset, ftype='hdf5'):
+
+def _append(dataset, rows):
+    n = dataset.shape[0]
+    dataset.resize(n + len(rows), axis=0)
+    dataset[n:] = rows
+
+
+def append_datum(path, key, rows):
+    """ append `rows` to the end of the resizable dataset `key` """
+    with h5py.File(path, 'r+') as f:
+        _append(f[key], rows)
+
+
+class Writer:
+    """ keeps the current hour's files open between inserts, so we don't
+    reopen (and reparse) the hdf5 file & throw away its chunk cache for every
+    exposure.
+
+    files are registered by role (eg 'exposure', 'measurement') with `open`.
+    opening a new file for a role retires the old one: it stays open for any
+    writes still on their way to it, and is queued to be closed on the first
+    write to its replacement. `close_retired` closes the queued files, &
+    `close` everything. writes to a path that isn't open at all fall back to
+    `insert_datum`.
+
+    files can be opened ahead of time with `prepare`, so that the `open`
+    swapping them in doesn't touch the disk. neither `open` nor the writes
+    close files, so none of the closing (or `on_close`) happens on the
+    thread that calls them.
+
+    measurement rows are small, so rather than writing each one as it comes
+    in, they're buffered & written in batches.
+
+    flush_every: int, flush after this many writes to a file (0 to disable)
+    flush_interval: float, flush a file if it's been this many seconds since
+        its last flush (0 to disable)
+    batch_size: int, write buffered measurement rows once there are this many
+    batch_interval: float, write buffered measurement rows once the oldest
+        is this many seconds old (0 to disable)
+    grow_by: int, minimum number of rows to grow exposure datasets by when
+        they fill up. the number of rows actually written is kept in the
+        file's `n_valid` attribute, and the datasets are trimmed to it on close
+    on_close: optional function called like `on_close(role, path)` after a
+        file has been closed
+    swmr: bool, write hdf5 files in single-writer/multiple-reader mode, so
+        they can be read (see `Tail`) while they're being written, & a power
+        cut leaves them recoverable (see `recover.py`). the files must have
+        been made with `_create_files(..., swmr=True)`. attributes can't be
+        written in swmr mode, so these files don't get `n_valid` or
+        `start_timestamp`; their datasets are still trimmed on close
+    """
+
+    def __init__(
+        self,
+        flush_every=1,
+        flush_interval=0,
+        batch_size=1,
+        batch_interval=0,
+        grow_by=16,
+        on_close=None,
+        swmr=False
+    ):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.grow_by = grow_by
+        self.on_close = on_close
+        self.swmr = swmr
+
+        self._files = {}
+        self._retiring = {}
+        # retired files no more writes are expected for, waiting to be closed
+        self._closing = []
+        self._prepared = {}
+        self._lock = threading.Lock()
+
+    def _open_file(self, role, path):
+        _, ext = os.path.splitext(path)
+
+        if ext == '.hdf5':
+            if self.swmr:
+                handle = h5py.File(
+                    path, 'r+', libver=SWMR_LIBVER, rdcc_nbytes=1024**2*10
+                )
+                handle.swmr_mode = True
+            else:
+                handle = h5py.File(path, 'r+', rdcc_nbytes=1024**2*10)
+            datasets = {key: handle[key] for key in handle.keys()}
+            n_valid = _n_valid(handle)
+        elif ext == '.txt':
+            handle = open(path, 'a')
+            datasets = None
+            n_valid = None
+        else:
+            raise ValueError(
+                f'file at {path} must have either hdf5 or txt extension'
+            )
+
+        log.debug(f'opened {path}')
+
+        return dict(
+            role=role,
+            path=path,
+            handle=handle,
+            datasets=datasets,
+            lock=threading.Lock(),
+            closed=False,
+            pending=[],
+            pending_since=None,
+            n_valid=n_valid,
+            grown=set(),
+            n_unflushed=0,
+            last_flush=time.monotonic()
+        )
+
+    def _close_file(self, entry):
+        # wait for any in-flight write to this file to finish
+        with entry['lock']:
+            self._write_pending(entry)
+            if entry['grown']:
+                # attributes can't be written in swmr mode, but once the
+                # datasets are trimmed, readers don't need `n_valid`
+                if not self._swmr_mode(entry):
+                    self._write_n_valid(entry)
+                _trim(entry['datasets'].values(), entry['n_valid'])
+            entry['handle'].close()
+            entry['closed'] = True
+        log.info(f'closed {entry["path"]}')
+
+        if self.on_close is not None:
+            self.on_close(entry['role'], entry['path'])
+
+    def _swmr_mode(self, entry):
+        return entry['datasets'] is not None and entry['handle'].swmr_mode
+
+    def _write_pending(self, entry):
+        """ write any buffered measurement rows """
+        if not entry['pending']:
+            return
+
+        indices, rows = zip(*entry['pending'])
+        _write_rows(
+            entry['datasets']['measurements'],
+            indices,
+            _to_records(np.stack(rows))
+        )
+        log.debug(f'wrote {len(indices)} measurements to {entry["path"]}')
+
+        entry['pending'] = []
+        entry['pending_since'] = None
+
+    def _buffer_row(self, entry, row, index):
+        """ buffer a measurement row, writing the batch if it's due """
+        if entry['pending_since'] is None:
+            entry['pending_since'] = time.monotonic()
+        entry['pending'].append((index, row))
+
+        if len(entry['pending']) >= self.batch_size or (
+            self.batch_interval
+            and time.monotonic() - entry['pending_since'] >= self.batch_interval
+        ):
+            self._write_pending(entry)
+            self._count_write(entry)
+
+    def _write_n_valid(self, entry):
+        if entry['n_valid'] != _n_valid(entry['handle']):
+            entry['handle'].attrs['n_valid'] = entry['n_valid']
+
+    def _flush_file(self, entry):
+        if entry['grown'] and not self._swmr_mode(entry):
+            self._write_n_valid(entry)
+        entry['handle'].flush()
+        entry['n_unflushed'] = 0
+        entry['last_flush'] = time.monotonic()
+
+    def _count_write(self, entry):
+        """ flush `entry` if the flush policy says it's time """
+        entry['n_unflushed'] += 1
+        if (
+            self.flush_every
+            and entry['n_unflushed'] >= self.flush_every
+        ) or (
+            self.flush_interval
+            and time.monotonic() - entry['last_flush'] >= self.flush_interval
+        ):
+            self._flush_file(entry)
+
+    def _find(self, path):
+        """ the open file at `path`. a write to a file means none are
+        coming for the one it replaced (see `open`), so that's queued to be
+        closed. call with `_lock` held
+        """
+        for entry in self._files.values():
+            if entry['path'] == path:
+                retired = self._retiring.pop(entry['role'], None)
+                if retired is not None:
+                    self._closing.append(retired)
+                return entry
+        for entry in [*self._retiring.values(), *self._closing]:
+            if entry['path'] == path:
+                return entry
+        return None
+
+    def prepare(self, **paths):
+        """ open files ahead of time, eg `prepare(exposure=path1)`, without
+        writing to them yet; a later `open` of the same paths then only has
+        to swap them in
+        """
+        for role, path in paths.items():
+            entry = self._open_file(role, path)
+            with self._lock:
+                self._prepared[path] = entry
+
+    def discard(self, *paths):
+        """ close & delete prepared files that won't be used after all """
+        for path in paths:
+            with self._lock:
+                entry = self._prepared.pop(path, None)
+            if entry is None:
+                continue
+
+            entry['handle'].close()
+            os.remove(path)
+            log.info(f'discarded unused file {path}')
+
+    def open(self, **paths):
+        """ open files for writing, eg `open(exposure=path1, measurement=path2)`
+        any file already open for the same role is retired. files that were
+        `prepare`d are swapped in without any disk i/o. a file from two
+        `open`s ago that's still open is queued for `close_retired`
+        """
+        for role, path in paths.items():
+            with self._lock:
+                current = self._files.get(role)
+                if current is not None and current['path'] == path:
+                    continue
+                retired = self._retiring.pop(role, None)
+                if retired is not None:
+                    self._closing.append(retired)
+                entry = self._prepared.pop(path, None)
+
+            if entry is None:
+                entry = self._open_file(role, path)
+            else:
+                entry['role'] = role
+
+            with self._lock:
+                if current is not None:
+                    self._retiring[role] = current
+                self._files[role] = entry
+
+    def insert(self, path, datum, index):
+        with self._lock:
+            entry = self._find(path)
+
+        with entry['lock'] if entry is not None else nullcontext():
+            if entry is None or entry['closed']:
+                log.warning(f'{path} is not open; inserting without writer')
+                insert_datum(path, datum, index)
+                return
+
+            if entry['datasets'] is None:
+                if len(datum.shape) == 1:
+                    datum = datum[None, :]
+                np.savetxt(entry['handle'], datum)
+            elif not isinstance(datum, dict):
+                self._buffer_row(entry, datum, index)
+                return
+            else:
+                log.debug(f'start to insert at {path}')
+                # the timestamp goes in last, so a row a reader (or
+                # `recover.py`) sees a timestamp for has been written in full
+                for key in sorted(datum, key=lambda key: key == 'timestamp'):
+                    dataset = entry['datasets'][key]
+                    _grow(dataset, index, self.grow_by)
+                    _write_value(dataset, index, datum[key])
+                    entry['grown'].add(key)
+                entry['n_valid'] = max(entry['n_valid'], index + 1)
+                if not self._swmr_mode(entry):
+                    _set_start_timestamp(entry['handle'], datum)
+                log.debug(f'done inserting at {path}')
+
+            self._count_write(entry)
+
+    def append(self, path, key, rows):
+        """ append `rows` to the end of the resizable dataset `key` """
+        with self._lock:
+            entry = self._find(path)
+
+        with entry['lock'] if entry is not None else nullcontext():
+            if entry is None or entry['closed']:
+                log.warning(f'{path} is not open; appending without writer')
+                append_datum(path, key, rows)
+                return
+
+            _append(entry['datasets'][key], rows)
+            self._count_write(entry)
+
+    @property
+    def has_retired(self):
+        """ whether there are retired files waiting for `close_retired` """
+        return bool(self._closing)
+
+    def close_retired(self):
+        """ close the retired files that no more writes are expected for.
+        this is where their `on_close` runs, so it can take a while
+        """
+        with self._lock:
+            entries, self._closing = self._closing, []
+
+        for entry in entries:
+            try:
+                self._close_file(entry)
+            except Exception as e:
+                log.error(f'failed to close {entry["path"]}: {e}')
+
+    def flush(self):
+        with self._lock:
+            for entry in [
+                *self._files.values(),
+                *self._retiring.values(),
+                *self._closing
+            ]:
+                with entry['lock']:
+                    self._write_pending(entry)
+                    self._flush_file(entry)
+
+    def close(self):
+        with self._lock:
+            entries = [
+                *self._closing,
+                *self._retiring.values(),
+                *self._files.values()
+            ]
+            self._closing = []
+            self._retiring = {}
+            self._files = {}
+            prepared = list(self._prepared)
+
+        for entry in entries:
+            self._close_file(entry)
+
+        self.discard(*prepared)
+
+
+def convert_measurements_txt(path):
+    """ convert a measurement file from the old numpy txt format into the
+    hdf5 format, next to it. returns the path of the new file
+    """
+    rows = np.loadtxt(path, ndmin=2)
+    # the first row is a placeholder of zeros written with the header
+    rows = rows[rows[:, 0] > 0]
+
+    hdf5_path = _create_file(
+        f'{os.path.splitext(path)[0]}.hdf5',
+        _measurement_dataset_parameters(len(rows))
+    )
+
+    if len(rows):
+        with h5py.File(hdf5_path, 'r+') as f:
+            _write_rows(f['measurements'], np.arange(len(rows)), _to_records(rows))
+
+    log.info(f'converted {path} to {hdf5_path}')
+
+    return hdf5_path
+
+
+def _measurement_subset(records, subset):
+    if subset == 'temperature':
+        return records['temperature']
+    return np.stack((records['bx'], records['by'], records['bz']), axis=-1)
+
+
+# the subsets of exposure files with a row per frame
+FRAME_SUBSETS = ['exposure', 'jitter', 'stats', 'thumbnail', 'selection']
+
+
+def read_file(path, subset, ftype=None, level=1):
     """ read data from a measurement/exposure file. not intended to be performant, just for plotting/inspection
 
-    path: path to the .hdf5 file with the data
-    subset: either 'exposure', 'temperature' or 'magnetic_field'
+    path: path to the .hdf5 (or old-style .txt measurement) file with the data
+    subset: either 'exposure', 'jitter', 'stats', 'thumbnail', 'selection',
+        'temperature', 'magnetic_field' or 'magnetic_field_stream'. only
+        frames that were kept are returned for 'exposure' (see
+        `selection.FrameSelector`); the other per-frame subsets have a row
+        for every frame
+    ftype: 'hdf5' or 'txt'; by default, taken from the extension of `path`
+    level: int, for 'exposure', read the frames binned `level` x `level`
+        (see `stored_levels`) rather than at full resolution. binned frames
+        are laid out like `reduction.channel_image`
     """
 
-    valid_subsets = ['exposure', 'temperature', 'magnetic_field']
+    valid_subsets = [
+        *FRAME_SUBSETS,
+        'temperature',
+        'magnetic_field',
+        'magnetic_field_stream'
+    ]
     if subset not in valid_subsets:
         raise ValueError(f'subset must be one of {valid_subsets}')
 
+    if ftype is None:
+        ftype = os.path.splitext(path)[1][1:]
+
     if ftype == 'hdf5':
         if path[-4:] != 'hdf5':
             raise ValueError(f'unrecognized extension on {path}; must be .hdf5')
 
         with h5py.File(path, 'r') as f:
-            timestamp = f['timestamp'][:]
-            mask = timestamp > 0
+            if subset in FRAME_SUBSETS:
+                if 'n_valid' in f.attrs:
+                    timestamp = f['timestamp'][:_n_valid(f)]
+                else:
+                    # older files were preallocated to a fixed size
+                    timestamp = f['timestamp'][:]
+
+                # rows for dropped exposures were never written, & frames
+                # that weren't kept were never stored
+                if subset == 'exposure':
+                    rows = np.flatnonzero(_frame_mask(f, timestamp))
+                else:
+                    rows = np.flatnonzero(timestamp > 0)
+                timestamp = timestamp[rows]
+                if subset == 'exposure':
+                    # only the kept frames are read
+                    data = _read_rows(_level_dataset(f, level), rows)
+                else:
+                    n_rows = rows[-1] + 1 if len(rows) else 0
+                    data = f[subset][:n_rows][rows]
+            elif subset == 'magnetic_field_stream':
+                rows = f[subset][:]
+                timestamp = rows[:, 0]
+                data = rows[:, 1:]
+            else:
+                records = f['measurements'][:]
+                records = records[records['timestamp'] > 0]
 
-            timestamp = timestamp[mask]
-            data = f[subset][mask]
+                timestamp = records['timestamp']
+                data = _measurement_subset(records, subset)
     
         log.info(f'read in {path}')
 
     elif ftype == 'txt':
-        raise NotImplementedError('havent implemented numpy txt read yet')
+        if subset not in ['temperature', 'magnetic_field']:
+            raise ValueError(f'{path} only has temperature & magnetic_field')
+
+        records = _to_records(np.loadtxt(path, ndmin=2))
+        records = records[records['timestamp'] > 0]
+
+        timestamp = records['timestamp']
+        data = _measurement_subset(records, subset)
+
+        log.info(f'read in {path}')
     else:
         raise ValueError('invalid file type for reading')
 
     return timestamp, data
 
 
+def _start_timestamp(path):
+    """ timestamp of the first exposure/measurement in an hourly file, without
+    reading any frames. None if the file has no data
+    """
+    with h5py.File(path, 'r') as f:
+        if 'start_timestamp' in f.attrs:
+            return float(f.attrs['start_timestamp'])
+
+        if 'measurements' in f:
+            timestamp = f['measurements'].fields('timestamp')[:]
+        else:
+            timestamp = f['timestamp'][:]
+
+    timestamp = timestamp[timestamp > 0]
+    return float(timestamp.min()) if len(timestamp) else None
+
+
+def night_files(outdir, name='exposures'):
+    """ the hourly hdf5 files in `outdir`, ordered by the timestamp of their
+    first exposure/measurement. files without any data are left out
+
+    name: either 'exposures' or 'measurements'
+    """
+    return [path for _, path in _night_files(outdir, name)]
+
+
+def _night_files(outdir, name):
+    """ sorted (start timestamp, path) pairs; see `night_files` """
+    files = []
+    for file in os.listdir(outdir):
+        if file[-4:] != 'hdf5' or name not in file:
+            continue
+
+        path = f'{outdir}/{file}'
+        start = _start_timestamp(path)
+        if start is not None:
+            files.append((start, path))
+
+    return sorted(files)
+
+
+def _read_rows(dataset, rows):
+    """ read the (sorted) `rows` of an exposure dataset; as one strided slice
+    if they're evenly spaced, otherwise frame by frame
+    """
+    steps = np.diff(rows)
+    if len(rows) == 0:
+        data = dataset[:0]
+    elif len(rows) == 1 or (steps == steps[0]).all():
+        step = int(steps[0]) if len(rows) > 1 else 1
+        data = dataset[rows[0]:rows[-1] + 1:step]
+    else:
+        data = np.empty((len(rows), *dataset.shape[1:]), dtype=dataset.dtype)
+        for i, row in enumerate(rows):
+            dataset.read_direct(data, np.s_[row], np.s_[i])
+
+    if dataset.attrs.get('packing') == 'packed12':
+        data = unpack_12bit(data)
+
+    return data
+
+
+class NightReader:
+    """ streams the exposures of a night lazily, in time order, reading a few
+    frames at a time, so memory use doesn't grow with the length of the night
+
+        reader = NightReader('/media/usb_drive/2025-01-01')
+        for timestamp, frame in reader.frames(start, stop, stride=10):
+            ...
+
+    outdir: directory (probably named like YYYY-MM-DD) with the night's files
+    chunk_size: int, number of frames read from disk at a time
+    level: int, read the frames binned `level` x `level` rather than at full
+        resolution; see `read_file`
+    """
+
+    def __init__(self, outdir, chunk_size=16, level=1):
+        self.outdir = outdir
+        self.chunk_size = chunk_size
+        self.level = level
+
+        files = _night_files(outdir, 'exposures')
+        self.starts = [start for start, _ in files]
+        self.files = [path for _, path in files]
+
+    def __iter__(self):
+        return self.frames()
+
+    def _rows(self, f, start, stop):
+        """ indices of the rows of an exposure file with frames in
+        [start, stop)
+        """
+        if 'n_valid' in f.attrs:
+            timestamp = f['timestamp'][:_n_valid(f)]
+        else:
+            timestamp = f['timestamp'][:]
+
+        mask = _frame_mask(f, timestamp)
+        if start is not None:
+            mask &= timestamp >= start
+        if stop is not None:
+            mask &= timestamp < stop
+
+        rows = np.flatnonzero(mask)
+        return rows, timestamp[rows]
+
+    def chunks(self, start=None, stop=None, stride=1):
+        """ yield (timestamps, frames) arrays of up to `chunk_size` frames
+
+        start, stop: optional unix timestamps; only frames taken in
+            [start, stop) are returned
+        stride: int, only return every `stride`th frame of the night
+        """
+        starts = self.starts
+        n_seen = 0
+
+        for i, path in enumerate(self.files):
+            # files are in order, so each one ends where the next starts
+            if stop is not None and starts[i] >= stop:
+                break
+            if (
+                start is not None
+                and i + 1 < len(self.files)
+                and starts[i + 1] <= start
+            ):
+                continue
+
+            with h5py.File(path, 'r') as f:
+                rows, timestamp = self._rows(f, start, stop)
+
+                # keep the stride going across files
+                offset = (-n_seen) % stride
+                n_seen += len(rows)
+                rows = rows[offset::stride]
+                timestamp = timestamp[offset::stride]
+
+                dataset = _level_dataset(f, self.level)
+                for j in range(0, len(rows), self.chunk_size):
+                    chunk = slice(j, j + self.chunk_size)
+                    yield timestamp[chunk], _read_rows(dataset, rows[chunk])
+
+    def frames(self, start=None, stop=None, stride=1):
+        """ yield (timestamp, frame) for each frame; see `chunks` """
+        for timestamps, frames in self.chunks(start, stop, stride):
+            yield from zip(timestamps, frames)
+
+    def windows(self, window, start=None, stop=None, stride=1):
+        """ yield (timestamps, frames) arrays of all the frames in consecutive
+        `window` second long time windows (empty windows are skipped)
+        """
+        timestamps, frames = [], []
+        window_end = None
+
+        for timestamp, frame in self.frames(start, stop, stride):
+            if window_end is None:
+                window_end = (start if start is not None else timestamp) + window
+
+            if timestamp >= window_end:
+                if timestamps:
+                    yield np.array(timestamps), np.stack(frames)
+                timestamps, frames = [], []
+                window_end += window * ((timestamp - window_end) // window + 1)
+
+            timestamps.append(timestamp)
+            frames.append(frame)
+
+        if timestamps:
+            yield np.array(timestamps), np.stack(frames)
+
+
+class Tail:
+    """ follows an hourly file while `Writer(swmr=True)` is writing it, for a
+    quicklook during the night without stopping capture:
+
+        with Tail('/media/usb_drive/2025-01-01/3-exposures.hdf5') as tail:
+            for timestamp, frame in tail.follow(poll_interval=5, timeout=60):
+                ...
+
+    polling only re-reads the shape of the file's timestamps & any new ones,
+    so it's cheap to do often; frames are only read when asked for. rows
+    without a timestamp (not yet written, or dropped) or without a frame
+    (see `selection.FrameSelector`) are never returned.
+
+    path: an exposure or measurement file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = h5py.File(path, 'r', swmr=True)
+        self.next_row = 0
+
+        if 'exposure' in self.file:
+            self.key = 'exposure'
+            self._timestamp = self.file['timestamp']
+        else:
+            self.key = 'measurements'
+            self._timestamp = self.file['measurements']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def poll(self):
+        """ the rows that have been written since the last poll, & their
+        timestamps
+        """
+        self._timestamp.refresh()
+        n_rows = self._timestamp.shape[0]
+        if n_rows <= self.next_row:
+            return np.zeros((0,), dtype=int), np.zeros((0,))
+
+        if self.key == 'exposure':
+            timestamp = self._timestamp[self.next_row:n_rows]
+        else:
+            timestamp = self._timestamp.fields('timestamp')[self.next_row:n_rows]
+
+        start = self.next_row
+        written = timestamp > 0
+        if written.any():
+            # a gap before the last written row is a dropped exposure, not
+            # one still being written
+            self.next_row = start + int(np.flatnonzero(written)[-1]) + 1
+
+        if self.key == 'exposure' and 'selection' in self.file:
+            # only the frames that were kept have anything to read
+            selection = self.file['selection']
+            selection.refresh()
+            kept = np.zeros(len(written), dtype=bool)
+            stored = selection.fields('kept')[start:n_rows]
+            kept[:len(stored)] = stored
+            written &= kept
+
+        rows = np.flatnonzero(written)
+        return start + rows, timestamp[rows]
+
+    def read(self, rows, key=None, level=1):
+        """ read `rows` (eg from `poll`) of dataset `key`; the frames of an
+        exposure file or the measurement records by default
+
+        level: int, read the frames of an exposure file binned `level` x
+            `level`; see `read_file`
+        """
+        if key is None and self.key == 'exposure':
+            dataset = _level_dataset(self.file, level)
+        else:
+            dataset = self.file[key or self.key]
+        dataset.refresh()
+        return _read_rows(dataset, rows)
+
+    def follow(self, poll_interval=1, timeout=None, clock=None, level=1):
+        """ yield (timestamp, frame) (or (timestamp, record) for a
+        measurement file) as they're written, polling every `poll_interval`
+        seconds. stops once nothing new has turned up for `timeout` seconds,
+        eg because the file's hour is over; by default, never. frames are
+        read at `level` (see `read`)
+        """
+        clock = clock or real_clock
+        last_new = clock.monotonic()
+
+        while True:
+            rows, timestamp = self.poll()
+            if len(rows):
+                last_new = clock.monotonic()
+                yield from zip(timestamp, self.read(rows, level=level))
+            elif timeout is not None and clock.monotonic() - last_new > timeout:
+                return
+            else:
+                clock.sleep(poll_interval)
+
+    def close(self):
+        self.file.close()
+
+
 def read_files(outdir, name, subset=None):
     """ read all of the hourly-measurement files found in an outdir. not intended to be performant, just for plotting/inspection.
+    to stream through a night of exposures instead, use `NightReader`
 
     outdir: directory (probably named like YYYY-MM-DD) with all the data taken on that date
     name: either 'exposures' or 'measurements'
-    subset: either 'temperature' or 'magnetic_field' if name == 'measurements'
+    subset: either 'temperature', 'magnetic_field' or 'magnetic_field_stream'
+        if name == 'measurements'
     """
 
-    # TODO: make workable for numpy txt files
-
-    files = [
+    filenames = os.listdir(outdir)
+    files = night_files(outdir, name)
+    # old-style txt measurement files, unless they've been converted
+    files += [
         f'{outdir}/{file}'
-        for file in os.listdir(outdir)
-        if file[-4:] == 'hdf5' and name in file
+        for file in filenames
+        if file[-3:] == 'txt' and name in file
+        and f'{file[:-3]}hdf5' not in filenames
     ]
 
     subset = 'exposure' if name == 'exposures' else subset 
 
-    timestamp, data = read_file(files[0], subset)
-    for file in files[1:]:
-        _t, _d = read_file(file, subset)
-        timestamp = np.concatenate((timestamp, _t))
-        data = np.concatenate((data, _d))
+    timestamps, data = zip(*[read_file(file, subset) for file in files])
+    timestamp = np.concatenate(timestamps)
+    data = np.concatenate(data)
 
-    # sort by timestamp -- os.listdir doesn't guarantee it lists files temporally
-    sortidxs = np.argsort(timestamp)
-    timestamp = timestamp[sortidxs]
-    data = data[sortidxs]
+    # hdf5 files are already in order, but txt files might not be
+    if (np.diff(timestamp) < 0).any():
+        sortidxs = np.argsort(timestamp)
+        timestamp = timestamp[sortidxs]
+        data = data[sortidxs]
 
     return timestamp, data
 
@@ -193,15 +1293,11 @@ def plot_files(outdir, name, subset=None):
 
 
 def plot_exposures(outdir):
-    """ WARNING: this will make a plot for each exposure!
-    this is example code """
-    from datetime import datetime
-    import matplotlib.pyplot as plt
-
-    _, data = read_files(outdir, 'exposures')
-
-    for i, d in enumerate(data):
-        fig, ax = plt.subplots()
-        ax.imshow(d)
-        fig.savefig(f'{outdir}/exposure-{i}.png')
+    """ save each of a night's frames as a png, `outdir`/exposure-{i}.png, a
+    few frames at a time; see `products.make_timelapse`
+    """
+    from products import make_timelapse
 
+    make_timelapse(
+        outdir, outdir, timelapse_bin=1, png_name='exposure-{}.png'
+    )
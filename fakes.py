@@ -0,0 +1,240 @@
+""" stand-ins for the camera, magnetometer & thermometer, so `measure` & `main`
+can run on a machine without them (see `benchmark.py`). call `install` before
+importing `measure`:
+
+    import fakes
+    fakes.install(conversion_time=0.045)
+    fakes.make_w1_device('/tmp/w1')
+
+    import measure
+    measure.W1_DEVICES_DIR = '/tmp/w1/'
+"""
+import os
+import sys
+import types
+import threading
+
+import numpy as np
+
+from clock import real_clock
+
+SENSOR_RESOLUTION = (4056, 3040) # [pixels], the IMX477's
+
+# rows of raw frames are padded out to a multiple of this many bytes
+RAW_STRIDE_ALIGN = 64
+
+SECONDS_TO_MICROSECONDS = 1_000_000
+
+
+def _sky_frames(shape, dtype, level, noise, n_frames, seed=0):
+    """ a few frames of a faint, noisy sky with a vignetting gradient, to
+    cycle through; making a fresh one every exposure would cost more than
+    the rest of the pipeline
+    """
+    rng = np.random.default_rng(seed)
+
+    n_rows, n_cols = shape[:2]
+    y, x = np.ogrid[-1:1:n_rows * 1j, -1:1:n_cols * 1j]
+    vignette = 1 - 0.3 * (x**2 + y**2)
+    if len(shape) == 3:
+        vignette = vignette[..., None]
+
+    info = np.iinfo(dtype)
+    return [
+        np.clip(
+            level * vignette + rng.normal(0, noise, size=shape),
+            info.min,
+            info.max
+        ).astype(dtype)
+        for _ in range(n_frames)
+    ]
+
+
+class FakeCameraRequest:
+    def __init__(self, arrays):
+        self._arrays = arrays
+
+    def make_array(self, stream):
+        return self._arrays[stream]
+
+    def release(self):
+        pass
+
+
+class FakeMappedArray:
+    def __init__(self, request, stream):
+        self.array = request.make_array(stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakePicamera2:
+    """ enough of `picamera2.Picamera2` for `measure`. each capture takes the
+    configured ExposureTime & returns one of a few prerendered frames at the
+    full sensor resolution
+    """
+
+    n_frames = 4
+    clock = real_clock
+
+    def __init__(self):
+        self.sensor_resolution = SENSOR_RESOLUTION
+        self._config = None
+        self._frames = {}
+        self._n_captured = 0
+
+    def create_still_configuration(self, raw=None, display=None, **kwargs):
+        raw = raw or {}
+        return dict(
+            main=dict(format='BGR888', size=self.sensor_resolution),
+            raw=dict(
+                format=raw.get('format', 'SRGGB12'),
+                size=raw.get('size', self.sensor_resolution)
+            ),
+            controls={}
+        )
+
+    def configure(self, config):
+        self._config = config
+
+        width, height = config['main']['size']
+        self._frames['main'] = _sky_frames(
+            (height, width, 3), np.uint8, 20, 3, self.n_frames
+        )
+
+        width, height = config['raw']['size']
+        raw = _sky_frames((height, width), np.uint16, 256, 10, self.n_frames)
+        stride = -(-2 * width // RAW_STRIDE_ALIGN) * RAW_STRIDE_ALIGN
+        self._frames['raw'] = []
+        for frame in raw:
+            padded = np.zeros((height, stride), dtype=np.uint8)
+            padded[:, :2 * width] = frame.view(np.uint8)
+            self._frames['raw'].append(padded)
+
+    def camera_configuration(self):
+        return self._config
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _expose(self):
+        exposure_time = self._config['controls'].get('ExposureTime', 0)
+        self.clock.sleep(exposure_time / SECONDS_TO_MICROSECONDS)
+
+        i = self._n_captured % self.n_frames
+        self._n_captured += 1
+        return {stream: frames[i] for stream, frames in self._frames.items()}
+
+    def capture_array(self, stream='main'):
+        return self._expose()[stream].copy()
+
+    def capture_request(self):
+        return FakeCameraRequest(self._expose())
+
+
+class FakeRM3100:
+    """ enough of `rm3100.RM3100_I2C` for `measure`; readings are a slow
+    wobble around a typical field, & take `conversion_time` seconds each
+    """
+
+    conversion_time = 0.045 # [seconds], about that of cycle_count=400
+    counts_per_microtesla = 150
+    clock = real_clock
+
+    def __init__(self, i2c, i2c_address=0x20, cycle_count=400):
+        self.cycle_count = cycle_count
+
+        self._period = None
+        self._next_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def measurement_time(self):
+        # `measure` waits this long on the real clock
+        return self.conversion_time / getattr(self.clock, 'scale', 1)
+
+    def _reading(self):
+        t = self.clock.time()
+        field = np.array([20., 5., -45.]) + 0.5 * np.sin(t / 60 + np.arange(3))
+        return tuple(np.round(field * self.counts_per_microtesla).astype(int))
+
+    def start_single_reading(self):
+        self._next_time = self.clock.monotonic() + self.conversion_time
+
+    def start_continuous_reading(self, frequency=75):
+        self._period = max(1 / frequency, self.conversion_time)
+        self._next_time = self.clock.monotonic() + self._period
+
+    def stop(self):
+        self._period = None
+
+    def get_next_reading(self, poll_interval=0.001):
+        with self._lock:
+            delay = self._next_time - self.clock.monotonic()
+            if delay > 0:
+                self.clock.sleep(delay)
+            if self._period is not None:
+                self._next_time = max(
+                    self._next_time + self._period, self.clock.monotonic()
+                )
+            return self._reading()
+
+    def convert_to_microteslas(self, reading):
+        return tuple(np.array(reading) / self.counts_per_microtesla)
+
+
+def use_clock(clock):
+    """ take the time of exposures & readings on `clock`, eg the
+    `ScaledClock` of a simulated night
+    """
+    FakePicamera2.clock = clock
+    FakeRM3100.clock = clock
+
+
+def install(conversion_time=None):
+    """ put fake `picamera2`, `board` & `rm3100` modules in `sys.modules`, so
+    `measure` imports them instead of the real ones
+
+    conversion_time: seconds each fake magnetometer reading takes
+    """
+    if conversion_time is not None:
+        FakeRM3100.conversion_time = conversion_time
+
+    picamera2 = types.ModuleType('picamera2')
+    picamera2.Picamera2 = FakePicamera2
+    picamera2.MappedArray = FakeMappedArray
+
+    board = types.ModuleType('board')
+    board.I2C = lambda: None
+
+    rm3100 = types.ModuleType('rm3100')
+    rm3100.RM3100_I2C = FakeRM3100
+
+    sys.modules.update(picamera2=picamera2, board=board, rm3100=rm3100)
+
+
+def make_w1_device(base_dir, temperature=21.5):
+    """ make a fake DS18B20 under `base_dir`, laid out like
+    /sys/bus/w1/devices. returns the path of its w1_slave file
+    """
+    device_dir = f'{base_dir}/28-000000000000'
+    os.makedirs(device_dir, exist_ok=True)
+
+    device_file = f'{device_dir}/w1_slave'
+    with open(device_file, 'w') as f:
+        f.write(
+            '50 05 4b 46 7f ff 0c 10 1c : crc=1c YES\n'
+            f'50 05 4b 46 7f ff 0c 10 1c t={int(temperature * 1000)}\n'
+        )
+
+    return device_file
@@ -0,0 +1,93 @@
+import sys
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from logger import setup_logger
+log = setup_logger('frame-pool-logger', sys.stdout, 'frame-pool')
+
+
+class FramePool:
+    """ a small set of preallocated, contiguous frame buffers that are
+    captured into, handed to the writer, and returned once they've been
+    written. this avoids allocating (and h5py copying) a full frame every
+    exposure.
+
+    shape, dtype: shape & dtype of a single frame
+    size: int, number of buffers to preallocate
+    shared: bool, put the buffers in shared memory, so other processes can
+        read frames without them being pickled (see `offload.FrameEncoder`)
+    """
+
+    def __init__(self, shape, dtype, size=4, shared=False):
+        self.shape = shape
+        self.dtype = dtype
+        self.shared = shared
+
+        self._free = queue.Queue()
+        self._owned = set()
+        self._shm = {}
+
+        for _ in range(size):
+            self._add()
+
+    @property
+    def size(self):
+        return len(self._owned)
+
+    def _add(self):
+        if self.shared:
+            nbytes = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+            shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            buf = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+            self._shm[id(buf)] = shm
+        else:
+            buf = np.empty(self.shape, dtype=self.dtype)
+        self._owned.add(id(buf))
+        self._free.put(buf)
+
+    def acquire(self, timeout=1):
+        """ get a free buffer. if none are returned within `timeout` seconds
+        (eg one was lost to a capture timeout), grow the pool rather than
+        stall the capture
+        """
+        try:
+            return self._free.get(timeout=timeout)
+        except queue.Empty:
+            log.warning(
+                f'no free frame buffers after {timeout}s; '
+                f'growing pool to {self.size + 1}'
+            )
+            self._add()
+            return self._free.get_nowait()
+
+    def release(self, buf):
+        """ return a buffer to the pool; arrays the pool doesn't own (eg the
+        blank frames made on a failed capture) are ignored
+        """
+        if id(buf) in self._owned:
+            self._free.put(buf)
+
+    def shared_name(self, buf):
+        """ name of the shared memory block behind `buf`, or None if it isn't
+        one of this pool's shared buffers
+        """
+        shm = self._shm.get(id(buf))
+        return None if shm is None else shm.name
+
+    def close(self):
+        """ free the shared memory blocks; the pool can't be used after """
+        while not self._free.empty():
+            self._free.get_nowait()
+
+        for shm in self._shm.values():
+            try:
+                shm.close()
+            except BufferError:
+                # a frame from it is still referenced somewhere; it'll be
+                # unmapped when that's garbage collected
+                pass
+            shm.unlink()
+        self._shm = {}
+
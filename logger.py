@@ -1,5 +1,8 @@
 import queue
+import atexit
 import logging
+import threading
+from time import monotonic
 from logging.handlers import QueueHandler, QueueListener
 
 class LogFormatter(logging.Formatter):
@@ -12,33 +15,226 @@ formatter = LogFormatter(
     "[%(asctime)s] [%(top)s] [%(funcName)s] [%(levelname)s] %(message)s"
 )
 
-def setup_logger(name, log_out, top, level=logging.INFO):
-    extra=dict(top=top)
+LOG_QUEUE_SIZE = 10000 # [records]
+# how long a warning or error waits for room in a full queue that has no
+# lower level record to make way for it
+WARNING_TIMEOUT = 0.1 # [s]
 
-    if type(log_out) == str:
-        handler = logging.FileHandler(log_out)        
-    else:
-        handler = logging.StreamHandler(log_out)
+# every logger's records go through this queue, & are written out by a single
+# background thread, so logging never blocks on a slow stdout or sd card
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_listener = None
+_listener_lock = threading.Lock()
 
-    handler.setFormatter(formatter)
+# the handler that writes to each output, shared between loggers
+_handlers = {}
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
+_n_dropped = 0
+_n_reported = 0
+# records are dropped from the executor's threads as well as the event loop's
+_dropped_lock = threading.Lock()
 
-    logger = logging.LoggerAdapter(logger, extra)
 
-    return logger
+def _count_dropped():
+    global _n_dropped
+
+    with _dropped_lock:
+        _n_dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """ lets through at most `rate` INFO & DEBUG records a second from each
+    line that logs (in bursts of up to `burst`), so eg a message logged on
+    every write can't flood the log. the number held back is added to the next
+    record from that line that gets through. warnings & errors always get
+    through.
+
+    rate: float, records a second from each line, or None for no limit
+    burst: int
+    """
+
+    def __init__(self, rate=None, burst=10):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate or record.levelno > logging.INFO:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = monotonic()
+        with self._lock:
+            tokens, last, n_held = self._buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, n_held + 1)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+
+        if n_held:
+            record.msg = f'{record.msg} ({n_held} similar messages held back)'
+        return True
+
+rate_limit = RateLimitFilter()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """ puts records on the bounded queue for `target` to write, & counts them
+    instead of waiting when it's full. warnings & errors aren't dropped: they
+    take the place of the oldest queued INFO or DEBUG record, or if there
+    isn't one, wait up to `WARNING_TIMEOUT` for room. once logging's stopped,
+    writes records out itself
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.target = self.target
+        return record
+
+    def enqueue(self, record):
+        if _listener is None:
+            self.target.handle(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if record.levelno >= logging.WARNING:
+            if self._evict(record):
+                return
+            try:
+                self.queue.put(record, timeout=WARNING_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+        _count_dropped()
+
+    def _evict(self, record):
+        """ queue `record` in place of the oldest queued record below
+        WARNING, & count that one as dropped. returns False if there isn't one
+        """
+        with self.queue.mutex:
+            queued = self.queue.queue
+            for i, other in enumerate(queued):
+                # the listener's sentinel is None
+                if other is not None and other.levelno < logging.WARNING:
+                    del queued[i]
+                    queued.append(record)
+                    break
+            else:
+                return False
+
+        _count_dropped()
+        return True
+
 
-"""    log_queue = queue.Queue()
-    queue_handler = QueueHandler(log_queue)
+class _Listener(QueueListener):
+    """ writes each record with the handler it was queued for, & notes any
+    records dropped since the last one
+    """
 
-    root = logging.getLogger(name)
-    root.setLevel(level)
-    root.addHandler(queue_handler)
-    root = logging.LoggerAdapter(root, extra)
+    def handle(self, record):
+        global _n_reported
 
-    queue_listener = QueueListener(log_queue, handler)
-    queue_listener.start()
+        record.target.handle(record)
 
-    return root #logger"""
+        n_dropped = _n_dropped
+        if n_dropped > _n_reported:
+            record.target.handle(logging.makeLogRecord(dict(
+                name=record.name,
+                levelno=logging.WARNING,
+                levelname='WARNING',
+                funcName=record.funcName,
+                top=record.top,
+                msg=f'log queue full; dropped {n_dropped - _n_reported} '
+                    f'record(s) ({n_dropped} so far)'
+            )))
+            _n_reported = n_dropped
+
+    def enqueue_sentinel(self):
+        # the queue may be full; wait for room rather than lose the sentinel
+        self.queue.put(self._sentinel)
+
+
+def _output_handler(log_out):
+    handler = _handlers.get(log_out)
+    if handler is None:
+        if type(log_out) == str:
+            handler = logging.FileHandler(log_out)
+        else:
+            handler = logging.StreamHandler(log_out)
+        handler.setFormatter(formatter)
+        _handlers[log_out] = handler
+    return handler
+
+
+def start_logging():
+    """ start the background thread that writes out the logs """
+    global _listener
+
+    with _listener_lock:
+        if _listener is None:
+            _listener = _Listener(_log_queue)
+            _listener.start()
+
+
+def stop_logging():
+    """ write out whatever's queued & stop the background thread. anything
+    logged after this is written straight away, on the caller's thread
+    """
+    global _listener
+
+    with _listener_lock:
+        if _listener is not None:
+            listener, _listener = _listener, None
+            listener.stop()
+            for handler in _handlers.values():
+                handler.flush()
+
+atexit.register(stop_logging)
+
+
+def configure_logging(queue_size=None, rate=None, burst=None):
+    """ queue_size: int, records that can wait to be written before more are
+        dropped
+    rate, burst: see `RateLimitFilter`
+    """
+    if queue_size is not None:
+        _log_queue.maxsize = queue_size
+    if rate is not None:
+        rate_limit.rate = rate
+    if burst is not None:
+        rate_limit.burst = burst
+
+
+def n_dropped():
+    """ records dropped so far because the log queue was full """
+    return _n_dropped
+
+
+def setup_logger(name, log_out, top, level=logging.INFO):
+    extra=dict(top=top)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not any(isinstance(h, _DroppingQueueHandler) for h in logger.handlers):
+        handler = _DroppingQueueHandler(_log_queue, _output_handler(log_out))
+        handler.addFilter(rate_limit)
+        logger.addHandler(handler)
+
+    start_logging()
+
+    logger = logging.LoggerAdapter(logger, extra)
+
+    return logger
@@ -1,13 +1,24 @@
 import os
 import sys
 import asyncio
-from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep, monotonic
 from datetime import datetime, timezone, timedelta
 
 import numpy as np
 
 from data import _create_files
-from data import insert_datum
+from data import Writer
+from catalog import add_to_catalog
+from write_queue import WriteQueue
+from frame_pool import FramePool
+from offload import FrameEncoder
+from reduction import FramePyramid, FrameReducer
+from selection import FrameSelector, SELECTION_DTYPE, _selection_config
+from products import make_products, start_workers, _keogram_config
+from metrics import metrics, reset_peak_rss, peak_rss_mb
+from scheduling import Schedule, PeriodicSampler
+from clock import Clock
 import json
 import argparse
 
@@ -25,13 +36,16 @@ args = parser.parse_args()
 from measure import (
     prepare_camera,
     take_single_exposure,
+    get_frame_attrs,
     prepare_magnetometer,
     get_magnetometer_measurement,
+    MagnetometerStream,
     prepare_thermometer,
+    ThermometerReader,
     get_temperature
 )
 
-from logger import setup_logger
+from logger import setup_logger, configure_logging, stop_logging, n_dropped
 log = None
 
 camera_critical = False
@@ -46,35 +60,63 @@ SECONDS_TO_MICROSECONDS = 1_000_000
 with open(args.config, "rb") as file:
     config_dict = json.load(file)
 
-excess_minutes = 10  # buffer the hdf5 file size by some amount
 exposure_time = config_dict["exposure_duration"] # [seconds] 
 exposure_cadence = 1 / config_dict["exposure_interval"] # [exposures per second]
 exposure_timeout = 100 # [seconds]
-measurement_cadence = config_dict["measurement_cadence"] # [seconds; approx]
+thermometer_timeout = 1 # [seconds]
+magnetometer_cycle_count = config_dict.get("magnetometer_cycle_count", 400)
+magnetometer_stream_rate = config_dict.get("magnetometer_stream_rate", 0) # [Hz]
+magnetometer_decimate = config_dict.get("magnetometer_decimate", 1)
+magnetometer_drain_interval = config_dict.get("magnetometer_drain_interval", 1) # [seconds]
+thermometer_interval = config_dict.get("thermometer_interval", 5) # [seconds]
+thermometer_max_age = config_dict.get("thermometer_max_age", 30) # [seconds]
+measurement_cadence = config_dict["measurement_cadence"] # [seconds]
 camera_gain = config_dict["camera_gain"]
+capture_mode = config_dict.get("capture_mode", "rgb") # 'rgb' or 'raw'
+raw_bits = config_dict.get("raw_bits", 12) # 12 (packed) or 16
+flush_every = config_dict.get("flush_every", 1) # [writes]
+flush_interval = config_dict.get("flush_interval", 0) # [seconds]
+measurement_batch_size = config_dict.get("measurement_batch_size", 30) # [rows]
+measurement_batch_interval = config_dict.get("measurement_batch_interval", 60) # [seconds]
+write_queue_size = config_dict.get("write_queue_size", 4) # [exposures]
+write_queue_overflow = config_dict.get("write_queue_overflow", "block")
+exposure_codec = config_dict.get("exposure_compression", None)
+frame_overrun = config_dict.get("frame_overrun", "skip") # 'skip' or 'catch_up'
+metrics_interval = config_dict.get("metrics_interval", 60) # [seconds]
+frame_workers = config_dict.get("frame_workers", 4) # [processes]
+log_queue_size = config_dict.get("log_queue_size", 10000) # [records]
+log_rate_limit = config_dict.get("log_rate_limit", 0) # [records per second per line]
+swmr = config_dict.get("swmr", False)
+frame_stats = config_dict.get("frame_stats", False)
+frame_selection = config_dict.get("frame_selection", None)
+frame_pyramid_levels = config_dict.get("frame_pyramid", None)
+keogram = config_dict.get("keogram", None)
 
 frames_per_night = (config_dict["observation_interval"]*3600)/config_dict["exposure_interval"] # osb interval is units of hrs
 
-sleep_buffer = 1.0 
+# rows expected per hourly file; only used to size chunks, as the datasets
+# grow as they're written to
+n_exposures = int(exposure_cadence / SECONDS_TO_HOURS)
+n_measurements = int(1 / (measurement_cadence * SECONDS_TO_HOURS))
 
-n_exposures = int(
-    exposure_cadence / SECONDS_TO_HOURS
-    + excess_minutes * exposure_cadence / SECONDS_TO_MINUTES
-)
-n_measurements = int(
-    measurement_cadence / SECONDS_TO_HOURS
-    + excess_minutes * measurement_cadence / SECONDS_TO_MINUTES
-)
-
-n_xpix = None
-n_ypix = None
-n_colors = None 
+frame_shape = None
+frame_dtype = None
+frame_attrs = None
+frame_reducer = None
+frame_selector = None
+frame_pyramid = None
 
 parentdir = '/media/usb_drive'
 
+# what the night is scheduled against; swap in a `clock.ScaledClock` to run
+# it faster than real time (see `benchmark.py --night`). latencies are
+# always timed with the real clock
+clock = Clock()
+METRICS_NAME = 'metrics.jsonl'
+
 def get_now():
     """ Get's the current UTC time """
-    now = datetime.now(timezone.utc)
+    now = clock.now()
     return now
 
 
@@ -82,25 +124,233 @@ def get_datestr(datetime):
     return datetime.isoformat().split('T')[0]
 
 
-create_files = lambda outdir, name: _create_files(
-    outdir, name, n_measurements, n_exposures, n_xpix, n_ypix, config=config_dict
-)
+def create_files(outdir, name):
+    """ make the exposure & measurement files for an hour """
+    selection = {}
+    if frame_selector is not None:
+        selection = dict(
+            thumbnail_shape=frame_selector.thumbnail_shape,
+            thumbnail_dtype=frame_selector.thumbnail_dtype,
+            selection_dtype=SELECTION_DTYPE
+        )
+    pyramid = {}
+    if frame_pyramid is not None:
+        pyramid = dict(
+            pyramid_shapes=frame_pyramid.shapes,
+            pyramid_dtype=frame_pyramid.dtype
+        )
+
+    return _create_files(
+        outdir,
+        name,
+        n_measurements,
+        n_exposures,
+        frame_shape,
+        frame_dtype=frame_dtype,
+        frame_attrs=frame_attrs,
+        exposure_codec=exposure_codec,
+        # about a minute of streamed magnetometer rows per chunk
+        stream_chunk_rows=max(
+            int(60 * magnetometer_stream_rate / magnetometer_decimate), 1024
+        ),
+        config=config_dict,
+        swmr=swmr,
+        stats_dtype=None if frame_reducer is None else frame_reducer.dtype,
+        stats_attrs=None if frame_reducer is None else frame_reducer.attrs,
+        **selection,
+        **pyramid
+    )
 
 rm = None
+magnetometer_stream = None
 cam = None
 therm_device_file = None
+thermometer = None
+# keogram updates run here, one at a time, off the writer's thread, reading
+# the files in `keogram_pool`'s worker processes if there are any
+keogram_executor = None
+keogram_pool = None
+keogram_updates = []
+
+def catalog_file(role, path):
+    """ add each exposure file to the night's catalog once it's closed, &
+    to the keogram, if it's being kept up to date
+    """
+    if role != 'exposure':
+        return
+    try:
+        add_to_catalog(path)
+    except Exception as e:
+        log.error(f'failed to add {path} to catalog: {e}')
+
+    if keogram_executor is not None:
+        keogram_updates.append(keogram_executor.submit(
+            make_products,
+            os.path.dirname(path),
+            paths=[path],
+            executor=keogram_pool,
+            **_keogram_config(keogram)
+        ))
+
+
+def wait_for_keogram():
+    """ wait for the keogram updates of the files closed so far """
+    while keogram_updates:
+        try:
+            keogram_updates.pop(0).result()
+        except Exception as e:
+            log.error(f'failed to update keogram: {e}')
+
+
+writer = Writer(
+    flush_every=flush_every,
+    flush_interval=flush_interval,
+    batch_size=measurement_batch_size,
+    batch_interval=measurement_batch_interval,
+    on_close=catalog_file,
+    swmr=swmr
+)
+write_queue = None
+frame_pool = None
+frame_encoder = None
 
 
 async def insert_datum_async(path, datum, index):
-    """ async wrapper around `insert_datum` """
+    """ async wrapper around `writer.insert` """
     loop = asyncio.get_running_loop()    
-    await loop.run_in_executor(None, insert_datum, path, datum, index)
+    stage = 'write_exposure' if isinstance(datum, dict) else 'write_measurement'
+    with metrics.timer(stage):
+        await loop.run_in_executor(None, writer.insert, path, datum, index)
+    close_retired_files()
+
+
+# `writer.close_retired` calls still running
+closing_files = set()
+
+
+def close_retired_files():
+    """ close the files `writer` has retired in the executor, in the
+    background, so neither the event loop nor the next write waits for
+    them to be trimmed & closed (& catalogued, see `catalog_file`)
+    """
+    if not writer.has_retired:
+        return
+
+    future = asyncio.get_running_loop().run_in_executor(
+        None, writer.close_retired
+    )
+    closing_files.add(future)
+    future.add_done_callback(closing_files.discard)
+
+
+def prepare_files(outdir, name):
+    """ make the files for an hour & open them in `writer`, ready to be
+    swapped in by `rotate_files`. this is all blocking disk i/o, so it's run
+    in the executor. returns the exposure & measurement file paths
+    """
+    t1 = monotonic()
+
+    with metrics.timer('prepare_files'):
+        os.makedirs(outdir, exist_ok=True)
+        exposure_file_path, measurement_file_path = create_files(outdir, name)
+        writer.prepare(
+            exposure=exposure_file_path,
+            measurement=measurement_file_path
+        )
+
+    log.info(
+        f'prepared files for {outdir}/{name} in {monotonic() - t1:.2f}s'
+    )
+
+    return exposure_file_path, measurement_file_path
+
+
+def prepare_files_async(outdir, name):
+    """ start preparing the files for an hour in the background. returns
+    `(outdir, name)` & the future of `prepare_files`, to pass to
+    `rotate_files`
+    """
+    loop = asyncio.get_running_loop()
+    return (outdir, name), loop.run_in_executor(
+        None, prepare_files, outdir, name
+    )
+
+
+def next_files(outdir, count, start_of_day_timestamp, start_of_hour_timestamp):
+    """ the outdir & name `main` will rotate to next: the next hour's, unless
+    a day will have passed by then
+    """
+    next_rotation = start_of_hour_timestamp + 1 / SECONDS_TO_HOURS
+
+    if (next_rotation - start_of_day_timestamp) * SECONDS_TO_DAYS > 1:
+        next_day = datetime.fromtimestamp(
+            start_of_day_timestamp + 1 / SECONDS_TO_DAYS, timezone.utc
+        )
+        return f'{parentdir}/{get_datestr(next_day)}', 0
+
+    return outdir, count + 1
+
+
+async def rotate_files(outdir, name, prepared=None):
+    """ hand the files for a new hour to `writer`, which closes the last
+    hour's once all their writes are done. if `prepared` (from
+    `prepare_files_async`) is for these files, this is just a swap; otherwise
+    the files are made now. returns the exposure & measurement file paths
+    """
+    loop = asyncio.get_running_loop()
+    t1 = monotonic()
+
+    paths = None
+    if prepared is not None:
+        prepared_for, future = prepared
+        if not future.done():
+            log.warning(f'files for {outdir}/{name} not ready yet; waiting')
+
+        try:
+            prepared_paths = await future
+        except Exception as e:
+            log.error(f'failed to prepare files for {prepared_for}: {e}')
+        else:
+            if prepared_for == (outdir, name):
+                paths = prepared_paths
+            else:
+                log.warning(
+                    f'prepared files for {prepared_for}, not '
+                    f'{(outdir, name)}; discarding them'
+                )
+                await loop.run_in_executor(
+                    None, writer.discard, *prepared_paths
+                )
+
+    if paths is None:
+        paths = await loop.run_in_executor(None, prepare_files, outdir, name)
+
+    exposure_file_path, measurement_file_path = paths
+    writer.open(
+        exposure=exposure_file_path,
+        measurement=measurement_file_path
+    )
+    close_retired_files()
+
+    metrics.record('rotation', monotonic() - t1)
+    log.info(
+        f'rotated to {exposure_file_path} & {measurement_file_path} '
+        f'in {(monotonic() - t1) * 1e3:.1f} ms'
+    )
+
+    return exposure_file_path, measurement_file_path
 
 async def insert_in_hdf5(path, datum, index):
     """ wraps `insert_datum_async` with error handling. Note, we take a fixed
         timeout for all writes of 2 seconds, as the largest items we'll write
         are the exposures which are ~6 MB, and write speed on the pi/usb
         seem to be of order >~ 10 MB/s    
+
+        any hdf5 compression/checksumming happens inside the write, so it
+        runs in the executor and not on the event loop thread
+
+        returns False if we gave up on a write that may still be running in
+        the executor (so `datum` is still in use), True otherwise
     """
     try:
         task = asyncio.create_task(insert_datum_async(path, datum, index))
@@ -108,6 +358,8 @@ async def insert_in_hdf5(path, datum, index):
             await task #insert_datum_async(path, datum, index)
     except asyncio.TimeoutError:
         log.error(f'timeout when writing to {path} at index {index}')
+        metrics.count('write_timeout')
+        return False
     except asyncio.CancelledError:
         log.info('cancelled while inserting datum; finishing insert before')
         
@@ -119,22 +371,32 @@ async def insert_in_hdf5(path, datum, index):
         if task.done():
             raise
         else:
-            log.warning('insert not yet finished, file may be corrupted!')
+            log.warning(
+                'insert not yet finished, file may be corrupted! '
+                f'(see recover.py to recover {path})'
+            )
+            metrics.count('write_cancelled')
+            return False
 
     except Exception as e:
         log.error(e)
+        metrics.count('write_failure')
+
+    return True
 
 
 async def get_temperature_async():
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(
-        None,
-        get_temperature,
-        therm_device_file
-    )
+    """ `thermometer` reads in the background, so this just returns its
+    latest reading & doesn't need the executor
+    """
+    return get_temperature(thermometer, max_age=thermometer_max_age)
 
 
 async def get_magnetometer_measurement_async():
+    if magnetometer_stream is not None:
+        # no need for a reading of our own, just take the latest streamed one
+        return magnetometer_stream.latest()
+
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(
         None,
@@ -143,34 +405,49 @@ async def get_magnetometer_measurement_async():
     )
 
 
-async def get_measurements():
-    loop = asyncio.get_running_loop()
-
-    timestamp = get_now().timestamp()
-
+async def _read_sensor(read, timeout, default, name):
+    """ run a sensor read coroutine with a timeout, falling back to
+    `default` if it times out or fails
+    """
     try:
-        temperature = await asyncio.wait_for(
-            get_temperature_async(),
-            timeout=1       
-        )
+        with metrics.timer(name):
+            return await asyncio.wait_for(read, timeout=timeout)
     except asyncio.TimeoutError:
-        temperature = 0
-        log.error('thermometer timeout')
+        log.error(f'{name} timeout')
+        metrics.count(f'{name}_timeout')
     except Exception as e:
-        temperature = 0
         log.error(e)
+        metrics.count(f'{name}_failure')
+    return default
 
-    try:
-        magnetic_field = await asyncio.wait_for(
+
+async def get_measurements():
+    """ read the thermometer & magnetometer concurrently. the timestamp is
+    the midpoint of the acquisition, so it's as close as possible to both
+    """
+    t1 = get_now().timestamp()
+
+    magnetometer_timeout = (
+        5 * rm.measurement_time if rm is not None else thermometer_timeout
+    )
+
+    temperature, magnetic_field = await asyncio.gather(
+        _read_sensor(
+            get_temperature_async(),
+            thermometer_timeout,
+            0,
+            'thermometer'
+        ),
+        _read_sensor(
             get_magnetometer_measurement_async(),
-            timeout=5 * rm.measurement_time
+            magnetometer_timeout,
+            np.zeros((3,)),
+            'magnetometer'
         )
-    except asyncio.TimeoutError:
-        magnetic_field = np.zeros((3,))
-        log.error('magnetometer timeout')
-    except Exception as e:
-        magnetic_field = np.zeros((3,))
-        log.error(e) 
+    )
+
+    t2 = get_now().timestamp()
+    timestamp = (t1 + t2) / 2
 
     log.debug(
         'measured temperature & magnetic field: '
@@ -205,14 +482,83 @@ async def get_and_write_measurements(path, index, event=None):
     return index + 1 
 
 
+def take_pooled_exposure():
+    """ take an exposure straight into a buffer from `frame_pool`; the buffer
+    goes back to the pool once `write_queue` is done with it
+    """
+    buf = frame_pool.acquire()
+    try:
+        return take_single_exposure(cam, capture_mode, raw_bits, out=buf)
+    except Exception:
+        frame_pool.release(buf)
+        raise
+
+
+def release_frame(datum):
+    if 'exposure' in datum:
+        frame_pool.release(datum['exposure'])
+
+
+async def encode_exposure(datum):
+    """ compress the exposure in `frame_encoder`'s worker processes & give
+    its buffer back to the pool. if it isn't in the pool's shared memory (eg
+    a blank frame from a failed capture) or encoding fails, the datum is
+    returned as is, for the writer to compress
+    """
+    buf = datum.get('exposure')
+    if buf is None:
+        return datum
+    name = frame_pool.shared_name(buf)
+    if name is None:
+        return datum
+
+    try:
+        with metrics.timer('encode'):
+            encoded = await frame_encoder.encode(name, buf)
+    except Exception as e:
+        log.error(f'failed to encode exposure: {e}')
+        metrics.count('encode_failure')
+        return datum
+
+    frame_pool.release(buf)
+    return {**datum, 'exposure': encoded}
+
+
 async def take_single_exposure_async():
-    """ async wrapper around `take_single_exposure` """
+    """ async wrapper around `take_pooled_exposure` """
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, take_single_exposure, cam)
+    return await loop.run_in_executor(None, take_pooled_exposure)
+
+
+async def run_frame_stage(stage, image_arr):
+    """ `stage(image_arr)`, worked out in `frame_encoder`'s worker processes
+    so it doesn't hold the GIL, or in the executor if there aren't any or
+    the frame isn't in the pool's shared memory (eg a blank frame from a
+    failed capture)
+    """
+    name = None
+    if frame_encoder is not None:
+        name = frame_pool.shared_name(image_arr)
+
+    if name is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, stage, image_arr)
+    return await frame_encoder.submit(stage, name, image_arr)
+
 
+async def reduce_exposure_async(image_arr):
+    """ the stats record of an exposure, for the `stats` dataset """
+    with metrics.timer('reduce'):
+        return await run_frame_stage(frame_reducer, image_arr)
 
-async def get_exposure():
+
+async def get_exposure(tick=0, scheduled=None):
+    """ take an exposure for frame `tick` of the frame schedule, which was
+    due at monotonic time `scheduled`. the wall clock timestamp & how late
+    the exposure started (its jitter) are recorded with it
+    """
     timestamp = get_now().timestamp()
+    jitter = 0. if scheduled is None else clock.monotonic() - scheduled
 
     if cam is None:
         # if there's no camera, there's no wait for an exposure.
@@ -220,7 +566,7 @@ async def get_exposure():
         # that long anyway.
         # I want to replace this with asyncio.Event synchronization at some
         # point b/c it's cleaner.
-        await asyncio.sleep(exposure_time)
+        await clock.async_sleep(exposure_time)
 
     try:
         image_arr = await asyncio.wait_for(
@@ -229,20 +575,87 @@ async def get_exposure():
         )
     except asyncio.TimeoutError:
         log.error('exposure timeout')
-        image_arr = np.zeros((n_xpix, n_ypix, n_colors), dtype=np.uint8)
+        metrics.count('exposure_timeout')
+        image_arr = np.zeros(frame_shape, dtype=frame_dtype)
     except Exception as e:
         log.error(e)
-        image_arr = np.zeros((n_xpix, n_ypix, n_colors), dtype=np.uint8)
+        metrics.count('exposure_failure')
+        image_arr = np.zeros(frame_shape, dtype=frame_dtype)
 
-    return dict(
+    datum = dict(
         timestamp=timestamp,
+        tick=tick,
+        jitter=jitter,
         exposure=image_arr
     )
 
+    if frame_reducer is not None:
+        try:
+            datum['stats'] = await reduce_exposure_async(image_arr)
+        except Exception as e:
+            log.error(f'failed to reduce exposure: {e}')
+            metrics.count('reduce_failure')
 
-async def get_and_write_exposure(path, index, event=None):
-    datum = await get_exposure()
-    await insert_in_hdf5(path, datum, index)
+    return datum
+
+
+async def select_exposure_async(datum):
+    """ run `frame_selector` on an exposure: its thumbnail is made in the
+    frame workers, & the decision on it here, where the background model
+    is kept. if it isn't kept, only its thumbnail is stored, & its buffer goes
+    straight back to the pool
+    """
+    try:
+        with metrics.timer('select'):
+            thumbnail = await run_frame_stage(
+                frame_selector.thumbnailer, datum['exposure']
+            )
+            keep, selection = frame_selector.decide(thumbnail)
+    except Exception as e:
+        log.error(f'failed to select exposure: {e}')
+        metrics.count('select_failure')
+        return datum
+
+    datum = {**datum, 'thumbnail': thumbnail, 'selection': selection}
+    if not keep:
+        frame_pool.release(datum.pop('exposure'))
+        metrics.count('frames_thumbnailed')
+
+    return datum
+
+
+async def bin_exposure_async(datum):
+    """ add the binned versions of a (kept) exposure to its datum, for
+    browsing
+    """
+    if 'exposure' not in datum:
+        return datum
+
+    try:
+        with metrics.timer('bin'):
+            binned = await run_frame_stage(frame_pyramid, datum['exposure'])
+    except Exception as e:
+        log.error(f'failed to bin exposure: {e}')
+        metrics.count('bin_failure')
+        return datum
+
+    return {**datum, **binned}
+
+
+async def get_and_write_exposure(
+    path, index, tick=0, scheduled=None, event=None
+):
+    """ take an exposure & hand it to `write_queue`; the write itself
+    happens in the queue's consumer
+    """
+    datum = await get_exposure(tick, scheduled)
+    if frame_selector is not None:
+        datum = await select_exposure_async(datum)
+    if frame_pyramid is not None:
+        datum = await bin_exposure_async(datum)
+    if frame_encoder is not None and frame_encoder.supported:
+        datum = await encode_exposure(datum)
+    await write_queue.put(path, datum, index)
     
     if event is not None:
         await event.wait()
@@ -251,6 +664,8 @@ async def get_and_write_exposure(path, index, event=None):
 
 
 async def main():
+    global write_queue, frame_pool, frame_encoder
+
     loop = asyncio.get_event_loop()
 
     start = get_now()
@@ -260,100 +675,300 @@ async def main():
     outdir = f'{parentdir}/{get_datestr(start)}'
     os.makedirs(outdir, exist_ok=True)
 
+    # the workers are started before any files are made: a worker being
+    # spawned briefly holds on to the process's open files, & with them hdf5's
+    # lock, which would stop the writer opening a file made at the same time
+    if frame_workers:
+        frame_encoder = FrameEncoder(
+            exposure_codec, frame_shape, frame_dtype, n_workers=frame_workers
+        )
+        if exposure_codec and not frame_encoder.supported:
+            log.info(
+                f'{exposure_codec} can only be applied by the writer; '
+                'not compressing frames in the workers'
+            )
+
+        # the per-frame stages run in the workers too
+        if frame_encoder.supported or any(
+            stage is not None
+            for stage in (frame_reducer, frame_selector, frame_pyramid)
+        ):
+            await loop.run_in_executor(None, frame_encoder.start)
+        else:
+            frame_encoder = None
+
     count = 0
 
-    exposure_file_path, measurement_file_path = create_files(
+    exposure_file_path, measurement_file_path = await rotate_files(
         outdir, count
     )
 
+    # the next hour's files are made in the background, so rotating to them
+    # doesn't hold up the event loop
+    prepared = prepare_files_async(*next_files(
+        outdir, count, start_of_day_timestamp, start_of_hour_timestamp
+    ))
+
     exposure_index = 0
-    measurement_index = 0
 
-    # TODO: kick off the event loop at some determined/fixed/'round' time?
-    for frame_num in range(0, int(frames_per_night)):
-        current = get_now()
-        current_timestamp = current.timestamp()
-        target_end_timestamp = current_timestamp + 1 / exposure_cadence
+    reset_peak_rss()
+
+    # enough buffers for a full queue, plus the frames being written & taken
+    frame_pool = FramePool(
+        frame_shape,
+        frame_dtype,
+        size=write_queue_size + 2,
+        shared=frame_encoder is not None
+    )
+
+    write_queue = WriteQueue(
+        insert_in_hdf5,
+        maxsize=write_queue_size,
+        overflow=write_queue_overflow,
+        on_done=release_frame
+    )
+    write_queue.start()
+    exposure_task = None
+
+    # the sampler owns the row index of the measurement file: it picks up the
+    # current file once per tick, & starts from row 0 when that's changed,
+    # taking its row before awaiting, so a rotation during a slow
+    # measurement can't be undone by the index it then writes back
+    sampled = dict(path=None, index=0)
+
+    async def sample_measurements(tick):
+        path = measurement_file_path
+        if path != sampled['path']:
+            sampled['path'], sampled['index'] = path, 0
+        index = sampled['index']
+        sampled['index'] += 1
+
+        await get_and_write_measurements(path, index)
+
+    # measurements run on their own fixed grid, independent of the exposures
+    sampler = PeriodicSampler(
+        sample_measurements,
+        measurement_cadence,
+        name='measurement sampler',
+        clock=clock
+    )
+    sampler_task = asyncio.create_task(sampler.run())
+
+    async def drain_magnetometer(tick):
+        rows = magnetometer_stream.drain()
+        if len(rows):
+            await loop.run_in_executor(
+                None,
+                writer.append,
+                measurement_file_path,
+                'magnetic_field_stream',
+                rows
+            )
+            close_retired_files()
+
+    drainer = None
+    drainer_task = None
+    if magnetometer_stream is not None:
+        drainer = PeriodicSampler(
+            drain_magnetometer,
+            magnetometer_drain_interval,
+            name='magnetometer drain',
+            clock=clock
+        )
+        drainer_task = asyncio.create_task(drainer.run())
+
+    async def dump_metrics(tick):
+        if tick == 0:
+            # the start of the night; nothing to dump yet
+            return
+        await loop.run_in_executor(
+            None, metrics.dump, f'{outdir}/{METRICS_NAME}'
+        )
+
+    # every period's stage latencies & counters, next to the night's data
+    metrics_dumper = PeriodicSampler(
+        dump_metrics,
+        metrics_interval,
+        name='metrics dump',
+        clock=clock
+    )
+    metrics_task = asyncio.create_task(metrics_dumper.run())
+
+    frame_schedule = Schedule(
+        1 / exposure_cadence,
+        n_ticks=int(frames_per_night),
+        overrun=frame_overrun,
+        name='frame schedule',
+        clock=clock
+    )
+
+    try:
+        # TODO: kick off the event loop at some determined/fixed/'round' time?
+        # frames are taken on a fixed grid of the monotonic clock, so an
+        # overrun or a wall clock step doesn't shift the frames after it
+        async for tick in frame_schedule:
+            current = get_now()
+            current_timestamp = current.timestamp()
         
-        # TODO: move all of this into it's own function for clarity
-        if (current_timestamp - start_of_day_timestamp) * SECONDS_TO_DAYS > 1:
-            start_of_day_timestamp = current_timestamp
-            start_of_hour_timestamp = current_timestamp
+            # TODO: move all of this into it's own function for clarity
+            if (current_timestamp - start_of_day_timestamp) * SECONDS_TO_DAYS > 1:
+                start_of_day_timestamp = current_timestamp
+                start_of_hour_timestamp = current_timestamp
 
-            outdir = f'./{get_datestr(current)}'
+                outdir = f'{parentdir}/{get_datestr(current)}'
     
-            log.info(f'24 hours have passed; changing outdir to {outdir}')
+                log.info(f'24 hours have passed; changing outdir to {outdir}')
 
-            count = 0
+                count = 0
 
-            exposure_file_path, measurement_file_path = create_files(
-                outdir, count
-            )
+                exposure_file_path, measurement_file_path = await rotate_files(
+                    outdir, count, prepared
+                )
+                prepared = prepare_files_async(*next_files(
+                    outdir, count, start_of_day_timestamp, start_of_hour_timestamp
+                ))
 
-            exposure_index = 0
-            measurement_index = 0
+                exposure_index = 0
 
-        elif (current_timestamp - start_of_hour_timestamp) * SECONDS_TO_HOURS > 1:
-            start_of_hour_timestamp = current_timestamp
+            elif (current_timestamp - start_of_hour_timestamp) * SECONDS_TO_HOURS > 1:
+                start_of_hour_timestamp = current_timestamp
 
-            log.info('1 hour has passed; making new measurement/exposure files')
+                log.info('1 hour has passed; making new measurement/exposure files')
 
-            count += 1
+                count += 1
 
-            exposure_file_path, measurement_file_path = create_files(
-                outdir, count
-            )
+                exposure_file_path, measurement_file_path = await rotate_files(
+                    outdir, count, prepared
+                )
+                prepared = prepare_files_async(*next_files(
+                    outdir, count, start_of_day_timestamp, start_of_hour_timestamp
+                ))
 
-            exposure_index = 0
-            measurement_index = 0
- 
-        exposure_task = asyncio.create_task(get_and_write_exposure(
-            exposure_file_path,
-            exposure_index
-        ))
+                exposure_index = 0
 
-        while target_end_timestamp - sleep_buffer > get_now().timestamp():
-            measurement_index = await get_and_write_measurements(
-                measurement_file_path,
-                measurement_index
+            # at most one exposure is being taken at a time; if the last one
+            # is still going (eg it's blocked on a full write queue), wait
+            if exposure_task is not None and not exposure_task.done():
+                log.warning('previous exposure not yet queued; waiting')
+                await exposure_task
+
+            exposure_task = asyncio.create_task(get_and_write_exposure(
+                exposure_file_path,
+                exposure_index,
+                tick=tick,
+                scheduled=frame_schedule.slot(tick)
+            ))
+
+            # since we dont wait `exposure_task` to finish, we go ahead and
+            # increment to the next index
+            exposure_index += 1
+
+            log.info(
+                f'write queue depth = {write_queue.depth}, '
+                f'last write lag = {write_queue.last_lag:.2f}s, '
+                f'dropped = {write_queue.n_dropped}'
+            )
+    finally:
+        log.info(frame_schedule.summary())
+        if frame_selector is not None:
+            log.info(frame_selector.summary())
+
+        metrics_task.cancel()
+        try:
+            await metrics_task
+        except asyncio.CancelledError:
+            pass
+
+        sampler_task.cancel()
+        try:
+            await sampler_task
+        except asyncio.CancelledError:
+            pass
+        log.info(sampler.summary())
+
+        if drainer_task is not None:
+            drainer_task.cancel()
+            try:
+                await drainer_task
+            except asyncio.CancelledError:
+                pass
+            await drain_magnetometer(None)
+            log.info(
+                f'{drainer.summary()}; {magnetometer_stream.n_readings} '
+                f'magnetometer readings, {magnetometer_stream.n_lost} lost'
             )
 
-        # since we dont wait `exposure_task` to finish, we go ahead and
-        # increment to the next index
-        exposure_index += 1
+        if exposure_task is not None and not exposure_task.done():
+            await exposure_task
+        await write_queue.close()
 
-        approx_sleep_length = target_end_timestamp - get_now().timestamp()
-        if approx_sleep_length < 0:
-            log.warning(f'sleep length = {approx_sleep_length:.3e} < 0')
-        else:
-            log.info(f'sleeping ~{approx_sleep_length:.1f}s')
-            sleep_length = target_end_timestamp - get_now().timestamp()
-            await asyncio.sleep(sleep_length)
+        # let the next hour's files finish being made, so `writer` can clean
+        # them up
+        try:
+            await prepared[1]
+        except Exception as e:
+            log.error(e)
+
+        log.info('closing data files')
+        if closing_files:
+            await asyncio.wait(closing_files)
+        writer.close()
+        wait_for_keogram()
+
+        metrics.dump(f'{outdir}/{METRICS_NAME}')
+        log.info(
+            f'peak rss this night = {peak_rss_mb()} MB '
+            f'({frame_pool.size} frame buffers), '
+            f'{n_dropped()} log records dropped'
+        )
+
+        if frame_encoder is not None:
+            frame_encoder.close()
+            frame_encoder = None
+        frame_pool.close()
+
+
+def teardown():
+    """ stop the background readers & workers `setup` started """
+    if thermometer is not None:
+        thermometer.stop()
+    if magnetometer_stream is not None:
+        magnetometer_stream.stop()
+        log.info(
+            f'stopped magnetometer stream; {magnetometer_stream.n_readings} '
+            f'readings, {magnetometer_stream.n_failures} failed'
+        )
+    if keogram_pool is not None:
+        keogram_pool.shutdown()
 
 
 def time_until_observation():
-    now = datetime.now()
+    now = datetime.fromtimestamp(clock.time())
     task_datetime = datetime.combine(now.date(), datetime.strptime(config_dict["observation_start_time"], "%H:%M").time())
     if task_datetime < now:  # If the time has passed today, set it for tomorrow
         task_datetime += timedelta(days=1)
 
     return (task_datetime - now).total_seconds()    
 
-if __name__ == '__main__':
-    level = 'DEBUG' if args.verbose else 'INFO'
-    log = setup_logger('main-logger', sys.stdout, 'main', level=level)
 
-    if not os.path.isdir(parentdir):
-        # TODO: raise an error and crash if a 'usb_critical flag is set'
-        log.warning(
-            f'usb drive not found at {parentdir}. defaulting to /home/gpoe'
-        )
-        parentdir = '/home/gpoe'
+def setup(camera_wait=60):
+    """ set up the camera, magnetometer & thermometer for `main`. whatever
+    isn't critical & fails to set up is left as None
+
+    camera_wait: seconds to wait before setting up the camera
+    """
+    global cam, frame_shape, frame_dtype, frame_attrs, frame_reducer
+    global frame_selector, frame_pyramid, keogram_executor, keogram_pool
+    global rm, magnetometer_stream, therm_device_file, thermometer
 
     try:
-        log.info("Sleeping for 1 min to wait to setup camera...")
-        sleep(60)
-        cam = prepare_camera(exposure_time, AnalogueGain=camera_gain)
+        log.info(f"Sleeping for {camera_wait}s to wait to setup camera...")
+        sleep(camera_wait)
+        cam = prepare_camera(
+            exposure_time,
+            capture_mode=capture_mode,
+            AnalogueGain=camera_gain
+        )
         log.info('setup camera')
     except Exception as e:
         if camera_critical:
@@ -366,26 +981,56 @@ if __name__ == '__main__':
         # TODO: some kind of test to make sure we're actually getting
         # useful data? eg make sure there's at least some value > 0?        
         t1 = time()
-        image_arr = take_single_exposure(cam)
+        image_arr = take_single_exposure(cam, capture_mode, raw_bits)
         t2 = time()
 
         log.info(f'exposure & postprocessing took {t2 - t1:.3f} s')
         
-        n_xpix, n_ypix, n_colors = image_arr.shape
+        frame_shape = image_arr.shape
+        frame_dtype = image_arr.dtype
 
-        log.debug(
-            f'dims (n_xpix, n_ypix, n_colors) = {n_xpix, n_ypix, n_colors}'
-        )
+        log.debug(f'frame shape = {frame_shape}, dtype = {frame_dtype}')
     except Exception as e:
         if camera_critical:
             log.error(e)
             raise e
         else:
             log.warning(e)  
-        n_xpix, n_ypix, n_colors = (1, 1, 3)
+        image_arr = take_single_exposure(None, capture_mode, raw_bits)
+        frame_shape = image_arr.shape
+        frame_dtype = image_arr.dtype
+
+    frame_attrs = get_frame_attrs(cam, capture_mode, raw_bits)
+    if frame_stats:
+        frame_reducer = FrameReducer(frame_attrs)
+    if frame_selection is not None:
+        frame_selector = FrameSelector(
+            frame_attrs, frame_shape, **_selection_config(frame_selection)
+        )
+    if frame_pyramid_levels:
+        frame_pyramid = FramePyramid(
+            frame_attrs, frame_shape, frame_pyramid_levels
+        )
+    if keogram is not None:
+        n_workers = _keogram_config(keogram)['n_workers']
+        keogram_executor = ThreadPoolExecutor(1)
+        # started now, before any of the night's files are made (see
+        # `products.start_workers`), & reused for every update
+        if n_workers:
+            keogram_pool = start_workers(n_workers)
 
     try:
-        rm = prepare_magnetometer()
+        rm = prepare_magnetometer(cycle_count=magnetometer_cycle_count)
+        if magnetometer_stream_rate:
+            magnetometer_stream = MagnetometerStream(
+                rm,
+                rate=magnetometer_stream_rate,
+                decimate=magnetometer_decimate
+            )
+            magnetometer_stream.start()
+            log.info(
+                f'streaming magnetometer at ~{magnetometer_stream_rate} Hz'
+            )
         log.info('setup magnetometer')
     except Exception as e:
         if magnetometer_critical:
@@ -396,6 +1041,13 @@ if __name__ == '__main__':
  
     try:
         therm_device_file = prepare_thermometer()
+        thermometer = ThermometerReader(
+            therm_device_file,
+            interval=thermometer_interval
+        )
+        thermometer.start()
+        if not thermometer.wait_for_reading(timeout=10):
+            log.warning('no thermometer reading after 10s')
         log.info('setup thermometer')
     except Exception as e:
         if thermometer_critical:
@@ -409,33 +1061,68 @@ if __name__ == '__main__':
     except Exception as e:
         log.warning(e)
 
-    # Schedule the function
-    #schedule.every().day.at(config_dict["observation_start_time"]).do(async_main)  # Example: 2:30 PM
-    log.info(f"Observation scheduled to begin at: {config_dict['observation_start_time']}")
 
+def observe(n_nights=None, now=False):
+    """ wait for `observation_start_time` & take a night's data, over and
+    over
+
+    n_nights: int, stop after this many nights, or None to go on forever
+    now: bool, start each night straight away
+    """
     begin_obs = False
-    while True:
+    while n_nights is None or n_nights > 0:
         time_to_start = time_until_observation()
         log.info(f"Time to observation start: {round(time_to_start, 2)} seconds")
 
-        if not args.now:
+        if not now:
             if time_to_start > 3600:
                 log.info(f"Sleeping for 1 hour")
-                sleep(3600)
+                clock.sleep(3600)
             elif time_to_start > 600:
                 log.info(f"Sleeping for 10 min")
-                sleep(600)
+                clock.sleep(600)
             elif time_to_start > 60:
                 log.info(f"Sleeping for 1 min")
-                sleep(60)
+                clock.sleep(60)
             else:
                 log.info(f"Sleeping until observation start time")
-                sleep(time_to_start)
+                clock.sleep(time_to_start)
                 begin_obs = True
         else:
             begin_obs = True
 
         if begin_obs:
-            log.info(f"Beginning observations at {datetime.now().time()}")
+            log.info(
+                "Beginning observations at "
+                f"{datetime.fromtimestamp(clock.time()).time()}"
+            )
             asyncio.run(main())
             begin_obs = False
+            if n_nights is not None:
+                n_nights -= 1
+
+
+if __name__ == '__main__':
+    level = 'DEBUG' if args.verbose else 'INFO'
+    log = setup_logger('main-logger', sys.stdout, 'main', level=level)
+    configure_logging(queue_size=log_queue_size, rate=log_rate_limit)
+
+    if not os.path.isdir(parentdir):
+        # TODO: raise an error and crash if a 'usb_critical flag is set'
+        log.warning(
+            f'usb drive not found at {parentdir}. defaulting to /home/gpoe'
+        )
+        parentdir = '/home/gpoe'
+
+    setup()
+
+    # Schedule the function
+    #schedule.every().day.at(config_dict["observation_start_time"]).do(async_main)  # Example: 2:30 PM
+    log.info(f"Observation scheduled to begin at: {config_dict['observation_start_time']}")
+
+    try:
+        observe(now=args.now)
+    finally:
+        teardown()
+        # write out the last of the logs before exiting
+        stop_logging()
@@ -1,19 +1,49 @@
 import os
+import sys
 import glob
 import time
+import threading
 
 import numpy as np
 
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
 
 import board
 import rm3100
 
+from data import pack_12bit
+from metrics import metrics
+
+from logger import setup_logger
+log = setup_logger('measure-logger', sys.stdout, 'measure')
+
 SECONDS_TO_MICROSECONDS = 1_000_000
 
+CAPTURE_MODES = ['rgb', 'raw']
+
+# columns cut off either side of the frame; these are all black on the
+# IMX477. both are even, so the raw frame keeps the sensor's bayer order
+CROP_LEFT = 250
+CROP_RIGHT = 480
+
+# the streamed magnetometer's latest reading is stale once it's this many
+# rows old
+MAGNETOMETER_STALE_ROWS = 5
+# at most one warning this often about failing magnetometer reads [seconds]
+MAGNETOMETER_WARN_INTERVAL = 60
+
+# where the 1-wire thermometer shows up
+W1_DEVICES_DIR = '/sys/bus/w1/devices/'
 
-def prepare_camera(exposure_time, **kwargs):
-    """ exposure_time is in seconds """
+
+def prepare_camera(exposure_time, capture_mode='rgb', **kwargs):
+    """ exposure_time is in seconds
+
+    capture_mode: 'rgb' for the ISP-processed 8-bit "main" stream, or 'raw'
+        for the sensor's linear 12-bit bayer data
+    """
+    if capture_mode not in CAPTURE_MODES:
+        raise ValueError(f'capture_mode must be one of {CAPTURE_MODES}')
 
     camera_controls = dict(
         ExposureTime=exposure_time * SECONDS_TO_MICROSECONDS,
@@ -24,7 +54,14 @@ def prepare_camera(exposure_time, **kwargs):
     camera_controls.update(kwargs)
 
     cam = Picamera2()
-    capture_config = cam.create_still_configuration(raw={}, display=None)
+    if capture_mode == 'raw':
+        # unpacked 12-bit: one little-endian uint16 per pixel
+        raw_config = dict(format='SRGGB12', size=cam.sensor_resolution)
+    else:
+        raw_config = {}
+    capture_config = cam.create_still_configuration(
+        raw=raw_config, display=None
+    )
     capture_config["controls"] = camera_controls
 
     cam.configure(capture_config)
@@ -34,18 +71,104 @@ def prepare_camera(exposure_time, **kwargs):
     return cam
 
 
-def take_single_exposure(cam):
+def take_single_exposure(cam, capture_mode='rgb', raw_bits=16, out=None):
+    """ capture_mode: 'rgb' or 'raw', see `prepare_camera`
+    raw_bits: 16 to return raw frames as a uint16 array, or 12 to pack every
+        two pixels into three bytes (see `data.pack_12bit`)
+    out: optional preallocated, contiguous array of the cropped frame's shape
+        (eg from a `frame_pool.FramePool`). if given, the frame is copied
+        straight out of the camera's buffer into it, and `out` is returned
+    """
+    if raw_bits not in (12, 16):
+        raise ValueError('raw_bits must be 12 or 16')
+
+    stream = 'raw' if capture_mode == 'raw' else 'main'
+
     if cam is None:
-        image_arr = np.zeros((1, 1, 3), dtype=np.uint8)
-    else:
-        image_arr = cam.capture_array("main")
-        image_arr = image_arr[:, 250:-480, :] # Cuts off all black regions of image and reduces data size by ~18 %
+        image_arr = _blank_frame(capture_mode, raw_bits)
+        if out is None:
+            return image_arr
+        out[...] = 0
+        return out
+
+    if out is None:
+        with metrics.timer('capture'):
+            image_arr = cam.capture_array(stream)
+        with metrics.timer('crop'):
+            image_arr = _crop_frame(cam, image_arr, capture_mode)
+            return _finish_frame(image_arr, capture_mode, raw_bits)
+
+    with metrics.timer('capture'):
+        request = cam.capture_request()
+    try:
+        with MappedArray(request, stream) as m, metrics.timer('crop'):
+            image_arr = _crop_frame(cam, m.array, capture_mode)
+            _finish_frame(image_arr, capture_mode, raw_bits, out=out)
+    finally:
+        request.release()
+
+    return out
+
+
+def _blank_frame(capture_mode, raw_bits):
+    if capture_mode == 'rgb':
+        return np.zeros((1, 1, 3), dtype=np.uint8)
+    return _finish_frame(
+        np.zeros((2, 2), dtype=np.uint16), capture_mode, raw_bits
+    )
+
+
+def _crop_frame(cam, image_arr, capture_mode):
+    """ Cuts off all black regions of image and reduces data size by ~18 % """
+    if capture_mode == 'raw':
+        width, _ = cam.camera_configuration()['raw']['size']
+        # rows come back as bytes, padded out to the stride
+        image_arr = image_arr.view(np.uint16)[:, :width]
+        return image_arr[:, CROP_LEFT:-CROP_RIGHT]
+    return image_arr[:, CROP_LEFT:-CROP_RIGHT, :]
+
+
+def _finish_frame(image_arr, capture_mode, raw_bits, out=None):
+    """ pack raw frames if asked to, and copy into `out` if given """
+    if capture_mode == 'raw' and raw_bits == 12:
+        return pack_12bit(image_arr, out=out)
+
+    if out is not None:
+        np.copyto(out, image_arr)
+        return out
+
+    if capture_mode == 'raw':
+        return np.ascontiguousarray(image_arr)
     return image_arr
 
 
-def prepare_magnetometer():
+def get_frame_attrs(cam, capture_mode='rgb', raw_bits=16):
+    """ describes how frames from `take_single_exposure` are laid out; these
+    are stored as attributes on the `exposure` dataset
+    """
+    if capture_mode == 'rgb':
+        return dict(capture_mode='rgb', packing='none', bit_depth=8)
+
+    if cam is None:
+        bayer_order = 'RGGB'
+    else:
+        # eg 'SRGGB12' -> 'RGGB'
+        bayer_order = cam.camera_configuration()['raw']['format'][1:5]
+
+    return dict(
+        capture_mode='raw',
+        bayer_order=bayer_order,
+        bit_depth=12,
+        packing='packed12' if raw_bits == 12 else 'none'
+    )
+
+
+def prepare_magnetometer(cycle_count=400):
+    """ cycle_count: higher is less noisy, but slower; at 400 a reading of
+    all three axes takes ~45 ms, so continuous reads top out around 20 Hz
+    """
     i2c = board.I2C()
-    rm = rm3100.RM3100_I2C(i2c, i2c_address=0x20, cycle_count=400)
+    rm = rm3100.RM3100_I2C(i2c, i2c_address=0x20, cycle_count=cycle_count)
     return rm
 
 
@@ -60,12 +183,164 @@ def get_magnetometer_measurement(rm):
     return np.array([Bx, By, Bz])
 
 
+class MagnetometerStream:
+    """ runs the magnetometer in continuous mode & reads it from a background
+    thread into a preallocated ring buffer of (timestamp, Bx, By, Bz) rows,
+    rather than paying for a single reading & sleep every sample.
+
+    rate: float, requested readings per second. the RM3100 picks the nearest
+        of 600, 300, 150, 75, 37, 18, 9, 4.5, ... Hz, and its cycle count may
+        make it slower still
+    decimate: int, average this many readings into each stored row
+    buffer_size: int, rows in the ring buffer; `drain` needs to be called
+        before it wraps around, or the oldest rows are lost
+    max_age: float, the oldest reading (in seconds) `latest` returns; by
+        default, `MAGNETOMETER_STALE_ROWS` rows' worth, but at least a
+        second, so a busy moment for the pi doesn't count
+
+    a failed read (eg an i2c error) is counted & retried, rather than
+    stopping the stream.
+    """
+
+    def __init__(
+        self, rm, rate=75, decimate=1, buffer_size=None, max_age=None
+    ):
+        self.rm = rm
+        self.rate = rate
+        self.decimate = decimate
+
+        if max_age is None:
+            max_age = max(MAGNETOMETER_STALE_ROWS * decimate / rate, 1)
+        self.max_age = max_age
+
+        if buffer_size is None:
+            # a minute of rows
+            buffer_size = max(int(60 * rate / decimate), 1)
+
+        self.n_readings = 0
+        self.n_lost = 0
+        self.n_failures = 0
+
+        self._buffer = np.zeros((buffer_size, 4), dtype=np.float64)
+        self._read_time = None
+        self._n_written = 0
+        self._n_drained = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def age(self):
+        """ seconds since the latest row, or None if there isn't one """
+        if self._read_time is None:
+            return None
+        return time.monotonic() - self._read_time
+
+    def start(self):
+        self._stop.clear()
+        self.rm.start_continuous_reading(frequency=self.rate)
+        self._thread = threading.Thread(
+            target=self._run, name='magnetometer-stream', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.rm.stop()
+
+    def _run(self):
+        poll_interval = 0.5 / self.rate
+        total = np.zeros((4,), dtype=np.float64)
+        n_summed = 0
+        last_warned = None
+        n_unwarned = 0
+
+        while not self._stop.is_set():
+            try:
+                reading = self.rm.get_next_reading(poll_interval=poll_interval)
+                field = self.rm.convert_to_microteslas(reading)
+            except Exception as e:
+                self.n_failures += 1
+                n_unwarned += 1
+                metrics.count('magnetometer_failure')
+
+                now = time.monotonic()
+                if (
+                    last_warned is None
+                    or now - last_warned >= MAGNETOMETER_WARN_INTERVAL
+                ):
+                    log.warning(
+                        f'magnetometer read failed {n_unwarned} time(s) '
+                        f'({self.n_failures} so far): {e}'
+                    )
+                    last_warned = now
+                    n_unwarned = 0
+
+                self._stop.wait(1 / self.rate)
+                continue
+
+            total[0] += time.time()
+            total[1:] += field
+            n_summed += 1
+            self.n_readings += 1
+
+            if n_summed < self.decimate:
+                continue
+
+            with self._lock:
+                i = self._n_written % len(self._buffer)
+                self._buffer[i] = total / n_summed
+                self._n_written += 1
+                self._read_time = time.monotonic()
+
+            total[:] = 0
+            n_summed = 0
+
+    def latest(self, max_age=None):
+        """ the latest (Bx, By, Bz), in microteslas. raises TimeoutError if
+        there's no reading yet or the latest is more than `max_age` seconds
+        old (`self.max_age` by default)
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            age = self.age
+            if age is None:
+                raise TimeoutError('no magnetometer reading yet')
+            if age > max_age:
+                raise TimeoutError(
+                    f'latest magnetometer reading is {age:.1f}s old '
+                    f'({self.n_failures} failed reads)'
+                )
+            i = (self._n_written - 1) % len(self._buffer)
+            return self._buffer[i, 1:].copy()
+
+    def drain(self):
+        """ all the (timestamp, Bx, By, Bz) rows stored since the last drain """
+        with self._lock:
+            size = len(self._buffer)
+            n_new = self._n_written - self._n_drained
+            if n_new > size:
+                self.n_lost += n_new - size
+                n_new = size
+
+            idxs = np.arange(self._n_written - n_new, self._n_written) % size
+            rows = self._buffer[idxs]
+            self._n_drained = self._n_written
+
+        return rows
+
+
 def prepare_thermometer():
-    os.system('modprobe w1-gpio')
-    os.system('modprobe w1-therm')
- 
-    base_dir = '/sys/bus/w1/devices/'
-    device_folder = glob.glob(base_dir + '28*')[0]
+    device_folders = glob.glob(W1_DEVICES_DIR + '28*')
+    if not device_folders:
+        # the 1-wire kernel modules aren't loaded yet
+        os.system('modprobe w1-gpio')
+        os.system('modprobe w1-therm')
+        device_folders = glob.glob(W1_DEVICES_DIR + '28*')
+
+    device_folder = device_folders[0]
     device_file = device_folder + '/w1_slave'
 
     return device_file
@@ -76,18 +351,124 @@ def _read_temp(device_file):
         return f.readlines()
 
 
-def get_temperature(device_file):
-    if device_file is None:
-        return 0
+def _read_temperature(device_file, max_retries=5):
+    """ blocking read of the thermometer, retrying if the CRC check fails.
+    each read triggers a full ~750 ms 1-wire conversion
+
+    returns (temperature in C, number of CRC failures)
+    """
+    n_crc_failures = 0
 
     lines = _read_temp(device_file)
     while lines[0].strip()[-3:] != 'YES':
-        # time.sleep(0.2)
-        lines = _read_temp()
+        n_crc_failures += 1
+        if n_crc_failures > max_retries:
+            raise ValueError(
+                f'thermometer CRC check failed {n_crc_failures} times'
+            )
+        time.sleep(0.2)
+        lines = _read_temp(device_file)
     
     equals_pos = lines[1].find('t=')
-    if equals_pos != -1:
-        temp_string = lines[1][equals_pos+2:]
-        temp_c = float(temp_string) / 1000.0
-        return temp_c
+    if equals_pos == -1:
+        raise ValueError(f'no temperature in thermometer output {lines}')
+
+    temp_string = lines[1][equals_pos+2:]
+    temp_c = float(temp_string) / 1000.0
+    return temp_c, n_crc_failures
+
+
+class ThermometerReader:
+    """ reads the thermometer every `interval` seconds in a background thread
+    & keeps the latest reading, so `get_temperature` doesn't have to wait for
+    a 1-wire conversion. temperature changes slowly, so we don't need a fresh
+    conversion for every sample.
+    """
+
+    def __init__(self, device_file, interval=5):
+        self.device_file = device_file
+        self.interval = interval
+
+        self.temperature = None
+        self.n_reads = 0
+        self.n_crc_failures = 0
+        self.n_failures = 0
+
+        self._read_time = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._has_reading = threading.Event()
+        self._thread = None
+
+    @property
+    def age(self):
+        """ seconds since the latest reading, or None if there isn't one """
+        if self._read_time is None:
+            return None
+        return time.monotonic() - self._read_time
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='thermometer-reader', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                temperature, n_crc_failures = _read_temperature(
+                    self.device_file
+                )
+                with self._lock:
+                    self.temperature = temperature
+                    self._read_time = time.monotonic()
+                    self.n_reads += 1
+                    self.n_crc_failures += n_crc_failures
+                self._has_reading.set()
+            except Exception:
+                with self._lock:
+                    self.n_failures += 1
+
+            self._stop.wait(self.interval)
+
+    def wait_for_reading(self, timeout=None):
+        """ block until there's a first reading; returns False on timeout """
+        return self._has_reading.wait(timeout)
+
+    def get(self, max_age=None):
+        """ latest temperature. raises TimeoutError if there's no reading yet
+        or the latest is more than `max_age` seconds old
+        """
+        with self._lock:
+            age = self.age
+            if age is None:
+                raise TimeoutError('no thermometer reading yet')
+            if max_age is not None and age > max_age:
+                raise TimeoutError(
+                    f'latest thermometer reading is {age:.1f}s old '
+                    f'({self.n_failures} failed reads, '
+                    f'{self.n_crc_failures} CRC failures)'
+                )
+            return self.temperature
+
+
+def get_temperature(device_file, max_age=None):
+    """ device_file: the thermometer's w1_slave file, for a blocking read, or
+        a running `ThermometerReader`, to return its latest reading
+    max_age: for a `ThermometerReader`, the oldest reading (in seconds) to
+        accept before raising TimeoutError
+    """
+    if device_file is None:
+        return 0
+
+    if isinstance(device_file, ThermometerReader):
+        return device_file.get(max_age)
 
+    temp_c, _ = _read_temperature(device_file)
+    return temp_c
@@ -0,0 +1,118 @@
+import sys
+import json
+import threading
+from time import time, perf_counter
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from logger import setup_logger
+log = setup_logger('metrics-logger', sys.stdout, 'metrics')
+
+
+class Metrics:
+    """ per-stage latencies & event counters for the hot path, eg
+
+        with metrics.timer('capture'):
+            ...
+        metrics.count('write_timeout')
+
+    latencies are summarized (n, p50, p95, max) & reset every `dump`, so each
+    line of the metrics file covers one period; counters keep counting for
+    the whole run. safe to use from executor threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+        self.counters = Counter()
+        self.period_start = time()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        t1 = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - t1)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self, reset=False):
+        """ the latencies (in ms) of each stage this period & the counters """
+        with self._lock:
+            samples = self._samples
+            counters = dict(self.counters)
+            period_start = self.period_start
+            period_end = time()
+            if reset:
+                self._samples = defaultdict(list)
+                self.period_start = period_end
+
+        stages = {}
+        for stage, values in samples.items():
+            p50, p95 = np.percentile(values, [50, 95]) * 1e3
+            stages[stage] = dict(
+                n=len(values),
+                p50=round(p50, 3),
+                p95=round(p95, 3),
+                max=round(max(values) * 1e3, 3)
+            )
+
+        return dict(
+            start=period_start,
+            end=period_end,
+            stages=stages,
+            counters=counters,
+            peak_rss_mb=peak_rss_mb()
+        )
+
+    def dump(self, path):
+        """ append this period's summary to the json lines file at `path` &
+        start a new period
+        """
+        summary = self.summary(reset=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+        log.debug(f'wrote metrics to {path}')
+        return summary
+
+
+# shared by everything in this process
+metrics = Metrics()
+
+
+def read_metrics(path):
+    """ read a metrics file back in as a list of summaries """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def reset_peak_rss():
+    """ reset the kernel's peak resident set size counter for this process,
+    so `peak_rss_mb` reports the peak since now (linux only)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError as e:
+        log.debug(f'could not reset peak rss: {e}')
+
+
+def peak_rss_mb():
+    """ peak resident set size of this process in MB, or None if unknown """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError as e:
+        log.debug(f'could not read peak rss: {e}')
+    return None
@@ -0,0 +1,188 @@
+import sys
+import zlib
+import asyncio
+import multiprocessing
+from itertools import product
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from data import EncodedFrame, _exposure_codec, _exposure_filter_parameters
+
+from logger import setup_logger
+log = setup_logger('offload-logger', sys.stdout, 'offload')
+
+# shared memory blocks a worker has attached to, by name; the frame pool's
+# buffers are reused, so each is only attached once
+_attached = {}
+
+
+def _attach(name, shape, dtype):
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _encode_chunks(name, shape, dtype, offsets, chunk_shape, level, shuffle):
+    """ runs in a worker: gzip the chunks of the frame in shared memory block
+    `name` at `offsets`, the same way hdf5's shuffle & deflate filters would
+    """
+    frame = _attach(name, shape, dtype)
+    itemsize = frame.dtype.itemsize
+
+    chunks = []
+    for offset in offsets:
+        chunk = frame[tuple(
+            slice(o, o + n) for o, n in zip(offset, chunk_shape)
+        )]
+        if chunk.shape != chunk_shape:
+            # chunks on the edge of the frame are stored padded out to size
+            padded = np.zeros(chunk_shape, dtype=frame.dtype)
+            padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+            chunk = padded
+
+        data = np.ascontiguousarray(chunk).view(np.uint8)
+        if shuffle and itemsize > 1:
+            data = data.reshape(-1, itemsize).T
+        chunks.append((offset, zlib.compress(data.tobytes(), level)))
+
+    return chunks
+
+
+def _run_stage(stage, name, shape, dtype):
+    """ runs in a worker: `stage` of the frame in shared memory block `name` """
+    return stage(_attach(name, shape, dtype))
+
+
+def _ready():
+    return True
+
+
+@contextmanager
+def _hidden_main():
+    """ a spawned worker normally runs the parent's main script again (as
+    `__mp_main__`), in case what it's given to run was defined there. nothing
+    the workers run is, & the script sets up the camera & sensors, so it's
+    hidden from workers spawned in this block
+    """
+    main = sys.modules['__main__']
+    path = getattr(main, '__file__', None)
+    if path is not None:
+        del main.__file__
+    try:
+        yield
+    finally:
+        if path is not None:
+            main.__file__ = path
+
+
+def spawn_workers(n_workers):
+    """ a pool of `n_workers` worker processes, all started by the time
+    it's returned. the event loop process has threads running, so they're
+    spawned rather than forked; they only import what the functions they're
+    given to run need (see `_hidden_main`)
+    """
+    executor = ProcessPoolExecutor(
+        n_workers, mp_context=multiprocessing.get_context('spawn')
+    )
+    # the pool spawns a worker for each of these, as none are idle yet
+    with _hidden_main():
+        futures = [executor.submit(_ready) for _ in range(n_workers)]
+    for future in futures:
+        future.result()
+    return executor
+
+
+class FrameEncoder:
+    """ compresses exposures into the chunks of the `exposure` dataset in a
+    pool of worker processes, so the compression doesn't hold the GIL the
+    event loop needs to keep sensor sampling on time. the writer then stores
+    the chunks as they are (see `data.EncodedFrame`). the other cpu bound
+    work done on each frame (eg `reduction.FrameReducer`) is run in the same
+    workers, with `submit`.
+
+    frames are read by the workers straight out of the shared memory buffers
+    of a `FramePool(..., shared=True)`, so they're never pickled; only the
+    compressed chunks come back. each frame's chunks are split between the
+    workers, so a tiled frame (see `exposure_compression`'s `tile`) is
+    compressed on all of them at once.
+
+    only gzip (with or without shuffle) can be done this way; check
+    `supported` before using `encode`.
+
+    codec: the `exposure_compression` config entry
+    frame_shape, frame_dtype: shape & dtype of a single frame
+    n_workers: int, number of worker processes
+    """
+
+    def __init__(self, codec, frame_shape, frame_dtype, n_workers=4):
+        self.codec = _exposure_codec(codec)
+        self.frame_shape = tuple(frame_shape)
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.n_workers = n_workers
+
+        chunks = _exposure_filter_parameters(codec, frame_shape)['chunks']
+        self.chunk_shape = tuple(chunks[1:])
+
+        offsets = list(product(*(
+            range(0, n, c) for n, c in zip(self.frame_shape, self.chunk_shape)
+        )))
+        # the chunks each worker compresses
+        n_groups = min(n_workers, len(offsets))
+        self._groups = [offsets[i::n_groups] for i in range(n_groups)]
+
+        self._pool = None
+
+    @property
+    def supported(self):
+        return (
+            self.codec['compression'] == 'gzip'
+            and not self.codec['fletcher32']
+        )
+
+    def start(self):
+        """ start the workers now, rather than on the first frame """
+        self._pool = spawn_workers(self.n_workers)
+        log.info(f'started {self.n_workers} frame workers')
+
+    async def encode(self, name, frame):
+        """ compress `frame`, which lives in the shared memory block `name`.
+        returns a `data.EncodedFrame`
+        """
+        loop = asyncio.get_running_loop()
+
+        groups = await asyncio.gather(*[
+            loop.run_in_executor(
+                self._pool,
+                _encode_chunks,
+                name,
+                frame.shape,
+                frame.dtype.str,
+                offsets,
+                self.chunk_shape,
+                self.codec['compression_level'],
+                self.codec['shuffle']
+            )
+            for offsets in self._groups
+        ])
+
+        return EncodedFrame([chunk for group in groups for chunk in group])
+
+    async def submit(self, stage, name, frame):
+        """ run `stage(frame)` in a worker & return the result; `frame`
+        lives in the shared memory block `name`. `stage` is pickled over to
+        the worker every time, so it should be small, & it can't keep state
+        between frames
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._pool, _run_stage, stage, name, frame.shape, frame.dtype.str
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,699 @@
+""" the nightly products, made by streaming through a night's exposure files a
+few frames at a time: a keogram (the north-south strip through the middle of
+each frame, stacked over time) & a timelapse.
+
+    python products.py /media/usb_drive/2025-01-01 --timelapse night.mp4
+
+the keogram is kept in the night's `keogram.hdf5`, & only frames that aren't
+in it yet are added to it, so it can be kept up to date during the night (see
+the `keogram` config entry) & be ready at dawn. the files of a night are read
+in parallel by a pool of worker processes (see `--workers`); results are
+still put together in time order.
+
+image rows are taken to run north-south; use `--column` to pick the strip if
+the camera isn't pointed at the zenith.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import itertools
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+from data import _n_valid, level_key, night_files, stored_levels
+from offload import spawn_workers
+from reduction import (
+    bin_image,
+    binned_shape,
+    channel_dtype,
+    channel_image,
+    channel_shape,
+    frame_channels
+)
+
+from logger import setup_logger
+log = setup_logger('products-logger', sys.stdout, 'products')
+
+KEOGRAM_NAME = 'keogram.hdf5'
+
+# for keeping the keogram up to date during the night; the files are read in
+# the background one at a time as they're closed, so no worker processes
+DEFAULT_KEOGRAM = dict(
+    column=None,
+    width=8,
+    n_workers=0,
+    chunk_size=16
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('outdir', help='directory with the night\'s files')
+parser.add_argument(
+    '--column',
+    type=int,
+    help='column of the middle of the keogram strip (default: the middle)'
+)
+parser.add_argument(
+    '--width',
+    type=int,
+    default=8,
+    help='number of columns averaged into the keogram strip'
+)
+parser.add_argument(
+    '--timelapse',
+    help='make a timelapse; a video file (made with ffmpeg) or a directory '
+        'for png frames'
+)
+parser.add_argument('--fps', type=int, default=24)
+parser.add_argument(
+    '--bin',
+    type=int,
+    default=4,
+    help='bin timelapse frames this many times in each direction'
+)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--chunk-size', type=int, default=16)
+parser.add_argument('--png', help='also plot the keogram to this png')
+
+
+def _keogram_config(config=None):
+    """ fill in the defaults for a `keogram` config entry; see
+    `make_products` for the keys
+    """
+    config = {**DEFAULT_KEOGRAM, **(config or {})}
+
+    unknown = set(config) - set(DEFAULT_KEOGRAM)
+    if unknown:
+        raise ValueError(f'unknown keogram keys {sorted(unknown)}')
+
+    return config
+
+
+def keogram_path(outdir):
+    return f'{outdir}/{KEOGRAM_NAME}'
+
+
+def _frame_attrs(dataset):
+    attrs = {}
+    for key, value in dataset.attrs.items():
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        attrs[key] = value
+    return attrs
+
+
+def _strip(n_cols, column=None, width=8):
+    """ the [start, stop) columns of the `channel_image` the keogram strip is
+    averaged over
+    """
+    if column is None:
+        column = n_cols // 2
+    start = min(max(column - width // 2, 0), n_cols - width)
+    return start, start + width
+
+
+def _stored_columns(frame_attrs, start, stop):
+    """ the columns of the stored frames that columns [start, stop) of their
+    `channel_image` come from
+    """
+    if frame_attrs['capture_mode'] == 'rgb':
+        return start, stop
+    if frame_attrs.get('packing') == 'packed12':
+        # every bayer pattern column is two pixels, packed into three bytes
+        return 3 * start, 3 * stop
+    return 2 * start, 2 * stop
+
+
+def _frame_rows(f):
+    """ the rows of an open exposure file that were written (whether or not
+    their frame was kept at full resolution), & their timestamps
+    """
+    if 'n_valid' in f.attrs:
+        timestamp = f['timestamp'][:_n_valid(f)]
+    else:
+        timestamp = f['timestamp'][:]
+
+    rows = np.flatnonzero(timestamp > 0)
+    return rows, timestamp[rows]
+
+
+def _kept(f, rows):
+    """ which of (sorted) `rows` have their frame stored at full resolution
+    (see `selection.FrameSelector`)
+    """
+    if 'selection' not in f:
+        return np.ones(len(rows), dtype=bool)
+    kept = f['selection'].fields('kept')[rows[0]:rows[-1] + 1]
+    return kept[rows - rows[0]]
+
+
+def _thumbnail_bin(f, image_shape):
+    """ how many times the `thumbnail`s of the exposure file `f` are binned,
+    from their size relative to frames whose `channel_image` is
+    `image_shape`
+    """
+    return image_shape[0] // f['thumbnail'].shape[1]
+
+
+def _resample(image, from_bin, to_bin, shape):
+    """ an image binned `from_bin` times, resampled (to the nearest pixel) to
+    `shape` pixels of one binned `to_bin` times
+    """
+    rows = np.minimum(
+        np.arange(shape[0]) * to_bin // from_bin, image.shape[0] - 1
+    )
+    cols = np.minimum(
+        np.arange(shape[1]) * to_bin // from_bin, image.shape[1] - 1
+    )
+    return image[rows][:, cols]
+
+
+def _chunks(path, first_row, chunk_size):
+    """ tasks for the workers: the rows of the file at `path` with frames,
+    from `first_row` on, in groups of up to `chunk_size`
+    """
+    with h5py.File(path, 'r') as f:
+        rows, _ = _frame_rows(f)
+
+    rows = rows[rows >= first_row]
+    return [
+        (path, rows[i:i + chunk_size]) for i in range(0, len(rows), chunk_size)
+    ]
+
+
+def to_rgb8(image, frame_attrs):
+    """ a (n_rows, n_cols, 3) uint8 picture of a `channel_image`, for
+    viewing; raw frames are scaled down to 8 bits & their greens averaged
+    """
+    if frame_attrs['capture_mode'] == 'rgb':
+        return image.astype(np.uint8, copy=False)
+
+    channels = frame_channels(frame_attrs)
+    index = {name: i for i, name in enumerate(channels)}
+    greens = [i for name, i in index.items() if name.startswith('g')]
+
+    rgb = np.stack([
+        image[..., index['r']],
+        image[..., greens].mean(axis=-1),
+        image[..., index['b']],
+    ], axis=-1)
+
+    scale = 2 ** (int(frame_attrs['bit_depth']) - 8)
+    return np.clip(rgb / scale, 0, 255).astype(np.uint8)
+
+
+def _timelapse_level(f, timelapse_bin):
+    """ the coarsest level the frames of the exposure file `f` are stored at
+    that timelapse frames binned `timelapse_bin` times can be made from
+    """
+    return max(
+        level for level in stored_levels(f) if timelapse_bin % level == 0
+    )
+
+
+def _process(path, rows, column=None, width=8, timelapse_bin=None):
+    """ runs in a worker: the timestamps, keogram strips &, if
+    `timelapse_bin` is given, binned timelapse frames of `rows` of an
+    exposure file. frames that weren't kept at full resolution are made from
+    their thumbnails instead
+    """
+    with h5py.File(path, 'r') as f:
+        dataset = f['exposure']
+        frame_attrs = _frame_attrs(dataset)
+        image_shape = channel_shape(dataset.shape[1:], frame_attrs)
+        strip = slice(*_strip(image_shape[1], column, width))
+        stored = slice(*_stored_columns(frame_attrs, strip.start, strip.stop))
+
+        level = None
+        if timelapse_bin is not None:
+            level = _timelapse_level(f, timelapse_bin)
+            frame_shape = binned_shape(image_shape, timelapse_bin)
+
+        kept = _kept(f, rows)
+        if not kept.all():
+            thumbnail_bin = _thumbnail_bin(f, image_shape)
+            # the thumbnail columns the strip overlaps, & the thumbnail row
+            # each row of the strip is in
+            start = strip.start // thumbnail_bin
+            thumbnail_strip = slice(
+                start, max(-(-strip.stop // thumbnail_bin), start + 1)
+            )
+            thumbnail_rows = np.minimum(
+                np.arange(image_shape[0]) // thumbnail_bin,
+                f['thumbnail'].shape[1] - 1
+            )
+
+        timestamp = f['timestamp'][rows[0]:rows[-1] + 1][rows - rows[0]]
+        strips, frames = [], []
+        for row, keep in zip(rows, kept):
+            if not keep:
+                thumbnail = f['thumbnail'][row]
+                strips.append(
+                    thumbnail[:, thumbnail_strip].mean(axis=1)[thumbnail_rows]
+                )
+                if level is not None:
+                    if timelapse_bin % thumbnail_bin == 0:
+                        image = bin_image(
+                            thumbnail, timelapse_bin // thumbnail_bin
+                        )
+                    else:
+                        image = _resample(
+                            thumbnail,
+                            thumbnail_bin,
+                            timelapse_bin,
+                            frame_shape
+                        )
+                    frames.append(to_rgb8(image, frame_attrs))
+                continue
+
+            if level == 1:
+                image = channel_image(dataset[row], frame_attrs)
+                strips.append(image[:, strip].mean(axis=1))
+            else:
+                # only the strip's columns are read out at full resolution
+                strips.append(channel_image(
+                    dataset[row, :, stored], frame_attrs
+                ).mean(axis=1))
+                if level is not None:
+                    image = f[level_key(level)][row]
+
+            if level is not None:
+                frames.append(to_rgb8(
+                    bin_image(image, timelapse_bin // level), frame_attrs
+                ))
+
+    return dict(
+        filename=os.path.basename(path),
+        rows=rows,
+        timestamp=timestamp,
+        strips=np.rint(np.stack(strips)).astype(channel_dtype(frame_attrs)),
+        frames=frames,
+        frame_attrs=frame_attrs
+    )
+
+
+def _in_order(executor, tasks, n_ahead, **kwargs):
+    """ yield the results of `_process`ing `tasks` in order, with at most
+    `n_ahead` of them being worked on or waiting at a time, so the results of
+    a whole night never pile up in memory
+    """
+    if executor is None:
+        for task in tasks:
+            yield _process(*task, **kwargs)
+        return
+
+    tasks = iter(tasks)
+    pending = [
+        executor.submit(_process, *task, **kwargs)
+        for task in itertools.islice(tasks, n_ahead)
+    ]
+    while pending:
+        result = pending.pop(0).result()
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(executor.submit(_process, *task, **kwargs))
+        yield result
+
+
+def _create_keogram(path, n_rows, n_channels, dtype, frame_attrs, column, width):
+    with h5py.File(path, 'w') as f:
+        f.create_dataset(
+            'timestamp', shape=(0,), maxshape=(None,), chunks=(1024,),
+            dtype=np.float64
+        )
+        f.create_dataset(
+            'keogram',
+            shape=(0, n_rows, n_channels),
+            maxshape=(None, n_rows, n_channels),
+            chunks=(64, n_rows, n_channels),
+            dtype=dtype,
+            compression='gzip',
+            shuffle=True
+        )
+        f['keogram'].attrs.update(
+            channels=frame_channels(frame_attrs),
+            column=-1 if column is None else column,
+            width=width
+        )
+        f.attrs['frame_attrs'] = json.dumps(frame_attrs)
+        # the number of rows of each exposure file that have been added
+        f.attrs['rows_done'] = json.dumps({})
+
+
+def _rows_done(outdir):
+    if not os.path.isfile(keogram_path(outdir)):
+        return {}
+    with h5py.File(keogram_path(outdir), 'r') as f:
+        return json.loads(f.attrs['rows_done'])
+
+
+class Timelapse:
+    """ writes frames to a video through an ffmpeg pipe or, if `path` has no
+    extension, to numbered pngs in the directory `path` through a single
+    reused matplotlib figure
+
+        with Timelapse('night.mp4', fps=24) as timelapse:
+            for frame in frames:
+                timelapse.write(frame)
+
+    frames: (n_rows, n_cols, 3) uint8 arrays, all the same shape
+    png_name: name of each png, formatted with the frame's number
+    """
+
+    def __init__(self, path, fps=24, png_name='{:06d}.png'):
+        self.path = path
+        self.fps = fps
+        self.png_name = png_name
+        self.n_frames = 0
+
+        self._ffmpeg = None
+        self._figure = None
+        self._image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _start_ffmpeg(self, shape):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError(
+                'ffmpeg isn\'t installed; give a directory for png frames '
+                'instead'
+            )
+
+        n_rows, n_cols, _ = shape
+        self._ffmpeg = subprocess.Popen(
+            [
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                '-s', f'{n_cols}x{n_rows}', '-r', str(self.fps),
+                '-i', '-',
+                '-pix_fmt', 'yuv420p', '-vcodec', 'libx264',
+                self.path
+            ],
+            stdin=subprocess.PIPE
+        )
+
+    def _start_figure(self, frame):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        os.makedirs(self.path, exist_ok=True)
+
+        n_rows, n_cols, _ = frame.shape
+        dpi = 100
+        self._figure = Figure(figsize=(n_cols / dpi, n_rows / dpi), dpi=dpi)
+        FigureCanvasAgg(self._figure)
+        ax = self._figure.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        self._image = ax.imshow(frame)
+
+    def write(self, frame):
+        # yuv420p video needs an even number of rows & columns
+        frame = frame[:frame.shape[0] // 2 * 2, :frame.shape[1] // 2 * 2]
+
+        if os.path.splitext(self.path)[1]:
+            if self._ffmpeg is None:
+                self._start_ffmpeg(frame.shape)
+            self._ffmpeg.stdin.write(np.ascontiguousarray(frame).tobytes())
+        else:
+            if self._figure is None:
+                self._start_figure(frame)
+            self._image.set_data(frame)
+            self._figure.savefig(
+                f'{self.path}/{self.png_name.format(self.n_frames)}'
+            )
+
+        self.n_frames += 1
+
+    def close(self):
+        if self._ffmpeg is not None:
+            self._ffmpeg.stdin.close()
+            if self._ffmpeg.wait() != 0:
+                log.error(f'ffmpeg failed making {self.path}')
+            self._ffmpeg = None
+        log.info(f'wrote {self.n_frames} frames to {self.path}')
+
+
+def start_workers(n_workers):
+    """ a pool of `n_workers` worker processes for `make_products`, all
+    started by the time it's returned (see `offload.spawn_workers`). even a
+    spawned worker holds on to the process's open files (& their hdf5 locks)
+    for a moment as it starts, so while a night is being written, start them
+    before any of its files are made & keep reusing them
+    """
+    return spawn_workers(n_workers)
+
+
+# only one update of a night's keogram at a time
+_lock = threading.Lock()
+
+
+def make_products(
+    outdir,
+    paths=None,
+    column=None,
+    width=8,
+    timelapse=None,
+    fps=24,
+    timelapse_bin=4,
+    n_workers=4,
+    chunk_size=16,
+    executor=None
+):
+    """ add the frames of a night that aren't in its keogram yet to it, &
+    optionally make a timelapse of the whole night
+
+    paths: exposure files to add; all of the night's by default
+    column, width: the keogram strip is the mean of the `width` columns
+        around `column` (in bayer patterns, for raw frames)
+    timelapse: None, or the path of a video or directory (see `Timelapse`)
+    timelapse_bin: int, bin timelapse frames this many times in each
+        direction; they're made from the coarsest binned frames stored (see
+        `reduction.FramePyramid`) this is a multiple of
+    n_workers: int, worker processes to read the files in; 0 to read them in
+        this thread
+    chunk_size: int, frames read at a time by each worker
+    executor: a pool from `start_workers` to read the files in, rather than
+        starting (& stopping) `n_workers` new worker processes
+    """
+    with _lock:
+        paths = paths if paths is not None else night_files(outdir, 'exposures')
+
+        keogram_done = _rows_done(outdir)
+
+        # a timelapse needs every frame; the keogram only the new ones
+        start = {} if timelapse is not None else keogram_done
+        tasks = []
+        for path in paths:
+            tasks += _chunks(
+                path, start.get(os.path.basename(path), 0), chunk_size
+            )
+
+        if not tasks:
+            log.info(f'no new frames for the products of {outdir}')
+            return
+
+        writer = None if timelapse is None else Timelapse(timelapse, fps)
+        try:
+            with _workers(executor, n_workers) as executor:
+                for result in _in_order(
+                    executor,
+                    tasks,
+                    2 * max(n_workers, 1),
+                    column=column,
+                    width=width,
+                    timelapse_bin=None if timelapse is None else timelapse_bin
+                ):
+                    for frame in result['frames']:
+                        writer.write(frame)
+                    _add_to_keogram(
+                        outdir, result, keogram_done, column, width
+                    )
+        finally:
+            if writer is not None:
+                writer.close()
+
+        with h5py.File(keogram_path(outdir), 'r') as f:
+            n_frames = f['timestamp'].shape[0]
+
+    log.info(f'keogram of {outdir} now has {n_frames} frames')
+
+
+def make_timelapse(
+    outdir,
+    timelapse,
+    paths=None,
+    fps=24,
+    timelapse_bin=4,
+    n_workers=4,
+    chunk_size=16,
+    executor=None,
+    png_name='{:06d}.png'
+):
+    """ make a timelapse of a night (see `make_products` for the
+    arguments), leaving its keogram as it is
+    """
+    paths = paths if paths is not None else night_files(outdir, 'exposures')
+
+    tasks = []
+    for path in paths:
+        tasks += _chunks(path, 0, chunk_size)
+
+    with _workers(executor, n_workers) as executor:
+        with Timelapse(timelapse, fps, png_name) as writer:
+            for result in _in_order(
+                executor,
+                tasks,
+                2 * max(n_workers, 1),
+                timelapse_bin=timelapse_bin
+            ):
+                for frame in result['frames']:
+                    writer.write(frame)
+
+
+@contextmanager
+def _workers(executor, n_workers):
+    """ `executor`, or if it's None, `n_workers` new worker processes that
+    are stopped on the way out (or None, for none)
+    """
+    own_executor = executor is None and n_workers > 0
+    if own_executor:
+        executor = start_workers(n_workers)
+
+    try:
+        yield executor
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def _add_to_keogram(outdir, result, rows_done, column, width):
+    """ append a worker's strips to the keogram, skipping any of the frames
+    that are already in it, & note them in `rows_done`
+    """
+    path = keogram_path(outdir)
+    strips = result['strips']
+    if not os.path.isfile(path):
+        _create_keogram(
+            path,
+            *strips.shape[1:],
+            strips.dtype,
+            result['frame_attrs'],
+            column,
+            width
+        )
+
+    filename, rows = result['filename'], result['rows']
+    new = rows >= rows_done.get(filename, 0)
+    if not new.any():
+        return
+
+    # the rows are noted as done along with adding them, so a run that's
+    # stopped partway doesn't add them again the next time
+    with h5py.File(path, 'r+') as f:
+        for key, values in [
+            ('timestamp', result['timestamp'][new]),
+            ('keogram', strips[new])
+        ]:
+            n = f[key].shape[0]
+            f[key].resize(n + len(values), axis=0)
+            f[key][n:] = values
+
+        rows_done[filename] = int(rows[-1]) + 1
+        f.attrs['rows_done'] = json.dumps(rows_done)
+
+
+def read_keogram(outdir):
+    """ the timestamps & strips of a night's keogram, in time order """
+    with h5py.File(keogram_path(outdir), 'r') as f:
+        timestamp = f['timestamp'][:]
+        keogram = f['keogram'][:]
+
+    order = np.argsort(timestamp, kind='stable')
+    return timestamp[order], keogram[order]
+
+
+def _time_grid(timestamp, keogram, interval=None):
+    """ a keogram's strips put on a regular grid of times, `interval`
+    seconds apart (by default, the usual time between frames), so time runs
+    evenly across it & gaps in the night show as blank columns. returns the
+    times & the (n_times, n_rows, n_channels) strips
+    """
+    if interval is None:
+        interval = np.median(np.diff(timestamp)) if len(timestamp) > 1 else 1
+
+    n_times = int(round((timestamp[-1] - timestamp[0]) / interval)) + 1
+    times = timestamp[0] + interval * np.arange(n_times)
+
+    # the last strip up to half an interval after each time, if it's within
+    # half an interval of it
+    nearest = np.maximum(
+        np.searchsorted(timestamp, times + interval / 2, side='right') - 1, 0
+    )
+    present = np.abs(timestamp[nearest] - times) <= interval / 2
+
+    grid = np.zeros((n_times, *keogram.shape[1:]), dtype=keogram.dtype)
+    grid[present] = keogram[nearest[present]]
+    return times, grid
+
+
+def plot_keogram(outdir, path):
+    """ save a picture of a night's keogram to `path`, against (utc) time,
+    running left to right
+    """
+    from datetime import datetime, timezone
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    with h5py.File(keogram_path(outdir), 'r') as f:
+        frame_attrs = json.loads(f.attrs['frame_attrs'])
+    times, keogram = _time_grid(*read_keogram(outdir))
+
+    image = to_rgb8(keogram, frame_attrs).transpose(1, 0, 2)
+    interval = times[1] - times[0] if len(times) > 1 else 1
+    start, stop = [
+        mdates.date2num(datetime.fromtimestamp(t, timezone.utc))
+        for t in (times[0] - interval / 2, times[-1] + interval / 2)
+    ]
+
+    fig, ax = plt.subplots(figsize=(12, 4))
+    ax.imshow(
+        image,
+        aspect='auto',
+        origin='upper',
+        extent=[start, stop, image.shape[0], 0]
+    )
+    ax.xaxis_date()
+    ax.set_xlabel('time (utc)')
+    ax.set_ylabel('row (north-south)')
+    fig.savefig(path)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    make_products(
+        args.outdir,
+        column=args.column,
+        width=args.width,
+        timelapse=args.timelapse,
+        fps=args.fps,
+        timelapse_bin=args.bin,
+        n_workers=args.workers,
+        chunk_size=args.chunk_size
+    )
+
+    if args.png is not None:
+        plot_keogram(args.outdir, args.png)
@@ -0,0 +1,260 @@
+""" recover hourly files that weren't closed cleanly, eg because the pi lost
+power in the middle of a night:
+
+    python recover.py /media/usb_drive/2025-01-01/3-exposures.hdf5
+    python recover.py /media/usb_drive/2025-01-01
+
+(a directory recovers every hourly file in it.) hdf5 won't open a file for
+writing that was left open by a writer, so its status flags are cleared first,
+like `h5clear -s` does. then each dataset is cut back in place to the last
+row that was completely written; nothing else in the file is rewritten, so
+the space the cut off rows took up isn't given back. recovered exposure files
+are (re)added to the night's catalog.
+
+don't run it on files that are still being written.
+"""
+import os
+import sys
+import glob
+import argparse
+
+import h5py
+import numpy as np
+
+from catalog import add_to_catalog
+from data import level_key, stored_levels
+
+from logger import setup_logger
+log = setup_logger('recover-logger', sys.stdout, 'recover')
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# the rows of an exposure file are spread over these datasets, & the binned
+# frames (see `reduction.FramePyramid`)
+EXPOSURE_ROW_DATASETS = [
+    'timestamp', 'tick', 'jitter', 'exposure', 'stats', 'thumbnail', 'selection'
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    'paths',
+    nargs='+',
+    help='hourly hdf5 files, or directories of them, to recover'
+)
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & 0xFFFFFFFF
+
+
+def _lookup3(data, initval=0):
+    """ bob jenkins' lookup3 hash, which hdf5 checksums its metadata with """
+    mask = 0xFFFFFFFF
+    length = len(data)
+    a = b = c = (0xDEADBEEF + length + initval) & mask
+
+    def word(i):
+        return int.from_bytes(data[i:i + 4], 'little')
+
+    i = 0
+    while length - i > 12:
+        a = (a + word(i)) & mask
+        b = (b + word(i + 4)) & mask
+        c = (c + word(i + 8)) & mask
+
+        a = (a - c) & mask; a ^= _rot(c, 4); c = (c + b) & mask
+        b = (b - a) & mask; b ^= _rot(a, 6); a = (a + c) & mask
+        c = (c - b) & mask; c ^= _rot(b, 8); b = (b + a) & mask
+        a = (a - c) & mask; a ^= _rot(c, 16); c = (c + b) & mask
+        b = (b - a) & mask; b ^= _rot(a, 19); a = (a + c) & mask
+        c = (c - b) & mask; c ^= _rot(b, 4); b = (b + a) & mask
+
+        i += 12
+
+    if length - i == 0:
+        return c
+
+    # the last 1-12 bytes, zero padded
+    data = data[i:] + bytes(12 - (length - i))
+    a = (a + word(0)) & mask
+    b = (b + word(4)) & mask
+    c = (c + word(8)) & mask
+
+    c ^= b; c = (c - _rot(b, 14)) & mask
+    a ^= c; a = (a - _rot(c, 11)) & mask
+    b ^= a; b = (b - _rot(a, 25)) & mask
+    c ^= b; c = (c - _rot(b, 16)) & mask
+    a ^= c; a = (a - _rot(c, 4)) & mask
+    b ^= a; b = (b - _rot(a, 14)) & mask
+    c ^= b; c = (c - _rot(b, 24)) & mask
+
+    return c
+
+
+def _find_superblock(f):
+    """ offset of the superblock; it's after the user block, if there is one,
+    which is 0 or 512, 1024, 2048... bytes long
+    """
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + len(HDF5_SIGNATURE) <= size:
+        f.seek(offset)
+        if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+            return offset
+        offset = 512 if offset == 0 else 2 * offset
+
+    raise ValueError(f'{f.name} is not an hdf5 file')
+
+
+def clear_status_flags(path):
+    """ clear the flags hdf5 sets in the superblock of a file while it's open
+    for writing (as `h5clear -s` does), so a file a writer never closed can be
+    opened again. returns whether there were any to clear
+    """
+    with open(path, 'r+b') as f:
+        offset = _find_superblock(f)
+
+        f.seek(offset)
+        header = bytearray(f.read(12))
+        version, size_of_offsets, flags = header[8], header[9], header[11]
+        if version < 2 or flags == 0:
+            # older superblocks don't have the flags
+            return False
+
+        # signature, version, sizes & flags, then 4 addresses & the checksum
+        header += f.read(4 * size_of_offsets)
+        checksum = int.from_bytes(f.read(4), 'little')
+        if _lookup3(bytes(header)) != checksum:
+            raise ValueError(
+                f'superblock checksum of {path} doesn\'t match; try '
+                '`h5clear -s` instead'
+            )
+
+        header[11] = 0
+        f.seek(offset)
+        f.write(header)
+        f.write(_lookup3(bytes(header)).to_bytes(4, 'little'))
+
+    log.info(f'cleared status flags of {path}')
+    return True
+
+
+def _last_written(timestamp):
+    """ the number of rows up to & including the last one with a timestamp """
+    written = np.flatnonzero(timestamp > 0)
+    return int(written[-1]) + 1 if len(written) else 0
+
+
+def _readable(dataset, row):
+    try:
+        dataset[row]
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _row_datasets(f):
+    """ the datasets of the exposure file `f` with a row per frame """
+    return [key for key in EXPOSURE_ROW_DATASETS if key in f] + [
+        level_key(level) for level in stored_levels(f)[1:]
+    ]
+
+
+def _exposure_rows(f):
+    """ number of complete rows in an exposure file. the timestamp is the last
+    part of a row to be written, so a row with one is complete, as long as
+    its frame can actually be read back
+    """
+    # the frames are short when the last ones weren't kept
+    frames = [level_key(level) for level in stored_levels(f)]
+    n_rows = min(
+        f[key].shape[0] for key in _row_datasets(f) if key not in frames
+    )
+    n_keep = _last_written(f['timestamp'][:n_rows])
+
+    while (
+        n_keep > 0
+        and n_keep <= f['exposure'].shape[0]
+        and not _readable(f['exposure'], n_keep - 1)
+    ):
+        log.warning(f'frame {n_keep - 1} of {f.filename} is unreadable')
+        n_keep -= 1
+
+    return n_keep
+
+
+def _resize(dataset, n_rows):
+    if dataset.shape[0] != n_rows:
+        log.info(
+            f'cutting {dataset.name} of {dataset.file.filename} from '
+            f'{dataset.shape[0]} to {n_rows} rows'
+        )
+        dataset.resize(n_rows, axis=0)
+
+
+def recover_file(path):
+    """ cut the datasets of the hourly file at `path` back to their last
+    complete row, in place. returns the number of rows kept, by dataset
+    """
+    clear_status_flags(path)
+
+    kept = {}
+    with h5py.File(path, 'r+') as f:
+        if 'exposure' in f:
+            n_keep = _exposure_rows(f)
+            for key in _row_datasets(f):
+                _resize(f[key], n_keep)
+                kept[key] = n_keep
+
+            f.attrs['n_valid'] = n_keep
+            timestamp = f['timestamp'][:n_keep]
+            timestamp = timestamp[timestamp > 0]
+            if 'start_timestamp' not in f.attrs and len(timestamp):
+                f.attrs['start_timestamp'] = timestamp[0]
+        else:
+            if 'measurements' in f:
+                dataset = f['measurements']
+                n_keep = _last_written(dataset.fields('timestamp')[:])
+                _resize(dataset, n_keep)
+                kept['measurements'] = n_keep
+
+            if 'magnetic_field_stream' in f:
+                dataset = f['magnetic_field_stream']
+                n_keep = _last_written(dataset[:, 0])
+                _resize(dataset, n_keep)
+                kept['magnetic_field_stream'] = n_keep
+
+    if 'exposure' in kept:
+        add_to_catalog(path)
+
+    log.info(f'recovered {path}: kept {kept}')
+    return kept
+
+
+def recover(paths):
+    """ recover each file in `paths`; directories recover every hourly file
+    in them. returns {path: rows kept, by dataset}
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                glob.glob(f'{path}/*-exposures*.hdf5')
+                + glob.glob(f'{path}/*-measurements*.hdf5')
+            )
+        else:
+            files.append(path)
+
+    recovered = {}
+    for path in files:
+        try:
+            recovered[path] = recover_file(path)
+        except Exception as e:
+            log.error(f'failed to recover {path}: {e}')
+
+    return recovered
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    recover(args.paths)
@@ -0,0 +1,288 @@
+""" per-frame statistics, computed as each frame is taken & stored in the
+`stats` dataset next to `exposure`, so a night can be scanned for activity or
+clouds by reading a few kilobytes per file rather than every frame:
+
+    timestamp, stats = read_night_stats('/media/usb_drive/2025-01-01')
+    cloudy = timestamp[stats['median'][:, 1] > 40]
+
+each frame's record (see `stats_dtype`) has, for every channel, the mean,
+median, a set of percentiles, the number of saturated pixels & a coarse
+histogram.
+"""
+import sys
+
+import h5py
+import numpy as np
+
+from data import _n_valid, level_key, night_files, unpack_12bit
+
+from logger import setup_logger
+log = setup_logger('reduction-logger', sys.stdout, 'reduction')
+
+PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+N_HISTOGRAM_BINS = 32
+
+# frames are histogrammed this many rows at a time, to keep the temporary
+# arrays small
+BLOCK_ROWS = 128
+
+
+def frame_channels(frame_attrs):
+    """ names of the channels of frames laid out like `frame_attrs` (see
+    `measure.get_frame_attrs`): r, g & b for rgb frames, or one for each site
+    of the bayer pattern of raw frames, eg r, g1, g2 & b for RGGB
+    """
+    if frame_attrs['capture_mode'] == 'rgb':
+        return ['r', 'g', 'b']
+
+    sites = frame_attrs['bayer_order'].lower()
+    return [
+        f'{site}{sites[:i + 1].count(site)}' if sites.count(site) > 1 else site
+        for i, site in enumerate(sites)
+    ]
+
+
+def channel_image(frame, frame_attrs):
+    """ a (n_rows, n_cols, n_channels) view (or copy, for packed frames) of
+    `frame`, with the channels of `frame_channels`. each 2x2 bayer pattern of
+    a raw frame becomes one pixel with a channel for each of its sites
+    """
+    if frame_attrs['capture_mode'] == 'rgb':
+        return frame
+
+    if frame_attrs.get('packing') == 'packed12':
+        frame = unpack_12bit(frame)
+
+    # an odd row or column out wouldn't have a full bayer pattern
+    n_rows, n_cols = (frame.shape[0] // 2) * 2, (frame.shape[1] // 2) * 2
+    return frame[:n_rows, :n_cols].reshape(
+        n_rows // 2, 2, n_cols // 2, 2
+    ).transpose(0, 2, 1, 3).reshape(n_rows // 2, n_cols // 2, 4)
+
+
+def channel_shape(frame_shape, frame_attrs):
+    """ shape of the `channel_image` of frames with shape `frame_shape` """
+    if frame_attrs['capture_mode'] == 'rgb':
+        return tuple(frame_shape)
+
+    n_rows, n_cols = frame_shape
+    if frame_attrs.get('packing') == 'packed12':
+        n_cols = n_cols * 2 // 3
+    return (n_rows // 2, n_cols // 2, 4)
+
+
+def channel_dtype(frame_attrs):
+    """ dtype that holds a pixel value of frames laid out like `frame_attrs` """
+    return np.dtype(np.uint8 if frame_attrs['bit_depth'] <= 8 else np.uint16)
+
+
+def binned_shape(image_shape, factor):
+    n_rows, n_cols, n_channels = image_shape
+    return (n_rows // factor, n_cols // factor, n_channels)
+
+
+def _bin_sums(image, factor):
+    """ the (uint32) sum of each `factor` x `factor` block of pixels of a
+    `channel_image`, or of an array of such sums
+    """
+    n_rows, n_cols, n_channels = binned_shape(image.shape, factor)
+    image = image[:n_rows * factor, :n_cols * factor]
+
+    # summing strided slices is several times faster than summing over the
+    # axes of a (n_rows, factor, n_cols, factor, n_channels) view
+    rows = np.zeros((n_rows, n_cols * factor, n_channels), dtype=np.uint32)
+    for i in range(factor):
+        rows += image[i::factor]
+    sums = np.zeros((n_rows, n_cols, n_channels), dtype=np.uint32)
+    for j in range(factor):
+        sums += rows[:, j::factor]
+    return sums
+
+
+def _mean(sums, factor, dtype):
+    binned = sums / factor**2
+    if np.issubdtype(dtype, np.integer):
+        binned = np.rint(binned)
+    return binned.astype(dtype)
+
+
+def bin_image(image, factor, dtype=None):
+    """ the mean of each `factor` x `factor` block of pixels of a
+    `channel_image`; rows & columns left over at the edges are dropped
+
+    dtype: of the result; that of `image` by default
+    """
+    return _mean(_bin_sums(image, factor), factor, dtype or image.dtype)
+
+
+class FramePyramid:
+    """ bins each frame to a few coarser resolutions, to be stored next to
+    `exposure` (in the datasets named by `level_key`) so frames can be
+    browsed without reading them at full resolution:
+
+        pyramid = FramePyramid(frame_attrs, frame_shape, levels=[2, 4])
+        binned = pyramid(frame)    # {'binned2': ..., 'binned4': ...}
+
+    each level is a `channel_image`, binned `level` x `level` (see
+    `bin_image`). levels count pixels of the channel image, not of the
+    sensor: for raw frames, whose channel image has a pixel per 2x2 bayer
+    pattern, `binned2` covers 4x4 sensor pixels. the finer levels' sums are
+    binned again for the coarser ones they divide, so the full frame is only
+    summed once.
+
+    frame_attrs: how the frames are laid out; see `measure.get_frame_attrs`
+    frame_shape: shape of a single frame
+    levels: bin factors, each at least 2
+    """
+
+    def __init__(self, frame_attrs, frame_shape, levels=(2, 4)):
+        self.frame_attrs = frame_attrs
+        self.levels = sorted(set(levels))
+        if any(level < 2 for level in self.levels):
+            raise ValueError('pyramid levels must be at least 2')
+
+        image_shape = channel_shape(frame_shape, frame_attrs)
+        self.shapes = {
+            level_key(level): binned_shape(image_shape, level)
+            for level in self.levels
+        }
+        self.dtype = channel_dtype(frame_attrs)
+
+    def __call__(self, frame):
+        image = channel_image(frame, self.frame_attrs)
+
+        binned = {}
+        sums, summed = image, 1
+        for level in self.levels:
+            if level % summed:
+                sums, summed = image, 1
+            sums = _bin_sums(sums, level // summed)
+            summed = level
+            binned[level_key(level)] = _mean(sums, level, self.dtype)
+
+        return binned
+
+
+def stats_dtype(
+    n_channels, n_percentiles=len(PERCENTILES), n_bins=N_HISTOGRAM_BINS
+):
+    return np.dtype([
+        ('mean', np.float32, (n_channels,)),
+        ('median', np.float32, (n_channels,)),
+        ('percentiles', np.float32, (n_channels, n_percentiles)),
+        ('n_saturated', np.int64, (n_channels,)),
+        ('histogram', np.int32, (n_channels, n_bins)),
+    ])
+
+
+class FrameReducer:
+    """ reduces frames from `measure.take_single_exposure` to a `stats_dtype`
+    record each:
+
+        reducer = FrameReducer(frame_attrs)
+        stats = reducer(frame)
+
+    everything is worked out from a histogram of every pixel value, so the
+    median & percentiles (by nearest rank) are exact without sorting the
+    frame.
+
+    frame_attrs: how the frames are laid out; see `measure.get_frame_attrs`
+    percentiles: list of percentiles to store
+    n_bins: int, number of bins in the stored histogram; must divide the
+        number of possible pixel values
+    """
+
+    def __init__(
+        self, frame_attrs, percentiles=PERCENTILES, n_bins=N_HISTOGRAM_BINS
+    ):
+        self.frame_attrs = frame_attrs
+        self.channels = frame_channels(frame_attrs)
+        self.n_values = 2 ** int(frame_attrs['bit_depth'])
+        self.percentiles = np.asarray(percentiles, dtype=float)
+        self.n_bins = n_bins
+
+        if self.n_values % n_bins:
+            raise ValueError(f'n_bins must divide {self.n_values}')
+
+        self.dtype = stats_dtype(len(self.channels), len(percentiles), n_bins)
+        self.attrs = dict(
+            channels=self.channels,
+            percentiles=self.percentiles,
+            histogram_edges=np.linspace(0, self.n_values, n_bins + 1)
+        )
+
+        # each channel's values are counted in their own range of bins
+        self._offsets = np.arange(len(self.channels)) * self.n_values
+
+    def _pixels(self, block):
+        """ (n_pixels, n_channels) values of a block of rows """
+        return channel_image(block, self.frame_attrs).reshape(
+            -1, len(self.channels)
+        )
+
+    def histograms(self, frame):
+        """ (n_channels, n_values) counts of every pixel value in `frame` """
+        n_channels = len(self.channels)
+        counts = np.zeros(n_channels * self.n_values, dtype=np.int64)
+
+        for i in range(0, frame.shape[0], BLOCK_ROWS):
+            pixels = self._pixels(frame[i:i + BLOCK_ROWS])
+            counts += np.bincount(
+                np.add(pixels, self._offsets, dtype=np.intp).ravel(),
+                minlength=len(counts)
+            )
+
+        return counts.reshape(n_channels, self.n_values)
+
+    def __call__(self, frame):
+        histograms = self.histograms(frame)
+
+        n_pixels = histograms.sum(axis=1)
+        cumulative = np.cumsum(histograms, axis=1)
+
+        def ranks(percentiles):
+            # the smallest value at least `percentile`% of pixels are <=
+            targets = np.maximum(
+                np.ceil(n_pixels[:, None] * percentiles / 100), 1
+            )
+            return np.stack([
+                np.searchsorted(cumulative[i], targets[i])
+                for i in range(len(self.channels))
+            ])
+
+        stats = np.zeros((), dtype=self.dtype)
+        stats['mean'] = (
+            histograms @ np.arange(self.n_values) / np.maximum(n_pixels, 1)
+        )
+        stats['median'] = ranks(np.array([50.]))[:, 0]
+        stats['percentiles'] = ranks(self.percentiles)
+        stats['n_saturated'] = histograms[:, -1]
+        stats['histogram'] = histograms.reshape(
+            len(self.channels), self.n_bins, -1
+        ).sum(axis=2)
+
+        return stats
+
+
+def read_night_stats(outdir):
+    """ the timestamps & stats records of all of a night's frames, in time
+    order, without reading any of the frames themselves
+    """
+    timestamps, stats = [], []
+    for path in night_files(outdir, 'exposures'):
+        with h5py.File(path, 'r') as f:
+            if 'stats' not in f:
+                log.warning(f'{path} has no frame stats')
+                continue
+
+            n_valid = _n_valid(f) if 'n_valid' in f.attrs else None
+            timestamp = f['timestamp'][:n_valid]
+            mask = timestamp > 0
+
+            timestamps.append(timestamp[mask])
+            stats.append(f['stats'][:n_valid][mask])
+
+    if not stats:
+        return np.zeros((0,)), None
+
+    return np.concatenate(timestamps), np.concatenate(stats)
@@ -0,0 +1,140 @@
+import sys
+
+from clock import real_clock
+
+from logger import setup_logger
+log = setup_logger('scheduling-logger', sys.stdout, 'scheduling')
+
+OVERRUN_POLICIES = ['skip', 'catch_up']
+
+
+class Schedule:
+    """ a fixed grid of ticks, t0 + tick * interval, on the monotonic clock,
+    so ticks stay evenly spaced no matter how long the work between them
+    takes, and aren't moved by steps in the wall clock (eg from ntp or
+    `hwclock --hctosys`).
+
+        async for tick in Schedule(interval, n_ticks=100):
+            ...
+
+    waits until each tick's slot before yielding it; `slot(tick)` is the
+    monotonic time it was due. a tick that starts more than `late_tolerance`
+    seconds after its slot is counted as late.
+
+    interval: float, seconds between ticks
+    n_ticks: int, stop after this many ticks (skipped ones included), or None
+        to go on forever
+    overrun: what to do about ticks whose slots have passed entirely by the
+        time the previous tick is done;
+        'skip': count them as missed & go straight to the current slot
+        'catch_up': run them back to back until back on the grid
+    clock: the `clock.Clock` to schedule against; the real one by default
+    """
+
+    def __init__(
+        self,
+        interval,
+        n_ticks=None,
+        overrun='skip',
+        late_tolerance=0.1,
+        name='schedule',
+        clock=None
+    ):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(f'overrun must be one of {OVERRUN_POLICIES}')
+
+        self.interval = interval
+        self.n_ticks = n_ticks
+        self.overrun = overrun
+        self.late_tolerance = late_tolerance
+        self.name = name
+        self.clock = clock or real_clock
+
+        self.t0 = None
+        self.n_run = 0
+        self.n_late = 0
+        self.n_missed = 0
+        self.max_lateness = 0.
+        self.total_lateness = 0.
+
+    def slot(self, tick):
+        return self.t0 + tick * self.interval
+
+    def __aiter__(self):
+        return self._ticks()
+
+    async def _ticks(self):
+        self.t0 = self.clock.monotonic()
+        tick = 0
+
+        while self.n_ticks is None or tick < self.n_ticks:
+            delay = self.slot(tick) - self.clock.monotonic()
+            if delay > 0:
+                await self.clock.async_sleep(delay)
+
+            lateness = self.clock.monotonic() - self.slot(tick)
+            if lateness >= self.interval and self.overrun == 'skip':
+                missed = int(lateness // self.interval)
+                self.n_missed += missed
+                tick += missed
+                lateness -= missed * self.interval
+                log.warning(
+                    f'{self.name} missed {missed} tick(s) '
+                    f'({self.n_missed} missed so far)'
+                )
+                if self.n_ticks is not None and tick >= self.n_ticks:
+                    break
+
+            if lateness > self.late_tolerance:
+                self.n_late += 1
+                log.debug(f'{self.name} tick {tick} late by {lateness:.3f}s')
+
+            self.max_lateness = max(self.max_lateness, lateness)
+            self.total_lateness += lateness
+
+            yield tick
+            self.n_run += 1
+            tick += 1
+
+    def summary(self):
+        mean_lateness = self.total_lateness / max(self.n_run, 1)
+        return (
+            f'{self.name}: {self.n_run} ticks, {self.n_late} late, '
+            f'{self.n_missed} missed, mean lateness = {mean_lateness:.3f}s, '
+            f'max lateness = {self.max_lateness:.3f}s'
+        )
+
+
+class PeriodicSampler:
+    """ calls `sample(tick)` on a `Schedule`, so samples are evenly spaced no
+    matter how long each one takes (as long as it's shorter than `interval`).
+    if a sample overruns whole slots, those ticks are skipped rather than run
+    back to back.
+
+    sample: coroutine function called like `sample(tick)`
+    interval: float, seconds between ticks
+    """
+
+    def __init__(
+        self,
+        sample,
+        interval,
+        name='sampler',
+        late_tolerance=0.1,
+        clock=None
+    ):
+        self.sample = sample
+        self.schedule = Schedule(
+            interval,
+            overrun='skip',
+            late_tolerance=late_tolerance,
+            name=name,
+            clock=clock
+        )
+
+    async def run(self):
+        async for tick in self.schedule:
+            await self.sample(tick)
+
+    def summary(self):
+        return self.schedule.summary()
@@ -0,0 +1,188 @@
+""" decides as frames are taken which of them are worth storing at full
+resolution, so a night of mostly quiet sky doesn't fill the usb drive. every
+frame gets a binned thumbnail (the `thumbnail` dataset) & a record of the
+decision & the scores it was made on (the `selection` dataset); only the
+frames that are kept are stored in `exposure`.
+"""
+import sys
+import threading
+from functools import partial
+
+import numpy as np
+
+from reduction import (
+    bin_image,
+    binned_shape,
+    channel_dtype,
+    channel_image,
+    channel_shape
+)
+
+from logger import setup_logger
+log = setup_logger('selection-logger', sys.stdout, 'selection')
+
+SELECTION_DTYPE = np.dtype([
+    ('kept', np.bool_),
+    # mean absolute difference from the background, as a fraction of the
+    # background's mean
+    ('change', np.float32),
+    # mean pixel value of the thumbnail
+    ('brightness', np.float32),
+])
+
+DEFAULT_SELECTION = dict(
+    bin=8,
+    change_threshold=0.05,
+    brightness_threshold=None,
+    background_weight=0.05,
+    keep_every=0
+)
+
+
+def _selection_config(config=None):
+    """ fill in the defaults for a `frame_selection` config entry; see
+    `FrameSelector` for the keys
+    """
+    config = {**DEFAULT_SELECTION, **(config or {})}
+
+    unknown = set(config) - set(DEFAULT_SELECTION)
+    if unknown:
+        raise ValueError(f'unknown frame_selection keys {sorted(unknown)}')
+
+    return config
+
+
+def _thumbnail(frame, frame_attrs, bin, dtype):
+    return bin_image(channel_image(frame, frame_attrs), bin, dtype)
+
+
+class FrameSelector:
+    """ compares a binned thumbnail of each frame against a running model of
+    the background (an exponential moving average of the thumbnails so far),
+    & decides whether the full frame should be kept:
+
+        selector = FrameSelector(frame_attrs, frame_shape, change_threshold=0.1)
+        keep, thumbnail, selection = selector(frame)
+
+    or in two steps, so the thumbnail can be made in another process:
+
+        thumbnail = selector.thumbnailer(frame)
+        keep, selection = selector.decide(thumbnail)
+
+    a frame is kept if it's the first, or if
+        its change, the mean absolute difference between its thumbnail & the
+            background as a fraction of the background's mean, is at least
+            `change_threshold`
+        or the mean of its thumbnail is at least `brightness_threshold`
+        or `keep_every` frames have gone by since the last one kept
+
+    frame_attrs: how the frames are laid out; see `measure.get_frame_attrs`
+    frame_shape: shape of a single frame
+    bin: int, thumbnails are the mean of each `bin` x `bin` block of pixels
+        (of bayer patterns, for raw frames; see `reduction.channel_image`)
+    change_threshold: float
+    brightness_threshold: float in pixel values, or None
+    background_weight: float, how much each frame counts towards the
+        background model; about 1 / the number of frames it remembers
+    keep_every: int, 0 to only keep frames on their merits
+    """
+
+    def __init__(
+        self,
+        frame_attrs,
+        frame_shape,
+        bin=8,
+        change_threshold=0.05,
+        brightness_threshold=None,
+        background_weight=0.05,
+        keep_every=0
+    ):
+        self.frame_attrs = frame_attrs
+        self.bin = bin
+        self.change_threshold = change_threshold
+        self.brightness_threshold = brightness_threshold
+        self.background_weight = background_weight
+        self.keep_every = keep_every
+
+        self.thumbnail_shape = binned_shape(
+            channel_shape(frame_shape, frame_attrs), bin
+        )
+        self.thumbnail_dtype = channel_dtype(frame_attrs)
+
+        self.background = None
+        self.n_frames = 0
+        self.n_kept = 0
+        self._n_since_kept = 0
+        self._lock = threading.Lock()
+
+    @property
+    def thumbnailer(self):
+        """ a picklable function of a frame that makes its thumbnail """
+        return partial(
+            _thumbnail,
+            frame_attrs=self.frame_attrs,
+            bin=self.bin,
+            dtype=self.thumbnail_dtype
+        )
+
+    def thumbnail(self, frame):
+        return self.thumbnailer(frame)
+
+    def __call__(self, frame):
+        """ returns whether to keep `frame`, its thumbnail & its
+        `SELECTION_DTYPE` record
+        """
+        thumbnail = self.thumbnail(frame)
+        keep, selection = self.decide(thumbnail)
+        return keep, thumbnail, selection
+
+    def decide(self, thumbnail):
+        """ returns whether to keep the frame `thumbnail` was made from, &
+        its `SELECTION_DTYPE` record. frames should be decided in order
+        """
+        values = thumbnail.astype(np.float32)
+        brightness = values.mean()
+
+        with self._lock:
+            if self.background is None:
+                change = np.nan
+                keep = True
+                self.background = values
+            else:
+                change = (
+                    np.abs(values - self.background).mean()
+                    / max(self.background.mean(), 1)
+                )
+                keep = bool(
+                    change >= self.change_threshold
+                    or (
+                        self.brightness_threshold is not None
+                        and brightness >= self.brightness_threshold
+                    )
+                    or (
+                        self.keep_every
+                        and self._n_since_kept + 1 >= self.keep_every
+                    )
+                )
+                self.background += self.background_weight * (
+                    values - self.background
+                )
+
+            self.n_frames += 1
+            if keep:
+                self.n_kept += 1
+                self._n_since_kept = 0
+            else:
+                self._n_since_kept += 1
+
+        selection = np.zeros((), dtype=SELECTION_DTYPE)
+        selection['kept'] = keep
+        selection['change'] = change
+        selection['brightness'] = brightness
+
+        return keep, selection
+
+    def summary(self):
+        return (
+            f'{self.n_kept} of {self.n_frames} frames kept at full resolution'
+        )
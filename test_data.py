@@ -0,0 +1,218 @@
+import h5py
+import numpy as np
+import pytest
+
+from data import (
+    Writer,
+    _create_files,
+    insert_datum,
+    pack_12bit,
+    read_file,
+    unpack_12bit
+)
+from selection import SELECTION_DTYPE
+
+RGB_ATTRS = dict(capture_mode='rgb', packing='none', bit_depth=8)
+RAW_ATTRS = dict(
+    capture_mode='raw', bayer_order='RGGB', bit_depth=12, packing='packed12'
+)
+
+
+def selected_file(outdir, kept, frame_shape=(8, 12, 3), frame_attrs=RGB_ATTRS):
+    """ an exposure file with a frame for each of `kept`, only stored if
+    it's True; frame i is all i. returns its path & the frames
+    """
+    path, _ = _create_files(
+        outdir,
+        'h0',
+        10,
+        len(kept),
+        frame_shape,
+        frame_dtype=np.uint8,
+        frame_attrs=frame_attrs,
+        selection_dtype=SELECTION_DTYPE
+    )
+
+    frames = []
+    for i, keep in enumerate(kept):
+        if frame_attrs['packing'] == 'packed12':
+            n_rows, n_bytes = frame_shape
+            frame = np.full((n_rows, n_bytes * 2 // 3), i, dtype=np.uint16)
+            stored = pack_12bit(frame)
+        else:
+            frame = stored = np.full(frame_shape, i, dtype=np.uint8)
+        frames.append(frame)
+
+        selection = np.zeros((), dtype=SELECTION_DTYPE)
+        selection['kept'] = keep
+        datum = dict(timestamp=1.7e9 + i, selection=selection)
+        if keep:
+            datum['exposure'] = stored
+        insert_datum(path, datum, i)
+
+    return path, np.array(frames)
+
+
+@pytest.mark.parametrize('kept', [
+    [True, False, False, True, True, False, False, False, False, True],
+    [True, False, True, False, True, False],
+    [True],
+])
+def test_read_file_kept_frames(tmp_path, kept):
+    path, frames = selected_file(tmp_path, kept)
+
+    timestamp, data = read_file(path, 'exposure')
+
+    rows = np.flatnonzero(kept)
+    assert (timestamp == 1.7e9 + rows).all()
+    assert (data == frames[rows]).all()
+
+    _, selection = read_file(path, 'selection')
+    assert (selection['kept'] == kept).all()
+
+
+def test_read_file_packed_frames(tmp_path):
+    kept = [True, False, True, True]
+    path, frames = selected_file(
+        tmp_path, kept, frame_shape=(4, 6), frame_attrs=RAW_ATTRS
+    )
+
+    _, data = read_file(path, 'exposure')
+
+    assert data.dtype == np.uint16
+    assert (data == frames[np.flatnonzero(kept)]).all()
+
+
+def test_read_file_no_frames(tmp_path):
+    path, _ = _create_files(
+        tmp_path, 'h0', 10, 10, (4, 6), frame_attrs=RAW_ATTRS
+    )
+
+    timestamp, data = read_file(path, 'exposure')
+
+    assert len(timestamp) == 0
+    assert data.shape == (0, 4, 4)
+
+
+def hour_files(outdir, n_hours, frame_shape=(4, 6, 3)):
+    """ the exposure file paths of `n_hours` hours """
+    return [
+        _create_files(
+            outdir, f'h{hour}', 10, 10, frame_shape, frame_attrs=RGB_ATTRS
+        )[0]
+        for hour in range(n_hours)
+    ]
+
+
+def frame_datum(i, frame_shape=(4, 6, 3)):
+    return dict(
+        timestamp=1.7e9 + i, exposure=np.full(frame_shape, i, dtype=np.uint8)
+    )
+
+
+def test_writer_closes_retired_files_only_when_asked(tmp_path):
+    closed = []
+    writer = Writer(on_close=lambda role, path: closed.append(path))
+    paths = hour_files(tmp_path, 4)
+
+    writer.prepare(exposure=paths[0])
+    writer.open(exposure=paths[0])
+    writer.insert(paths[0], frame_datum(0), 0)
+
+    writer.prepare(exposure=paths[1])
+    writer.open(exposure=paths[1])
+    # a late write to the last hour's file still goes to it
+    writer.insert(paths[0], frame_datum(1), 1)
+    assert not writer.has_retired
+
+    # the first write to the new file queues the old one to be closed...
+    writer.insert(paths[1], frame_datum(2), 0)
+    assert writer.has_retired and closed == []
+    # ... but it's still written to until then
+    writer.insert(paths[0], frame_datum(3), 2)
+
+    writer.close_retired()
+    assert closed == [paths[0]] and not writer.has_retired
+
+    # a file two `open`s back is queued by `open`, without a write
+    writer.prepare(exposure=paths[2])
+    writer.open(exposure=paths[2])
+    writer.prepare(exposure=paths[3])
+    writer.open(exposure=paths[3])
+    assert writer.has_retired and closed == [paths[0]]
+
+    writer.close()
+    assert closed == paths
+
+    timestamp, data = read_file(paths[0], 'exposure')
+    assert (timestamp == 1.7e9 + np.array([0, 1, 3])).all()
+    assert (data[:, 0, 0, 0] == [0, 1, 3]).all()
+
+
+def test_pack_12bit_layout():
+    packed = pack_12bit(np.array([[0xABC, 0x123]], dtype=np.uint16))
+
+    assert packed.dtype == np.uint8
+    assert packed.tolist() == [[0xBC, 0x3A, 0x12]]
+
+
+def test_pack_12bit_round_trip():
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 4096, size=(6, 10), dtype=np.uint16)
+
+    packed = pack_12bit(arr)
+    assert packed.shape == (6, 15)
+    assert (unpack_12bit(packed) == arr).all()
+
+    out = np.empty((6, 15), dtype=np.uint8)
+    assert pack_12bit(arr, out=out) is out
+    assert (out == packed).all()
+
+
+def test_writer_grows_and_trims(tmp_path):
+    path, = hour_files(tmp_path, 1)
+    writer = Writer(grow_by=16)
+    writer.prepare(exposure=path)
+    writer.open(exposure=path)
+
+    for i in range(5):
+        writer.insert(path, frame_datum(i), i)
+
+    # the datasets grow ahead of the writes, & n_valid says how far they got.
+    # (the file's opened in the writer's mode, so hdf5 shares its handle)
+    with h5py.File(path, 'r+') as f:
+        assert f['timestamp'].shape[0] >= 16
+        assert f.attrs['n_valid'] == 5
+
+    # a frame that wasn't kept leaves `exposure` a row short
+    writer.insert(path, dict(timestamp=1.7e9 + 5), 5)
+    writer.close()
+
+    with h5py.File(path, 'r') as f:
+        assert f.attrs['n_valid'] == 6
+        assert f.attrs['start_timestamp'] == 1.7e9
+        for key in ['timestamp', 'tick', 'jitter', 'exposure']:
+            assert f[key].shape[0] == 6
+        assert (f['exposure'][:5, 0, 0, 0] == np.arange(5)).all()
+
+
+def test_writer_batches_measurements(tmp_path):
+    _, path = _create_files(
+        tmp_path, 'h0', 10, 10, (4, 6, 3), frame_attrs=RGB_ATTRS
+    )
+    writer = Writer(batch_size=3)
+    writer.prepare(measurement=path)
+    writer.open(measurement=path)
+
+    for i in range(4):
+        writer.insert(path, np.array([1.7e9 + i, 20., 1., 2., 3.]), i)
+
+    # the last row is still waiting for its batch
+    with h5py.File(path, 'r+') as f:
+        assert (f['measurements'].fields('timestamp')[:] > 0).sum() == 3
+
+    writer.close()
+
+    timestamp, temperature = read_file(path, 'temperature')
+    assert (timestamp == 1.7e9 + np.arange(4)).all()
+    assert (temperature == 20.).all()
@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+import pytest
+
+import products
+from data import _create_files, insert_datum, night_files, plot_exposures
+from products import make_products, read_keogram
+
+RGB_ATTRS = dict(capture_mode='rgb', packing='none', bit_depth=8)
+FRAME_SHAPE = (16, 24, 3)
+
+
+def make_night(outdir, n_frames=(10, 5)):
+    """ an exposure file for each entry of `n_frames`, with that many frames,
+    a second apart; frame i of each file is all i
+    """
+    timestamp = 1.7e9
+    for hour, n in enumerate(n_frames):
+        path, _ = _create_files(
+            outdir, f'h{hour}', 10, n, FRAME_SHAPE, frame_attrs=RGB_ATTRS
+        )
+        for i in range(n):
+            insert_datum(
+                path,
+                dict(
+                    timestamp=timestamp,
+                    exposure=np.full(FRAME_SHAPE, i, dtype=np.uint8)
+                ),
+                i
+            )
+            timestamp += 1
+
+
+def test_keogram_is_added_to_once(tmp_path):
+    make_night(tmp_path)
+
+    make_products(tmp_path, n_workers=0, chunk_size=4)
+    make_products(tmp_path, n_workers=0, chunk_size=4)
+
+    timestamp, keogram = read_keogram(tmp_path)
+    assert len(timestamp) == 15
+    assert (np.diff(timestamp) == 1).all()
+    assert keogram.shape == (15, FRAME_SHAPE[0], 3)
+
+
+def test_keogram_rows_done(tmp_path):
+    make_night(tmp_path)
+    paths = night_files(tmp_path)
+
+    # the files are added one at a time as they're closed, during the night
+    for path in paths:
+        make_products(tmp_path, paths=[path], n_workers=0, chunk_size=4)
+    assert products._rows_done(tmp_path) == {
+        'h0-exposures.hdf5': 10, 'h1-exposures.hdf5': 5
+    }
+
+    # frames written to a file since it was last added are added on their own
+    for i in range(5, 8):
+        insert_datum(
+            paths[1],
+            dict(
+                timestamp=1.7e9 + 10 + i,
+                exposure=np.full(FRAME_SHAPE, i, dtype=np.uint8)
+            ),
+            i
+        )
+    make_products(tmp_path, n_workers=0, chunk_size=4)
+
+    assert products._rows_done(tmp_path)['h1-exposures.hdf5'] == 8
+    timestamp, keogram = read_keogram(tmp_path)
+    assert (timestamp == 1.7e9 + np.arange(18)).all()
+    # the strips are in frame order, & frame i of each file is all i
+    assert (keogram[:, 0, 0] == [*range(10), *range(8)]).all()
+
+
+def test_keogram_after_interrupted_run(tmp_path, monkeypatch):
+    make_night(tmp_path)
+
+    def failing_write(self, frame):
+        if self.n_frames == 6:
+            raise OSError('disk full')
+        self.n_frames += 1
+
+    monkeypatch.setattr(products.Timelapse, 'write', failing_write)
+    with pytest.raises(OSError):
+        make_products(
+            tmp_path,
+            timelapse=f'{tmp_path}/night.mp4',
+            n_workers=0,
+            chunk_size=4
+        )
+    monkeypatch.undo()
+
+    # only the first chunk got into the keogram before the failure
+    assert len(read_keogram(tmp_path)[0]) == 4
+
+    make_products(tmp_path, n_workers=0, chunk_size=4)
+
+    timestamp, _ = read_keogram(tmp_path)
+    assert len(timestamp) == 15
+    assert len(np.unique(timestamp)) == 15
+
+
+def test_png_timelapse(tmp_path):
+    pytest.importorskip('matplotlib')
+    make_night(tmp_path)
+
+    products.make_timelapse(
+        tmp_path, f'{tmp_path}/frames', timelapse_bin=2, n_workers=0
+    )
+
+    pngs = sorted(os.listdir(f'{tmp_path}/frames'))
+    assert pngs == [f'{i:06d}.png' for i in range(15)]
+    # the timelapse alone leaves the keogram alone
+    assert not os.path.exists(products.keogram_path(tmp_path))
+
+
+def test_plot_exposures(tmp_path):
+    pytest.importorskip('matplotlib')
+    make_night(tmp_path, n_frames=(3,))
+
+    plot_exposures(tmp_path)
+
+    assert sorted(
+        file for file in os.listdir(tmp_path) if file.endswith('.png')
+    ) == [f'exposure-{i}.png' for i in range(3)]
+    assert not os.path.exists(products.keogram_path(tmp_path))
@@ -0,0 +1,83 @@
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+from recover import _lookup3, clear_status_flags, recover_file
+
+
+@pytest.mark.parametrize('data, initval, expected', [
+    # from the self test of lookup3.c
+    (b'', 0, 0xDEADBEEF),
+    (b'', 0xDEADBEEF, 0xBD5B7DDE),
+    (b'Four score and seven years ago', 0, 0x17770551),
+    (b'Four score and seven years ago', 1, 0xCD628161),
+])
+def test_lookup3(data, initval, expected):
+    assert _lookup3(data, initval) == expected
+
+
+def test_lookup3_matches_hdf5(tmp_path):
+    path = f'{tmp_path}/a.hdf5'
+    with h5py.File(path, 'w', libver='latest'):
+        pass
+
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        size_of_offsets = header[9]
+        header += f.read(4 * size_of_offsets)
+        checksum = int.from_bytes(f.read(4), 'little')
+
+    assert header[8] >= 2
+    assert _lookup3(header) == checksum
+
+
+def left_open(tmp_path):
+    """ a copy of a file taken while it was open for writing, as a power cut
+    would leave it
+    """
+    path = f'{tmp_path}/open.hdf5'
+    copy = f'{tmp_path}/0-exposures.hdf5'
+    with h5py.File(path, 'w', libver='latest') as f:
+        f['timestamp'] = np.arange(1, 5, dtype=np.float64)
+        f.flush()
+        shutil.copy(path, copy)
+    return copy
+
+
+def test_clear_status_flags(tmp_path):
+    path = left_open(tmp_path)
+    with pytest.raises(OSError):
+        h5py.File(path, 'r+').close()
+
+    assert clear_status_flags(path)
+    with h5py.File(path, 'r+') as f:
+        assert (f['timestamp'][:] == np.arange(1, 5)).all()
+
+    # a closed file has none to clear
+    assert not clear_status_flags(path)
+
+
+def test_recover_file_cuts_back_to_last_row(tmp_path):
+    path = f'{tmp_path}/0-exposures.hdf5'
+    with h5py.File(path, 'w', libver='latest') as f:
+        # the last two rows were grown but never written
+        f.create_dataset(
+            'timestamp',
+            data=[1.7e9, 1.7e9 + 1, 1.7e9 + 2, 0, 0],
+            maxshape=(None,)
+        )
+        f.create_dataset(
+            'exposure',
+            data=np.zeros((5, 4, 6, 3), dtype=np.uint8),
+            maxshape=(None, 4, 6, 3)
+        )
+
+    kept = recover_file(path)
+
+    assert kept == dict(timestamp=3, exposure=3)
+    with h5py.File(path, 'r') as f:
+        assert f['exposure'].shape[0] == 3
+        assert f.attrs['n_valid'] == 3
+        assert f.attrs['start_timestamp'] == 1.7e9
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from data import pack_12bit
+from reduction import (
+    PERCENTILES,
+    FramePyramid,
+    FrameReducer,
+    bin_image,
+    channel_image
+)
+
+RGB_ATTRS = dict(capture_mode='rgb', packing='none', bit_depth=8)
+RAW_ATTRS = dict(
+    capture_mode='raw', bayer_order='RGGB', bit_depth=12, packing='none'
+)
+PACKED_ATTRS = {**RAW_ATTRS, 'packing': 'packed12'}
+
+
+def random_frame(frame_attrs, seed=0):
+    """ a frame laid out like `frame_attrs`, & its unpacked pixels """
+    rng = np.random.default_rng(seed)
+    if frame_attrs['capture_mode'] == 'rgb':
+        frame = rng.integers(0, 256, size=(300, 40, 3), dtype=np.uint8)
+        frame[0, 0] = 255
+        return frame, frame
+
+    pixels = rng.integers(0, 4096, size=(300, 40), dtype=np.uint16)
+    pixels[0, 0] = 4095
+    if frame_attrs['packing'] == 'packed12':
+        return pack_12bit(pixels), pixels
+    return pixels, pixels
+
+
+@pytest.mark.parametrize('frame_attrs', [RGB_ATTRS, RAW_ATTRS, PACKED_ATTRS])
+def test_frame_reducer(frame_attrs):
+    frame, pixels = random_frame(frame_attrs)
+    reducer = FrameReducer(frame_attrs)
+
+    stats = reducer(frame)
+
+    values = channel_image(pixels, {**frame_attrs, 'packing': 'none'})
+    values = values.reshape(-1, values.shape[-1])
+    n_values = 2 ** frame_attrs['bit_depth']
+    assert stats['mean'] == pytest.approx(values.mean(axis=0), rel=1e-6)
+    # by nearest rank: the smallest value at least p% of pixels are <=
+    assert (stats['percentiles'] == np.percentile(
+        values, PERCENTILES, axis=0, method='inverted_cdf'
+    ).T).all()
+    assert (stats['median'] == np.percentile(
+        values, 50, axis=0, method='inverted_cdf'
+    )).all()
+    assert (stats['n_saturated'] == (values == n_values - 1).sum(axis=0)).all()
+    assert (stats['histogram'].sum(axis=1) == len(values)).all()
+    assert (stats['histogram'] == np.stack([
+        np.histogram(channel, reducer.attrs['histogram_edges'])[0]
+        for channel in values.T
+    ])).all()
+
+
+def test_bin_image():
+    image = np.arange(4 * 6, dtype=np.uint16).reshape(4, 6, 1)
+
+    binned = bin_image(image, 2)
+
+    assert binned.shape == (2, 3, 1)
+    assert binned[..., 0].tolist() == [[4, 6, 8], [16, 18, 20]]
+
+
+@pytest.mark.parametrize('frame_attrs', [RGB_ATTRS, PACKED_ATTRS])
+def test_frame_pyramid(frame_attrs):
+    frame, pixels = random_frame(frame_attrs)
+    pyramid = FramePyramid(frame_attrs, frame.shape, levels=[2, 4, 6])
+
+    binned = pyramid(frame)
+
+    image = channel_image(pixels, {**frame_attrs, 'packing': 'none'})
+    assert set(binned) == {'binned2', 'binned4', 'binned6'}
+    for level in [2, 4, 6]:
+        expected = bin_image(image, level, pyramid.dtype)
+        assert binned[f'binned{level}'].shape == pyramid.shapes[f'binned{level}']
+        assert (binned[f'binned{level}'] == expected).all()
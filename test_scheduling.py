@@ -0,0 +1,74 @@
+import asyncio
+
+from clock import Clock
+from scheduling import Schedule
+
+
+class FakeClock(Clock):
+    """ a monotonic clock that only moves when slept on, or by `advance` """
+
+    def __init__(self):
+        self.t = 100.
+
+    def monotonic(self):
+        return self.t
+
+    def advance(self, seconds):
+        self.t += seconds
+
+    async def async_sleep(self, seconds):
+        self.t += max(seconds, 0)
+
+
+def run_schedule(overrun, n_ticks=6, overrun_tick=1, work=2.5):
+    """ the ticks a `Schedule` with a 1s interval yields, if tick
+    `overrun_tick` takes `work` seconds & the rest none, & when they start
+    """
+    clock = FakeClock()
+    schedule = Schedule(1, n_ticks=n_ticks, overrun=overrun, clock=clock)
+
+    async def run():
+        ticks = []
+        async for tick in schedule:
+            ticks.append((tick, clock.monotonic() - schedule.t0))
+            if tick == overrun_tick:
+                clock.advance(work)
+        return ticks
+
+    return schedule, asyncio.run(run())
+
+
+def test_on_time():
+    schedule, ticks = run_schedule('skip', work=0)
+
+    assert ticks == [(tick, float(tick)) for tick in range(6)]
+    assert schedule.n_late == schedule.n_missed == 0
+
+
+def test_skip():
+    schedule, ticks = run_schedule('skip')
+
+    # tick 1 ran until 3.5, so tick 2's slot was missed & tick 3 runs late
+    assert ticks == [(0, 0.), (1, 1.), (3, 3.5), (4, 4.), (5, 5.)]
+    assert schedule.n_missed == 1
+    assert schedule.n_late == 1
+    assert schedule.n_run == 5
+    assert schedule.max_lateness == 0.5
+
+
+def test_catch_up():
+    schedule, ticks = run_schedule('catch_up')
+
+    # ticks 2 & 3 are run back to back, then it's back on the grid
+    assert ticks == [(0, 0.), (1, 1.), (2, 3.5), (3, 3.5), (4, 4.), (5, 5.)]
+    assert schedule.n_missed == 0
+    assert schedule.n_late == 2
+    assert schedule.max_lateness == 1.5
+
+
+def test_skip_past_the_end():
+    # the slots that pass while tick 1 runs include all that were left
+    schedule, ticks = run_schedule('skip', n_ticks=3, work=5)
+
+    assert [tick for tick, _ in ticks] == [0, 1]
+    assert schedule.n_run == 2
@@ -0,0 +1,59 @@
+import asyncio
+
+from metrics import metrics
+from write_queue import WriteQueue
+
+
+def test_consumer_survives_failed_write():
+    written, done = [], []
+
+    async def write(path, datum, index):
+        if index == 1:
+            raise OSError('usb drive went away')
+        written.append(index)
+
+    async def run():
+        queue = WriteQueue(write, maxsize=1, on_done=done.append)
+        queue.start()
+        for index in range(4):
+            await asyncio.wait_for(queue.put('h0.hdf5', index, index), 5)
+        await queue.close(timeout=5)
+        return queue
+
+    n_failures = metrics.counters['write_queue_failure']
+    queue = asyncio.run(run())
+
+    assert written == [0, 2, 3]
+    assert queue.n_written == 3
+    # the failed write's datum is still handed back
+    assert done == [0, 1, 2, 3]
+    assert metrics.counters['write_queue_failure'] == n_failures + 1
+
+
+def test_drop_oldest():
+    written, done = [], []
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def write(path, datum, index):
+            await gate.wait()
+            written.append(index)
+
+        queue = WriteQueue(
+            write, maxsize=2, overflow='drop_oldest', on_done=done.append
+        )
+        queue.start()
+        for index in range(5):
+            await queue.put('h0.hdf5', index, index)
+            await asyncio.sleep(0)
+        gate.set()
+        await queue.close(timeout=5)
+        return queue
+
+    queue = asyncio.run(run())
+
+    # 0 was being written; 1 & 2 made way for 3 & 4
+    assert written == [0, 3, 4]
+    assert queue.n_dropped == 2
+    assert sorted(done) == [0, 1, 2, 3, 4]
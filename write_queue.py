@@ -0,0 +1,133 @@
+import sys
+import asyncio
+from time import monotonic
+
+from metrics import metrics
+
+from logger import setup_logger
+log = setup_logger('write-queue-logger', sys.stdout, 'write-queue')
+
+OVERFLOW_POLICIES = ['block', 'drop_oldest', 'drop_newest']
+
+
+class WriteQueue:
+    """ bounded, ordered queue with a single consumer, so only one write to
+    the exposure file is ever in flight and the memory held in pending frames
+    is bounded by `maxsize`.
+
+    write: coroutine function called like `write(path, datum, index)`. it may
+        return False if it gave up on a write that could still be using
+        `datum`, in which case `datum` isn't passed to `on_done`
+    maxsize: int, maximum number of pending writes
+    overflow: what `put` does when the queue is full;
+        'block': wait for room in the queue
+        'drop_oldest': discard the oldest pending write to make room
+        'drop_newest': discard the write being put
+    on_done: optional function called like `on_done(datum)` once a datum has
+        been written or dropped, eg to recycle its frame buffer
+    """
+
+    def __init__(self, write, maxsize=4, overflow='block', on_done=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of {OVERFLOW_POLICIES}')
+
+        self.write = write
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.on_done = on_done
+
+        self.n_written = 0
+        self.n_dropped = 0
+        self.last_lag = 0.
+        self.max_lag = 0.
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._consumer = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def put(self, path, datum, index):
+        item = (path, datum, index, monotonic())
+
+        if self.overflow == 'block' or not self._queue.full():
+            await self._queue.put(item)
+        elif self.overflow == 'drop_oldest':
+            _, dropped_datum, dropped_index, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            self._queue.put_nowait(item)
+            self._drop(dropped_datum, dropped_index)
+        else:
+            self._drop(datum, index)
+
+    def _done(self, datum):
+        if self.on_done is not None:
+            self.on_done(datum)
+
+    def _drop(self, datum, index):
+        self._done(datum)
+        self.n_dropped += 1
+        metrics.count('write_dropped')
+        log.warning(
+            f'write queue full; dropped write at index {index} '
+            f'({self.n_dropped} dropped so far)'
+        )
+
+    async def _consume(self):
+        while True:
+            path, datum, index, put_time = await self._queue.get()
+            try:
+                await self._write(path, datum, index, put_time)
+            except Exception as e:
+                # keep consuming, or `put` & `close` would wait on a dead queue
+                log.error(f'failed to write index {index} to {path}: {e!r}')
+                metrics.count('write_queue_failure')
+            finally:
+                self._queue.task_done()
+
+    async def _write(self, path, datum, index, put_time):
+        metrics.record('queue_wait', monotonic() - put_time)
+        try:
+            finished = await self.write(path, datum, index) is not False
+        except Exception:
+            # the write's over, so the datum can still be recycled
+            self._done(datum)
+            raise
+        if finished:
+            self._done(datum)
+
+        self.n_written += 1
+        self.last_lag = monotonic() - put_time
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+        log.info(
+            f'wrote index {index} to {path}; '
+            f'queue depth = {self.depth}, write lag = {self.last_lag:.2f}s'
+        )
+
+    async def close(self, timeout=60):
+        """ wait up to `timeout` seconds for pending writes, then stop """
+        try:
+            async with asyncio.timeout(timeout):
+                await self._queue.join()
+        except asyncio.TimeoutError:
+            log.error(
+                f'{self.depth} writes still pending after {timeout}s; '
+                'discarding them'
+            )
+        finally:
+            if self._consumer is not None:
+                self._consumer.cancel()
+                try:
+                    await self._consumer
+                except asyncio.CancelledError:
+                    pass
+
+        log.info(
+            f'write queue closed; {self.n_written} written, '
+            f'{self.n_dropped} dropped, max write lag = {self.max_lag:.2f}s'
+        )